@@ -0,0 +1,1093 @@
+"""
+Offline benchmarks for the bot.
+
+    python bench.py checkout --buyers 500
+    python bench.py catalog --skus 100 1000 10000
+    python bench.py load --users 200 --latency-ms 30 --flood-rate 0.01
+    python bench.py stress --users 200 --taps 20
+    python bench.py startup --skus 1000
+    python bench.py search --skus 100 1000 10000
+    python bench.py routes
+    python bench.py conformance
+    python bench.py taps --users 200 --taps 20
+
+`checkout` measures the storage layer alone, `catalog` how page rendering
+scales with the number of products. `load` drives the real
+Application and handlers with synthetic updates against a local stand-in
+for the Bot API that records calls and can inject latency and 429s.
+`stress` feeds interleaved taps from many users through the concurrent
+update pipeline and then checks that no stock or cart went wrong.
+`search` times the inline search index build and prefix/typo lookups.
+`startup` times init_db() on a new, an unversioned and an up-to-date DB,
+plus a whole cold process start (interpreter + imports + init_db).
+`routes` presses every callback button (and stale/garbage ones) through
+the real handlers and checks what the bot sends back. `conformance` runs the same stock/cart/checkout checks (restarts and
+crashes included) against every storage engine and exits non-zero if one
+fails; `taps` compares their per-tap cart latency.
+Everything runs against a throwaway SQLite file; no Telegram token or
+network needed.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import re
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+# bot.py validates these at import time
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_CHAT_ID", "1")
+_tmpdir = tempfile.mkdtemp(prefix="bot-bench-")
+os.environ["DB_PATH"] = os.path.join(_tmpdir, "bench.db")
+
+import bot  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder, TypeHandler  # noqa: E402
+
+# queueing hundreds of calls at once is the point here, not worth a warning each
+logging.getLogger("bot").setLevel(logging.ERROR)
+
+
+def legacy_checkout(user_id: int):
+    # the pre-engine checkout: per-line SELECT + UPDATE, one transaction per buyer
+    with bot.DB.write() as conn:
+        items = [(int(r["product_id"]), int(r["qty"])) for r in
+                 conn.execute("SELECT product_id, qty FROM cart WHERE user_id = ?", (user_id,)).fetchall()]
+        if not items:
+            return False, "Корзина пуста.", []
+        for product_id, q in items:
+            row = conn.execute("SELECT qty FROM stock WHERE product_id=?", (product_id,)).fetchone()
+            if q > (int(row["qty"]) if row else 0):
+                return False, "short", items
+        for product_id, q in items:
+            conn.execute("UPDATE stock SET qty = qty - ? WHERE product_id=?", (q, product_id))
+        conn.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
+    return True, "OK", items
+
+
+def fill_carts(buyers: int, lines: int):
+    with bot.DB.write() as conn:
+        products = [r["id"] for r in conn.execute("SELECT id FROM products ORDER BY id LIMIT ?", (lines,))]
+        conn.execute("DELETE FROM cart")
+        conn.execute("DELETE FROM orders")
+        conn.execute("UPDATE stock SET qty = ?, reserved = 0", (buyers * 2,))
+        conn.executemany(
+            "INSERT INTO cart(user_id, product_id, qty) VALUES(?, ?, 1)",
+            [(uid, p) for uid in range(1, buyers + 1) for p in products],
+        )
+        bot._load_stock(conn)
+
+
+async def run_orders(checkout, buyers: int) -> float:
+    started = time.perf_counter()
+    results = await asyncio.gather(*[checkout(uid) for uid in range(1, buyers + 1)])
+    elapsed = time.perf_counter() - started
+    failed = sum(1 for r in results if not r[0])
+    if failed:
+        print(f"  warning: {failed} orders failed")
+    return elapsed
+
+
+def bench_checkout(args):
+    bot.init_db()
+    store = bot.Store()
+
+    async def legacy(uid):
+        return await store.call(legacy_checkout, uid)
+
+    for name, fn in (("per-order transactions", legacy), ("group commit", store.checkout)):
+        fill_carts(args.buyers, args.lines)
+        elapsed = asyncio.run(run_orders(fn, args.buyers))
+        print(f"{name:>24}: {args.buyers / elapsed:8.0f} orders/s ({elapsed * 1000:.0f} ms for {args.buyers})")
+
+    store.close()
+    bot.close_db()
+
+
+def fill_category(skus: int) -> int:
+    """A category with `skus` in-stock products; returns its id."""
+    category_id = bot.add_category(f"bench {skus}")
+    with bot.DB.write() as conn:
+        conn.executemany(
+            "INSERT INTO products(category_id, name, lookup_key, position) VALUES(?, ?, ?, ?)",
+            [(category_id, f"SKU {i}", f"BENCH {skus} {i}", i) for i in range(skus)],
+        )
+        conn.execute("INSERT OR IGNORE INTO stock(product_id, qty) SELECT id, 5 FROM products WHERE category_id = ?", (category_id,))
+        bot._load_stock(conn)
+    return category_id
+
+def bench_catalog(args):
+    bot.init_db()
+    print(f"{'skus':>8} {'first page ms':>14} {'last page ms':>13} {'cached ms':>10}")
+    for skus in args.skus:
+        category_id = fill_category(skus)
+        last = (skus - 1) // bot.CATALOG_PAGE_SIZE
+
+        def timed(page: int) -> float:
+            # query + keyboard build, what a cache miss costs
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                _, items, has_next = bot.products_page(category_id, page)
+                bot.products_kb(category_id, items, page, has_next)
+            return (time.perf_counter() - started) / args.repeat * 1000
+
+        first, tail = timed(0), timed(last)
+
+        async def cached() -> float:
+            await bot.category_view(category_id, 0)  # warm
+            started = time.perf_counter()
+            for _ in range(args.repeat):
+                await bot.category_view(category_id, 0)
+            return (time.perf_counter() - started) / args.repeat * 1000
+
+        print(f"{skus:>8} {first:>14.3f} {tail:>13.3f} {asyncio.run(cached()):>10.4f}")
+    bot.store.close()
+    bot.close_db()
+
+
+def fill_named_category(skus: int, rng: random.Random) -> List[str]:
+    """A category of `skus` products named from flavor words and made-up ones; returns the names."""
+    syllables = ["ка", "ви", "ло", "ма", "ні", "ру", "те", "зо", "пи", "ля", "шо", "го", "ду", "бе"]
+    words = {w for f in bot.FLAVORS for w in f.split()}
+    words |= {"".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).upper() for _ in range(skus // 4)}
+    words = sorted(words)
+    names = sorted({f"{rng.choice(words)} {rng.choice(words)} {i}" for i in range(skus)})
+    category_id = bot.add_category(f"search {skus}")
+    with bot.DB.write() as conn:
+        conn.executemany(
+            "INSERT INTO products(category_id, name, lookup_key, position) VALUES(?, ?, ?, ?)",
+            [(category_id, name, bot.product_key(name), i) for i, name in enumerate(names)],
+        )
+        conn.execute("INSERT OR IGNORE INTO stock(product_id, qty) SELECT id, 5 FROM products WHERE category_id = ?", (category_id,))
+        bot._load_stock(conn)
+    return names
+
+def bench_search(args):
+    bot.init_db()
+    rng = random.Random(args.seed)
+    print(f"{'skus':>8} {'build ms':>9} {'prefix us':>10} {'typo us':>9} {'exact us':>9}")
+    for skus in args.skus:
+        names = fill_named_category(skus, rng)
+        started = time.perf_counter()
+        bot.SEARCH.invalidate()
+        bot.SEARCH.product(0)  # forces the rebuild
+        build = (time.perf_counter() - started) * 1000
+        sample = [rng.choice(names) for _ in range(args.repeat)]
+
+        def timed(make_query, fn) -> float:
+            queries = [make_query(name) for name in sample]
+            started = time.perf_counter()
+            for q in queries:
+                fn(q)
+            return (time.perf_counter() - started) / len(queries) * 1e6
+
+        def typo(name: str) -> str:
+            # one letter dropped from the first word: never a prefix match
+            word = name.split()[0]
+            i = rng.randrange(1, len(word))
+            return word[:i] + word[i + 1:]
+
+        prefix = timed(lambda name: name.split()[0][:3].lower(), lambda q: bot.search_products(q, bot.INLINE_RESULTS))
+        fuzzy = timed(typo, lambda q: bot.search_products(q, bot.INLINE_RESULTS))
+        exact = timed(lambda name: name.lower(), lambda q: bot.find_products([q]))
+        print(f"{skus:>8} {build:>9.1f} {prefix:>10.0f} {fuzzy:>9.0f} {exact:>9.1f}")
+    bot.close_db()
+
+
+# =========================
+# Fake Bot API
+# =========================
+class FakeBotAPI:
+    """Answers Bot API methods with plausible results; records every call."""
+
+    def __init__(self, latency: float, flood_rate: float, retry_after: int):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.log: List[Tuple[str, Dict[str, str]]] = []  # (method, params) of every answered call
+        self.floods = 0
+        self.photos: Dict[Tuple[int, int], dict] = {}  # (chat, message id) -> photo messages sent
+        self._message_id = 0
+        self._server = None
+        self.port = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                req = await bot._read_http_request(reader)
+                if req is None:
+                    break
+                _, path, headers, body = req
+                status, payload = await self.handle(path.rsplit("/", 1)[-1], headers, body)
+                writer.write(bot._http_response(status, json.dumps(payload).encode(), "application/json", True))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _params(headers: Dict[str, str], body: bytes) -> Dict[str, str]:
+        if headers.get("content-type", "").startswith("multipart/"):
+            # only chat_id matters for the fake answer
+            m = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', body)
+            return {"chat_id": m.group(1).decode()} if m else {}
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+    def _message(self, params: Dict[str, str], **extra) -> dict:
+        self._message_id += 1
+        chat_id = int(params.get("chat_id") or 0)
+        return {
+            "message_id": int(params.get("message_id") or self._message_id),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **extra,
+        }
+
+    async def handle(self, method: str, headers: Dict[str, str], body: bytes) -> Tuple[int, dict]:
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method not in ("getMe", "answerCallbackQuery") and random.random() < self.flood_rate:
+            self.floods += 1
+            return 429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        params = self._params(headers, body)
+        self.log.append((method, params))
+        target = (int(params.get("chat_id") or 0), int(params.get("message_id") or 0))
+        if method == "editMessageText" and target in self.photos:
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: there is no text in the message to edit"}
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(params, text=params.get("text", ""))
+        elif method == "sendPhoto":
+            result = self._message(params, photo=[{"file_id": "bench-photo", "file_unique_id": "u", "width": 1, "height": 1}])
+            self.photos[(result["chat"]["id"], result["message_id"])] = result
+        elif method == "deleteMessage":
+            result = self.photos.pop(target, None) is not None
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+
+# =========================
+# Load scenarios
+# =========================
+_update_ids = iter(range(1, 1 << 62))
+
+def user_dict(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+def callback_update(app, uid: int, data: str, version: Optional[int] = None, message: Optional[dict] = None) -> Update:
+    n = next(_update_ids)
+    # by default every tap sees a fresh version of a text message, so none is dropped as a double tap
+    message = message or {"message_id": 1, "date": version or n, "chat": {"id": uid, "type": "private"}, "text": "menu"}
+    return Update.de_json({
+        "update_id": n,
+        "callback_query": {
+            "id": str(n), "from": user_dict(uid), "chat_instance": str(uid), "data": data, "message": message,
+        },
+    }, app.bot)
+
+def command_update(app, uid: int, text: str) -> Update:
+    n = next(_update_ids)
+    command = text.split()[0]
+    return Update.de_json({
+        "update_id": n,
+        "message": {
+            "message_id": n, "date": 0, "chat": {"id": uid, "type": "private"}, "from": user_dict(uid),
+            "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }, app.bot)
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+async def run_session(app, updates: List[Update], latencies: List[float]):
+    # one user's taps happen one after another, like a real client
+    for update in updates:
+        started = time.perf_counter()
+        await app.process_update(update)
+        latencies.append(time.perf_counter() - started)
+
+# the seeded catalog: category 1, product ids = positions in FLAVORS
+REGULAR = 6
+LIMITED = [i for i, f in enumerate(bot.FLAVORS, 1) if "LIMITED" in f]
+
+def scenario_sessions(app, name: str, users: int, taps: int) -> List[List[Update]]:
+    sessions = []
+    for i in range(users):
+        uid = 10_000 + i
+        if name == "browse":
+            s = [command_update(app, uid, "/start"), callback_update(app, uid, bot.cb("cat", "1.0")),
+                 callback_update(app, uid, bot.cb("fl", REGULAR)), callback_update(app, uid, bot.cb("menu"))]
+        elif name == "cart":
+            s = [callback_update(app, uid, bot.cb("add", REGULAR))] + \
+                [callback_update(app, uid, bot.cb("inc", REGULAR)) for _ in range(taps)]
+        else:  # flash sale
+            s = [callback_update(app, uid, bot.cb("add", LIMITED[0])), callback_update(app, uid, bot.cb("order"))]
+        sessions.append(s)
+    return sessions
+
+def reset_state(users: int):
+    with bot.DB.write() as conn:
+        conn.execute("DELETE FROM cart")
+        conn.execute("DELETE FROM outbox")
+        conn.execute("DELETE FROM orders")
+        conn.execute("UPDATE stock SET qty = ?, reserved = 0", (users * 100,))
+        conn.executemany("UPDATE stock SET qty = ? WHERE product_id = ?", [(users // 2, p) for p in LIMITED])
+        bot._load_stock(conn)
+
+async def load_test(args):
+    api = FakeBotAPI(args.latency_ms / 1000, args.flood_rate, args.retry_after)
+    await api.start()
+    builder = (
+        ApplicationBuilder()
+        .application_class(bot.TracedApplication)
+        .token(os.environ["BOT_TOKEN"])
+        .base_url(f"http://127.0.0.1:{api.port}/bot")
+        .updater(None)
+    )
+    if not args.no_rate_limit:
+        builder = builder.rate_limiter(bot.FloodLimiter())
+    app = builder.build()
+    bot.add_handlers(app)
+    await app.initialize()
+    bot.outbox.start(app.bot)
+    try:
+        print(f"{'scenario':>10} {'updates':>8} {'upd/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  bot api calls")
+        for name in args.scenarios:
+            reset_state(args.users)
+            sessions = scenario_sessions(app, name, args.users, args.taps)
+            api.calls.clear()
+            latencies: List[float] = []
+            started = time.perf_counter()
+            await asyncio.gather(*[run_session(app, s, latencies) for s in sessions])
+            elapsed = time.perf_counter() - started
+            await bot.edits.flush()  # trailing ➕/➖ edits still waiting out the debounce
+            calls = ", ".join(f"{m}={n}" for m, n in api.calls.most_common())
+            print(f"{name:>10} {len(latencies):>8} {len(latencies) / elapsed:>8.0f} "
+                  f"{percentile(latencies, .5) * 1000:>8.1f} {percentile(latencies, .95) * 1000:>8.1f} "
+                  f"{percentile(latencies, .99) * 1000:>8.1f}  {calls}")
+        await bot.outbox.flush()
+        print(f"injected 429s: {api.floods}")
+    finally:
+        await bot.outbox.stop()
+        await app.shutdown()
+        await api.close()
+
+def bench_load(args):
+    bot.init_db()
+    try:
+        asyncio.run(load_test(args))
+    finally:
+        bot.store.close()
+        bot.close_db()
+
+
+# =========================
+# Concurrency stress
+# =========================
+def stress_sessions(app, users: int, taps: int, products: List[int], rng: random.Random) -> List[List[Update]]:
+    sessions = []
+    for i in range(users):
+        uid = 20_000 + i
+        s = [callback_update(app, uid, bot.cb(rng.choice(("add", "inc", "inc", "dec")), rng.choice(products)))
+             for _ in range(taps)]
+        if rng.random() < 0.1:
+            s.append(callback_update(app, uid, bot.cb("clear")))
+        s.append(callback_update(app, uid, bot.cb("order")))
+        sessions.append(s)
+    return sessions
+
+def interleave(sessions: List[List[Update]], rng: random.Random) -> List[Update]:
+    # random arrival order across users, each user's own taps stay in order
+    queues = [list(reversed(s)) for s in sessions]
+    out = []
+    while queues:
+        q = rng.choice(queues)
+        out.append(q.pop())
+        if not q:
+            queues.remove(q)
+    return out
+
+def check_invariants(initial: Dict[int, int]) -> List[str]:
+    """Every session ends with an order, so all stock must be either sold or back on the shelf."""
+    problems = []
+    with bot.DB.read() as conn:
+        stock = {r["product_id"]: (r["qty"], r["reserved"]) for r in
+                 conn.execute("SELECT product_id, qty, reserved FROM stock").fetchall()}
+        in_carts = dict(conn.execute("SELECT product_id, SUM(qty) FROM cart GROUP BY product_id").fetchall())
+        leftover = conn.execute("SELECT COUNT(DISTINCT user_id) FROM cart").fetchone()[0]
+        labels = {r["label"]: r["id"] for r in conn.execute(
+            "SELECT p.id, c.title || ' · ' || p.name AS label FROM products p JOIN categories c ON c.id = p.category_id")}
+        sold: Counter = Counter()
+        for (text,) in conn.execute("SELECT text FROM outbox").fetchall():
+            for label, q in re.findall(r"^• (.+) × (\d+)$", text, re.M):
+                sold[labels[label]] += int(q)
+    if leftover:
+        problems.append(f"{leftover} carts left after their owner's order (updates ran out of order)")
+    for pid, start in initial.items():
+        qty, reserved = stock[pid]
+        if qty < 0 or reserved < 0:
+            problems.append(f"product {pid}: qty={qty} reserved={reserved}")
+        if reserved != in_carts.get(pid, 0):
+            problems.append(f"product {pid}: reserved {reserved} but carts hold {in_carts.get(pid, 0)}")
+        if start != qty + sold[pid]:
+            problems.append(f"product {pid}: started with {start}, {qty} left + {sold[pid]} sold")
+    if bot.STOCK.all() != {pid: max(q - r, 0) for pid, (q, r) in stock.items()}:
+        problems.append("stock cache differs from the DB")
+    return problems
+
+async def stress_test(args):
+    rng = random.Random(args.seed)
+    api = FakeBotAPI(args.latency_ms / 1000, 0.0, 1)
+    await api.start()
+    processor = bot.UserOrderedProcessor(args.concurrency) if args.ordered else args.concurrency
+    app = (
+        ApplicationBuilder()
+        .application_class(bot.TracedApplication)
+        .token(os.environ["BOT_TOKEN"])
+        .base_url(f"http://127.0.0.1:{api.port}/bot")
+        .updater(None)
+        .job_queue(None)
+        .concurrent_updates(processor)
+        .build()
+    )
+    bot.add_handlers(app)
+    done = asyncio.Event()
+    processed = 0
+    updates: List[Update] = []
+
+    async def count(update, context):
+        nonlocal processed
+        processed += 1
+        if processed == len(updates):
+            done.set()
+    app.add_handler(TypeHandler(Update, count), group=1)
+
+    products = list(range(1, args.products + 1))
+    with bot.DB.write() as conn:
+        conn.execute("DELETE FROM cart")
+        conn.execute("DELETE FROM outbox")
+        conn.execute("DELETE FROM orders")
+        conn.execute("UPDATE stock SET qty = 0, reserved = 0")
+        # scarce on purpose: users fight over the same units
+        conn.executemany("UPDATE stock SET qty = ? WHERE product_id = ?", [(args.users // 2, p) for p in products])
+        bot._load_stock(conn)
+    bot.store = bot.Store(bot.make_engine(args.engine))
+    bot.store.engine.load()
+    initial = {p: (args.users // 2 if p in products else 0) for p in bot.STOCK.all()}
+
+    updates = interleave(stress_sessions(app, args.users, args.taps, products, rng), rng)
+    await app.initialize()
+    await app.start()
+    try:
+        started = time.perf_counter()
+        for update in updates:
+            await app.update_queue.put(update)
+        await done.wait()
+        elapsed = time.perf_counter() - started
+        await bot.edits.flush()
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await api.close()
+
+    bot.store.engine.flush()
+    mode = f"ordered x{args.concurrency}" if args.ordered else f"unordered x{args.concurrency}"
+    print(f"{mode}, {args.engine}: {len(updates)} updates from {args.users} users in {elapsed:.2f} s ({len(updates) / elapsed:.0f} upd/s)")
+    problems = check_invariants(initial)
+    for p in problems[:20]:
+        print("  FAIL", p)
+    print("  invariants hold" if not problems else f"  {len(problems)} problems")
+    return 1 if problems else 0
+
+def bench_stress(args):
+    bot.init_db()
+    try:
+        return asyncio.run(stress_test(args))
+    finally:
+        bot.store.close()
+        bot.close_db()
+
+
+def timed_init(path: str, repeat: int, before=None) -> float:
+    """Median init_db() time against `path`, with a fresh connection each run like a restart."""
+    times = []
+    for _ in range(repeat):
+        if before:
+            before(path)
+        bot.DB = bot.Database(path)
+        started = time.perf_counter()
+        bot.init_db()
+        times.append(time.perf_counter() - started)
+        bot.close_db()
+    return statistics.median(times)
+
+def bench_startup(args):
+    bot.init_db()
+    fill_category(args.skus)
+    bot.close_db()
+    current = bot.DB_PATH
+
+    def fresh(path):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    def unversioned(path):
+        # what every boot looked like before PRAGMA user_version: no v2 tables yet
+        conn = sqlite3.connect(path)
+        for table in ("order_items", "sales_daily", "sales_days"):
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+        conn.execute("PRAGMA user_version = 0")
+        conn.commit()
+        conn.close()
+
+    print(f"init_db() with {args.skus} extra products, median of {args.repeat}:")
+    rows = (
+        ("new DB", os.path.join(_tmpdir, "fresh.db"), fresh),
+        ("unversioned DB", current, unversioned),
+        ("current schema", current, None),
+    )
+    for name, path, before in rows:
+        print(f"{name:>24}: {timed_init(path, args.repeat, before) * 1000:8.2f} ms")
+
+    env = dict(os.environ, DB_PATH=current)
+    code = "import bot; bot.init_db()"
+    times = []
+    for _ in range(args.processes):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], env=env, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - started)
+    print(f"{'cold process start':>24}: {statistics.median(times) * 1000:8.0f} ms (median of {args.processes})")
+
+
+# =========================
+# Callback routes
+# =========================
+async def tap(app, api: FakeBotAPI, uid: int, data: str, version: Optional[int] = None,
+              message: Optional[dict] = None) -> List[Tuple[str, str]]:
+    """(method, text) of the Bot API calls one button press makes, debounced edits included."""
+    api.log.clear()
+    await app.process_update(callback_update(app, uid, data, version, message))
+    await bot.edits.flush()
+    return [(method, params.get("text", "")) for method, params in api.log]
+
+def route_parsing() -> List[str]:
+    failures: List[str] = []
+
+    def expect(what, got, want):
+        if got != want:
+            failures.append(f"{what}: got {got!r}, want {want!r}")
+
+    def parsed(data):
+        route = bot.parse_callback(data)
+        return route and (route[0], route[2])
+
+    expect("menu", parsed(bot.cb("menu")), ("menu", None))
+    expect("product id", parsed(bot.cb("fl", 7)), ("fl", 7))
+    expect("page", parsed(bot.cb("cat", "3.2")), ("cat", (3, 2)))
+    for data in ("", "menu", "0:menu", "2:menu", "1:nope", "1:fl", "1:fl:", "1:fl:x", "1:fl:-1",
+                 "1:fl:5:6", "1:menu:extra", "1:cat:3", "1:cat:a.b", "1:cat:.1", "1:mpage:1.5"):
+        expect(f"stale/garbage {data!r}", parsed(data), None)
+    for action, (_, parse_arg) in bot.CALLBACK_ROUTES.items():
+        data = bot.cb(action, None if parse_arg is None else ("1.0" if parse_arg is bot.parse_page else 1))
+        expect(f"every route parses: {data}", parsed(data) is not None, True)
+
+    # CB_MAX_BYTES counts bytes, not characters
+    fits = "1" * (bot.CB_MAX_BYTES - len(bot.cb("fl", "")))
+    expect("longest allowed data", len(bot.cb("fl", fits).encode()), bot.CB_MAX_BYTES)
+    for arg in (fits + "1", "ї" * (len(fits) // 2 + 1)):
+        try:
+            bot.cb("fl", arg)
+            failures.append(f"cb() accepted {len(bot.CB_VERSION) + 4 + len(arg.encode())} bytes")
+        except ValueError:
+            pass
+    biggest = 2 ** 63 - 1
+    for kb in (bot.products_kb(biggest, [(biggest, "x", 1)], biggest, True),
+               bot.cart_kb((bot.CartLine(biggest, "x", 1, True),))):
+        for row in kb.inline_keyboard:
+            for button in row:
+                if button.callback_data and len(button.callback_data.encode()) > bot.CB_MAX_BYTES:
+                    failures.append(f"button over {bot.CB_MAX_BYTES} bytes: {button.callback_data}")
+    return failures
+
+async def route_handlers(app, api: FakeBotAPI) -> List[str]:
+    failures: List[str] = []
+
+    def expect(what, calls, method, text):
+        # one visible reply/edit per press, answerCallbackQuery aside
+        sent = [(m, t) for m, t in calls if m != "answerCallbackQuery"]
+        if method is None:
+            if sent:
+                failures.append(f"{what}: expected no message, got {sent!r}")
+        elif not any(m == method and text in t for m, t in sent):
+            failures.append(f"{what}: expected {method} with {text!r}, got {sent!r}")
+
+    with bot.DB.write() as conn:
+        for table in ("cart", "orders", "order_items", "outbox"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("UPDATE stock SET qty = 0, reserved = 0")
+        bot._load_stock(conn)
+    in_stock, sold_out = bot.get_product(1), bot.get_product(2)
+    bot.set_stock(in_stock.id, 2)
+    empty_category = bot.add_category("routes: empty")
+    uid = 40_000
+
+    expect("menu", await tap(app, api, uid, bot.cb("menu")), "editMessageText", "Вибери товар:")
+    expect("menu page", await tap(app, api, uid, bot.cb("mpage", 0)), "editMessageText", "Вибери товар:")
+    expect("category", await tap(app, api, uid, bot.cb("cat", f"{in_stock.category_id}.0")),
+           "editMessageText", f"Смаки {in_stock.category}")
+    expect("empty category", await tap(app, api, uid, bot.cb("cat", f"{empty_category}.0")),
+           "editMessageText", "Наразі немає в наявності")
+    expect("missing category", await tap(app, api, uid, bot.cb("cat", "999999.0")),
+           "editMessageText", "Цієї категорії вже немає")
+    expect("product card", await tap(app, api, uid, bot.cb("fl", in_stock.id)), "editMessageText", in_stock.category)
+    # with a photo the card is a photo message, which has no text to edit
+    bot.PHOTO_URL = "https://example.com/card.jpg"
+    try:
+        expect("photo card", await tap(app, api, uid, bot.cb("fl", in_stock.id)), "sendPhoto", "")
+    finally:
+        bot.PHOTO_URL = ""
+    card = list(api.photos.values())[-1]
+    for what, data, text in (("cart from a photo card", bot.cb("cart"), "🧺 Корзина пуста."),
+                             ("back from a photo card", bot.cb("cat", f"{in_stock.category_id}.0"), "Смаки")):
+        calls = await tap(app, api, uid, data, message=card)
+        expect(what, calls, "sendMessage", text)
+        if ("deleteMessage", "") not in calls:
+            failures.append(f"{what}: the photo card isn't deleted, got {calls!r}")
+        api.photos[(card["chat"]["id"], card["message_id"])] = card
+    expect("sold-out card", await tap(app, api, uid, bot.cb("fl", sold_out.id)),
+           "editMessageText", "Цього смаку вже нема")
+    # names and descriptions are admin free text inside Markdown
+    odd = bot.add_product(empty_category, "snake_case *bold*", "`code` [link")
+    bot.set_stock(odd, 1)
+    expect("card escapes free text", await tap(app, api, uid, bot.cb("fl", odd)),
+           "editMessageText", "snake\\_case \\*bold\\***\n\n\\`code\\` \\[link")
+    bot.set_stock(odd, 0)
+    expect("empty cart", await tap(app, api, uid, bot.cb("cart")), "editMessageText", "🧺 Корзина пуста.")
+    expect("add", await tap(app, api, uid, bot.cb("add", in_stock.id)), "sendMessage", "✅ Додано в корзину")
+    expect("add sold out", await tap(app, api, uid, bot.cb("add", sold_out.id)), "sendMessage", "Цього смаку вже нема")
+    expect("cart", await tap(app, api, uid, bot.cb("cart")), "editMessageText", "🧺")
+    expect("inc", await tap(app, api, uid, bot.cb("inc", in_stock.id)), "editMessageText", "🧺")
+    expect("inc past stock", await tap(app, api, uid, bot.cb("inc", in_stock.id)),
+           "sendMessage", "Більше додати не можна")
+    expect("add past stock", await tap(app, api, uid, bot.cb("add", in_stock.id)),
+           "sendMessage", "Більше додати не можна")
+    expect("dec", await tap(app, api, uid, bot.cb("dec", in_stock.id)), "editMessageText", "🧺")
+    expect("noop", await tap(app, api, uid, bot.cb("noop")), None, "")
+    expect("order", await tap(app, api, uid, bot.cb("order")), "editMessageText", "✅ Замовлення прийнято")
+    with bot.DB.read() as conn:
+        queued = conn.execute("SELECT COUNT(*) FROM outbox WHERE chat_id = ?", (bot.ADMIN_CHAT_ID_INT,)).fetchone()[0]
+    if queued != 1:
+        failures.append(f"order: {queued} admin notifications queued, want 1")
+    expect("order with an empty cart", await tap(app, api, uid, bot.cb("order")), "sendMessage", "❌ Корзина пуста.")
+    await tap(app, api, uid, bot.cb("add", in_stock.id))
+    expect("dec to empty", await tap(app, api, uid, bot.cb("dec", in_stock.id)), "editMessageText", "🧺 Корзина пуста.")
+    await tap(app, api, uid, bot.cb("add", in_stock.id))
+    expect("clear", await tap(app, api, uid, bot.cb("clear")), "editMessageText", "🗑 Корзина очищена.")
+    if bot.STOCK.get(in_stock.id) != 1:
+        failures.append(f"clear: {bot.STOCK.get(in_stock.id)} left in stock, want 1")
+
+    # the "accepted" edit failed, so the ✅ button stays on the same version of the
+    # message; the user refills the cart from another message and taps it again
+    bot.set_stock(in_stock.id, 2)
+    version = 10 ** 9
+    await tap(app, api, uid, bot.cb("add", in_stock.id))
+    await tap(app, api, uid, bot.cb("order"), version)
+    await tap(app, api, uid, bot.cb("add", in_stock.id))
+    bot._recent_taps.clear()  # not a double tap: the user came back later
+    expect("order from a message whose cart changed", await tap(app, api, uid, bot.cb("order"), version),
+           "editMessageText", "✅ Замовлення прийнято")
+    bot._recent_taps.clear()
+    expect("that order retried", await tap(app, api, uid, bot.cb("order"), version),
+           "editMessageText", "✅ Замовлення прийнято")
+    with bot.DB.read() as conn:
+        queued = conn.execute("SELECT COUNT(*) FROM outbox WHERE chat_id = ?", (bot.ADMIN_CHAT_ID_INT,)).fetchone()[0]
+    if (bot.STOCK.get(in_stock.id), queued) != (0, 3):
+        failures.append(f"order from a changed cart: {bot.STOCK.get(in_stock.id)} left in stock and "
+                        f"{queued} admin notifications queued, want 0 and 3")
+
+    for data in ("0:menu", "1:nope", "1:fl:x"):
+        calls = await tap(app, api, uid, data)
+        expect(f"stale {data!r}", calls, "sendMessage", "Вибери товар:")
+        if ("answerCallbackQuery", "") in calls or not any(m == "answerCallbackQuery" for m, _ in calls):
+            failures.append(f"stale {data!r}: the spinner isn't answered with the 'button expired' hint")
+
+    update = callback_update(app, uid, bot.cb("menu"))
+    await app.process_update(update)
+    api.log.clear()
+    await app.process_update(update)  # Telegram delivers it again
+    expect("redelivered", [(m, p.get("text", "")) for m, p in api.log], None, "")
+    return failures
+
+async def routes_test(args):
+    api = FakeBotAPI(0, 0.0, 1)
+    await api.start()
+    app = (
+        ApplicationBuilder()
+        .application_class(bot.TracedApplication)
+        .token(os.environ["BOT_TOKEN"])
+        .base_url(f"http://127.0.0.1:{api.port}/bot")
+        .updater(None)
+        .job_queue(None)
+        .build()
+    )
+    bot.add_handlers(app)
+    await app.initialize()
+    try:
+        return await route_handlers(app, api)
+    finally:
+        await app.shutdown()
+        await api.close()
+
+def bench_routes(args):
+    bot.init_db()
+    try:
+        failures = route_parsing() + asyncio.run(routes_test(args))
+    finally:
+        bot.store.close()
+        bot.close_db()
+    for f in failures:
+        print("  FAIL", f)
+    print(f"{len(bot.CALLBACK_ROUTES)} routes: {'ok' if not failures else f'{len(failures)} failed'}")
+    return 1 if failures else 0
+
+
+# =========================
+# Storage engines
+# =========================
+def fresh_engine(name: str, path: str) -> "bot.StorageEngine":
+    """A new DB at `path` with the seeded catalog and a loaded `name` engine."""
+    bot.close_db()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    for _, journal in bot.Journal(path + ".journal").files():
+        os.remove(journal)
+    bot.DB = bot.Database(path)
+    bot.STOCK.watch_db = True
+    bot.init_db()
+    engine = bot.make_engine(name)
+    engine.load()
+    return engine
+
+def restart(engine: "bot.StorageEngine", crash: bool) -> "bot.StorageEngine":
+    """
+    Stop `engine` and load a new one. With `crash` it's kill -9: no snapshot,
+    and what the journal writer hasn't written yet (see crash_point) is lost.
+    """
+    if crash and isinstance(engine, bot.MemoryEngine):
+        crash_point(engine)
+    else:
+        engine.close()
+    path = bot.DB.path
+    bot.close_db()
+    bot.STOCK.replace({}, 0)
+    bot.DB = bot.Database(path)
+    bot.init_db()
+    engine = bot.make_engine(engine.name)
+    engine.load()
+    return engine
+
+def crash_point(engine: "bot.MemoryEngine"):
+    """
+    The journal writer falls behind here: it has written everything so far,
+    later changes stay on its queue and are lost in a restart(crash=True).
+    """
+    engine._stop.set()
+    engine._snapshotter.join()
+    engine._journal.stop()
+
+def conformance(name: str, path: str) -> List[str]:
+    """The same storage semantics checked against one engine; returns what failed."""
+    failures: List[str] = []
+
+    def expect(what, got, want):
+        if got != want:
+            failures.append(f"{what}: got {got!r}, want {want!r}")
+
+    def lines(cart):
+        return [(line.product_id, line.qty) for line in cart]
+
+    def pages_match(what):
+        # every page of the category, against what's visible and available in catalog order
+        category_id = bot.get_product(a).category_id
+        listed, page, more = [], 0, True
+        while more:
+            _, items, more = engine.products_page(category_id, page)
+            listed += items
+            page += 1
+        want = [(p.id, p.name, bot.STOCK.get(p.id)) for p in bot.SEARCH.visible_products()
+                if p.category_id == category_id and bot.STOCK.get(p.id) > 0]
+        expect(f"catalog pages {what}", listed, want)
+
+    engine = fresh_engine(name, path)
+    a, b, c = 1, 2, 3
+    label = {p: bot.get_product(p).label for p in (a, b, c)}
+    u1, u2, u3 = 101, 102, 103
+
+    # stock
+    engine.set_stock(a, 5)
+    engine.set_stock(b, 2)
+    engine.set_stock(c, 4)
+    expect("set_stock", bot.STOCK.get(a), 5)
+    expect("add_stock", engine.add_stock(a, 3), 8)
+    expect("add_stock stops at 0", engine.add_stock(b, -10), 0)
+    expect("add_stock unknown product", engine.add_stock(10 ** 6, 1), 0)
+    engine.import_stock([(b, 4)], False)
+    engine.import_stock([(b, 1)], True)
+    expect("import_stock", bot.STOCK.get(b), 5)
+    engine.import_stock([(p, 3) for p in range(4, 20)], False)
+    pages_match("after stock changes")
+
+    # carts and reservations
+    change, cart = engine.cart_adjust(u1, a, 3)
+    expect("reserve", (change, lines(cart), bot.STOCK.get(a)), (3, [(a, 3)], 5))
+    expect("increment capped by what's left", (engine.cart_adjust(u2, a, 10)[0], bot.STOCK.get(a)), (5, 0))
+    expect("sold out", engine.cart_adjust(u1, a, 1)[0], 0)
+    pages_match("with a product reserved away")
+    engine.cart_adjust(u1, b, 1)
+    expect("lines keep their order", lines(engine.cart_get(u1)), [(a, 3), (b, 1)])
+    expect("decrement", engine.cart_adjust(u2, a, -2)[0], -2)
+    expect("decrement stops at 0", (engine.cart_adjust(u2, a, -10)[0], lines(engine.cart_get(u2))), (-3, []))
+    expect("decrement releases", bot.STOCK.get(a), 5)
+    engine.cart_clear(u1)
+    expect("clear releases", (engine.cart_get(u1), bot.STOCK.get(a), bot.STOCK.get(b)), ((), 8, 5))
+
+    ttl = bot.RESERVATION_TTL_S
+    bot.RESERVATION_TTL_S = -1  # already expired
+    try:
+        engine.cart_adjust(u1, a, 2)
+    finally:
+        bot.RESERVATION_TTL_S = ttl
+    engine.cart_adjust(u2, b, 1)
+    expect("expiry releases old carts only",
+           (engine.release_expired(100), engine.cart_get(u1), bot.STOCK.get(a), lines(engine.cart_get(u2))),
+           (1, (), 8, [(b, 1)]))
+
+    # checkout
+    [empty] = engine.checkout_batch([(u1, "empty")])
+    expect("empty cart", (empty.ok, empty.message, empty.items), (False, "Корзина пуста.", []))
+    engine.cart_adjust(u1, a, 2)
+    engine.set_stock(b, 0)  # u2 still holds one
+    first, again, short = engine.checkout_batch([(u1, "k1"), (u1, "k1"), (u2, "k2")])
+    expect("checkout", (first.ok, first.items, first.replayed), (True, [(label[a], 2)], False))
+    expect("same key returns the same order", (again.ok, again.order_id, again.items, again.replayed),
+           (True, first.order_id, first.items, True))
+    expect("not enough stock", (short.ok, short.message, short.items),
+           (False, f"Немає в наявності достатньо: {label[b]} (потрібно 1, є 0).", [(label[b], 1)]))
+    expect("checkout deducts and clears", (bot.STOCK.get(a), engine.cart_get(u1)), (6, ()))
+    engine.cart_adjust(u1, a, 1)
+    changed, replayed = engine.checkout_batch([(u1, "k1"), (u1, "k1")])
+    expect("same key with a changed cart checks out again", (changed.ok, changed.items, changed.replayed),
+           (True, [(label[a], 1)], False))
+    expect("then returns the new order", (replayed.order_id, replayed.replayed), (changed.order_id, True))
+    engine.cart_clear(u2)
+
+    engine.cart_adjust(u3, c, 1)
+    bot.set_product_active(c, False)
+    expect("hidden products can't be added", engine.cart_adjust(u3, c, 1)[0], 0)
+    pages_match("with a hidden product")
+    def notice(items):
+        return 7, f"order {items}", None
+
+    [hidden] = engine.checkout_batch([(u3, "k3", notice)])
+    expect("hidden products count as sold out", (hidden.ok, hidden.items), (False, [(label[c], 1)]))
+    bot.set_product_active(c, True)
+    expect("cart survives hiding", lines(engine.cart_get(u3)), [(c, 1)])
+    pages_match("after showing it again")
+    [second] = engine.checkout_batch([(u3, "k3", notice)])
+    expect("order ids increase", second.ok and second.order_id > changed.order_id > first.order_id, True)
+
+    # the SQLite tables after a flush (admin listings and reports read those)
+    engine.set_stock(b, 3)
+    engine.cart_adjust(u1, b, 2)
+    engine.flush()
+    with bot.DB.read() as conn:
+        stock = {r["product_id"]: (r["qty"], r["reserved"]) for r in conn.execute("SELECT * FROM stock WHERE product_id <= 3")}
+        cart = [tuple(r) for r in conn.execute("SELECT user_id, product_id, qty FROM cart ORDER BY rowid")]
+    expect("stock table", stock, {a: (5, 0), b: (3, 2), c: (3, 0)})
+    expect("cart table", cart, [(u1, b, 2)])
+    report = bot.sales_report(1)
+    expect("sales report", (report.orders, report.units), (3, 4))
+
+    def notices():
+        engine.flush()
+        with bot.DB.read() as conn:
+            return [tuple(r) for r in conn.execute("SELECT chat_id, text, parse_mode FROM outbox")]
+    queued = [(7, f"order {[(label[c], 1)]}", None)]
+    expect("an order's notice is queued with it", notices(), queued)
+
+    # restart, with and without a clean shutdown
+    for crash in (False, True):
+        engine.cart_adjust(u2, a, 1)
+        engine.add_stock(c, 5)
+        before = (dict(bot.STOCK.all()), lines(engine.cart_get(u1)), lines(engine.cart_get(u2)))
+        if crash and isinstance(engine, bot.MemoryEngine):
+            # the documented loss: only changes the writer hadn't written yet
+            crash_point(engine)
+            engine.cart_adjust(u1, a, 1)
+            engine.set_stock(b, 9)
+        engine = restart(engine, crash)
+        after = (dict(bot.STOCK.all()), lines(engine.cart_get(u1)), lines(engine.cart_get(u2)))
+        what = "state after a crash" if crash else "state after a restart"
+        expect(what, after, before)
+        engine.flush()
+        with bot.DB.read() as conn:
+            held = [tuple(r) for r in conn.execute("""
+                SELECT s.product_id, s.reserved, COALESCE(SUM(c.qty), 0) FROM stock s
+                LEFT JOIN cart c ON c.product_id = s.product_id
+                GROUP BY s.product_id HAVING s.reserved != COALESCE(SUM(c.qty), 0)
+            """)]
+        expect(f"{what}: reservations match carts", held, [])
+        [again] = engine.checkout_batch([(u3, "k3")])
+        expect(f"{what}: idempotency key", (again.replayed, again.order_id), (True, second.order_id))
+        expect(f"{what}: notices", notices(), queued)
+    engine.close()
+    bot.close_db()
+    return failures
+
+def bench_conformance(args):
+    failed = 0
+    for name in args.engines:
+        failures = conformance(name, os.path.join(_tmpdir, f"conformance-{name}.db"))
+        for f in failures:
+            print(f"  FAIL [{name}] {f}")
+        print(f"{name:>8}: {'ok' if not failures else f'{len(failures)} failed'}")
+        failed += len(failures)
+    return 1 if failed else 0
+
+async def tap_session(store: "bot.Store", uid: int, taps: int, products: List[int], rng: random.Random,
+                      latencies: List[float], checkouts: List[float]):
+    for _ in range(taps):
+        delta = 1 if rng.random() < 0.7 else -1
+        started = time.perf_counter()
+        await store.cart_adjust(uid, rng.choice(products), delta)
+        latencies.append(time.perf_counter() - started)
+    started = time.perf_counter()
+    await store.checkout(uid, f"tap-{uid}")
+    checkouts.append(time.perf_counter() - started)
+
+def bench_taps(args):
+    print(f"{args.users} users x {args.taps} ➕/➖ taps, then checkout")
+    print(f"{'engine':>8} {'taps/s':>8} {'p50 us':>8} {'p95 us':>8} {'p99 us':>8} {'checkout p50 us':>16}")
+    for name in args.engines:
+        engine = fresh_engine(name, os.path.join(_tmpdir, f"taps-{name}.db"))
+        products = list(range(1, args.products + 1))
+        for p in products:
+            engine.set_stock(p, args.users * args.taps)
+        store = bot.Store(engine)
+        latencies: List[float] = []
+        checkouts: List[float] = []
+        rng = random.Random(args.seed)
+
+        async def run():
+            await asyncio.gather(*[tap_session(store, 30_000 + i, args.taps, products, rng, latencies, checkouts)
+                                   for i in range(args.users)])
+
+        started = time.perf_counter()
+        asyncio.run(run())
+        elapsed = time.perf_counter() - started
+        store.close()
+        bot.close_db()
+        print(f"{name:>8} {len(latencies) / elapsed:>8.0f} " +
+              " ".join(f"{percentile(latencies, p) * 1e6:>8.0f}" for p in (.5, .95, .99)) +
+              f" {percentile(checkouts, .5) * 1e6:>16.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("checkout", help="flash-sale checkout throughput, before/after group commit")
+    p.add_argument("--buyers", type=int, default=500)
+    p.add_argument("--lines", type=int, default=3, help="cart lines per buyer")
+    p.set_defaults(func=bench_checkout)
+
+    p = sub.add_parser("catalog", help="category page cost vs. catalog size")
+    p.add_argument("--skus", type=int, nargs="+", default=[100, 1000, 10000], help="products per category")
+    p.add_argument("--repeat", type=int, default=200)
+    p.set_defaults(func=bench_catalog)
+
+    p = sub.add_parser("load", help="drive the Application against a fake Bot API")
+    p.add_argument("--users", type=int, default=100, help="concurrent shoppers")
+    p.add_argument("--taps", type=int, default=5, help="rapid ➕ taps per user in the cart scenario")
+    p.add_argument("--latency-ms", type=float, default=20, help="Bot API latency to simulate")
+    p.add_argument("--flood-rate", type=float, default=0.0, help="share of requests answered with 429")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--no-rate-limit", action="store_true", help="bypass FloodLimiter to see the bot's own overhead")
+    p.add_argument("--scenarios", nargs="+", default=["browse", "cart", "flash"], choices=["browse", "cart", "flash"])
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("stress", help="interleaved taps through concurrent processing, then consistency checks")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--taps", type=int, default=20, help="add/inc/dec taps per user before ordering")
+    p.add_argument("--products", type=int, default=3, help="how many products users fight over")
+    p.add_argument("--concurrency", type=int, default=bot.CONCURRENT_UPDATES)
+    p.add_argument("--latency-ms", type=float, default=2)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--unordered", dest="ordered", action="store_false",
+                   help="plain concurrent_updates without per-user ordering, to see what breaks")
+    p.add_argument("--engine", default="sqlite", choices=list(bot.STORAGE_ENGINES))
+    p.set_defaults(func=bench_stress)
+
+    p = sub.add_parser("search", help="inline search index build and lookup cost vs. catalog size")
+    p.add_argument("--skus", type=int, nargs="+", default=[100, 1000, 10000], help="products per category")
+    p.add_argument("--repeat", type=int, default=200)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("startup", help="init_db() and cold start time")
+    p.add_argument("--skus", type=int, default=1000, help="products to add to the catalog first")
+    p.add_argument("--repeat", type=int, default=20)
+    p.add_argument("--processes", type=int, default=5, help="cold starts of a new interpreter to time")
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser("routes", help="every callback route against a fake Bot API")
+    p.set_defaults(func=bench_routes)
+
+    p = sub.add_parser("conformance", help="the same storage checks against every engine")
+    p.add_argument("--engines", nargs="+", default=list(bot.STORAGE_ENGINES), choices=list(bot.STORAGE_ENGINES))
+    p.set_defaults(func=bench_conformance)
+
+    p = sub.add_parser("taps", help="per-tap cart latency of each storage engine")
+    p.add_argument("--engines", nargs="+", default=list(bot.STORAGE_ENGINES), choices=list(bot.STORAGE_ENGINES))
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--taps", type=int, default=20)
+    p.add_argument("--products", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_taps)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,22 +1,58 @@
+import asyncio
+import bisect
+import contextvars
+import cProfile
+import csv
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import logging
 import os
+import pstats
+import queue
+import re
+import signal
 import sqlite3
 import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from typing import Dict, List, Tuple
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta
+from functools import lru_cache
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
     InputFile,
+    InputTextMessageContent,
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CallbackQueryHandler,
     CommandHandler,
     ContextTypes,
+    InlineQueryHandler,
+    MessageHandler,
+    filters,
 )
 
+log = logging.getLogger("bot")
+
 # =========================
 # ENV
 # =========================
@@ -34,6 +70,9 @@ ADMIN_CHAT_ID_INT = int(ADMIN_CHAT_ID)
 # =========================
 # CONFIG
 # =========================
+# Starting catalog: on a fresh DB these become the first category, with
+# product ids in list order. After that the catalog lives in the DB and is
+# managed with /addcategory, /addproduct, /hideproduct.
 BRAND = "Chaser"
 VOLUME = "30 мл"
 
@@ -63,546 +102,4009 @@ FLAVORS = [
 ]
 
 # Simple description template (you can rewrite later)
-def flavor_description(flavor: str) -> str:
-    return f"**{BRAND} {VOLUME}**\nСмак: **{flavor}**\n\nНатисни «➕ В корзину», щоб додати."
+def product_description(category: str, name: str, description: Optional[str] = None,
+                        hint: str = "Натисни «➕ В корзину», щоб додати.") -> str:
+    # Markdown; names and descriptions are free text from /addproduct, so they're escaped
+    extra = f"{escape_markdown(description)}\n\n" if description else ""
+    return f"**{escape_markdown(category)}**\nСмак: **{escape_markdown(name)}**\n\n{extra}{hint}"
 
 # Optional product photo path (put file in repo)
 PHOTO_PATH = "assets/chaser.png"  # you can rename to .jpg too
+PHOTO_URL = os.environ.get("PHOTO_URL", "").strip()  # if set, used instead of any file
 
 
 # =========================
-# DB (SQLite)
+# Metrics (Prometheus text format, served on /metrics)
 # =========================
-DB_PATH = os.environ.get("DB_PATH", "data.db")  # you can set to /var/data/data.db if you attach Render Disk
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
 
-def db() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
 
-def init_db():
-    conn = db()
-    cur = conn.cursor()
+class Metric:
+    kind = ""
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS stock (
-        flavor TEXT PRIMARY KEY,
-        qty INTEGER NOT NULL DEFAULT 0
-    )
-    """)
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
 
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS cart (
-        user_id INTEGER NOT NULL,
-        flavor TEXT NOT NULL,
-        qty INTEGER NOT NULL,
-        PRIMARY KEY (user_id, flavor)
-    )
-    """)
+    def _label_str(self, values: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{k}="{str(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
 
-    # Ensure all flavors exist in stock table
-    for f in FLAVORS:
-        cur.execute("INSERT OR IGNORE INTO stock(flavor, qty) VALUES(?, 0)", (f,))
-    conn.commit()
-    conn.close()
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
 
-def normalize_flavor(text: str) -> str:
-    # Accept underscores as spaces, trim, uppercase Ukrainian/RU kept as is
-    t = (text or "").strip()
-    t = t.replace("_", " ")
-    t = " ".join(t.split())
-    return t
+    def _render_value(self, key: Tuple[str, ...], value: Any) -> List[str]:
+        return [f"{self.name}{self._label_str(key)} {value}"]
 
-def get_stock_all() -> Dict[str, int]:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT flavor, qty FROM stock")
-    rows = cur.fetchall()
-    conn.close()
-    return {r["flavor"]: int(r["qty"]) for r in rows}
-
-def get_stock(flavor: str) -> int:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT qty FROM stock WHERE flavor = ?", (flavor,))
-    row = cur.fetchone()
-    conn.close()
-    return int(row["qty"]) if row else 0
-
-def set_stock(flavor: str, qty: int):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO stock(flavor, qty) VALUES(?, ?) ON CONFLICT(flavor) DO UPDATE SET qty=excluded.qty", (flavor, qty))
-    conn.commit()
-    conn.close()
-
-def add_stock(flavor: str, qty: int):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("UPDATE stock SET qty = MAX(qty + ?, 0) WHERE flavor = ?", (qty, flavor))
-    conn.commit()
-    conn.close()
-
-def cart_get(user_id: int) -> Dict[str, int]:
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT flavor, qty FROM cart WHERE user_id = ?", (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return {r["flavor"]: int(r["qty"]) for r in rows}
-
-def cart_set(user_id: int, flavor: str, qty: int):
-    conn = db()
-    cur = conn.cursor()
-    if qty <= 0:
-        cur.execute("DELETE FROM cart WHERE user_id=? AND flavor=?", (user_id, flavor))
-    else:
-        cur.execute("""
-            INSERT INTO cart(user_id, flavor, qty)
-            VALUES(?, ?, ?)
-            ON CONFLICT(user_id, flavor) DO UPDATE SET qty=excluded.qty
-        """, (user_id, flavor, qty))
-    conn.commit()
-    conn.close()
-
-def cart_add(user_id: int, flavor: str, delta: int):
-    current = cart_get(user_id).get(flavor, 0)
-    cart_set(user_id, flavor, current + delta)
 
-def cart_clear(user_id: int):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM cart WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+class Counter(Metric):
+    kind = "counter"
 
-def checkout(user_id: int) -> Tuple[bool, str, List[Tuple[str,int]]]:
-    """
-    Atomically:
-    - verify stock is enough
-    - decrement stock
-    - clear cart
-    """
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT flavor, qty FROM cart WHERE user_id = ?", (user_id,))
-    items = [(r["flavor"], int(r["qty"])) for r in cur.fetchall()]
-    if not items:
-        conn.close()
-        return False, "Корзина пуста.", []
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
 
-    try:
-        conn.execute("BEGIN IMMEDIATE")
-
-        # check stock
-        for flavor, q in items:
-            cur.execute("SELECT qty FROM stock WHERE flavor=?", (flavor,))
-            row = cur.fetchone()
-            available = int(row["qty"]) if row else 0
-            if q > available:
-                conn.rollback()
-                conn.close()
-                return False, f"Немає в наявності достатньо: {flavor} (потрібно {q}, є {available}).", items
 
-        # deduct
-        for flavor, q in items:
-            cur.execute("UPDATE stock SET qty = qty - ? WHERE flavor=?", (q, flavor))
+class Gauge(Metric):
+    kind = "gauge"
 
-        # clear cart
-        cur.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
-        return True, "OK", items
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        return False, f"Помилка оформлення: {e}", items
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels: str):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(labels)
+            if h is None:
+                # per-bucket counts (last one is +Inf), sum
+                h = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += value
+
+    def _render_value(self, key: Tuple[str, ...], value: Any) -> List[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+            lines.append(f"{self.name}_bucket{self._label_str(key, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_str(key)} {total}")
+        lines.append(f"{self.name}_count{self._label_str(key)} {cumulative}")
+        return lines
+
+
+METRICS: List[Metric] = []
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Update handling time", ("kind", "route"))
+DB_CALL_SECONDS = Histogram("bot_db_call_seconds", "DB helper run time", ("op",))
+DB_WAIT_SECONDS = Histogram("bot_db_queue_wait_seconds", "Time a DB call waited for a DB thread", ("op",))
+TG_API_SECONDS = Histogram("bot_telegram_api_seconds", "Bot API request time (excluding rate limit waits)", ("endpoint",))
+TG_API_ERRORS = Counter("bot_telegram_api_errors_total", "Failed Bot API requests", ("endpoint", "error"))
+CHECKOUTS = Counter("bot_checkouts_total", "Checkout attempts by outcome", ("outcome",))
+MESSAGE_EDITS = Counter("bot_message_edits_total", "Debounced message edits by outcome", ("outcome",))
+RESERVATIONS_EXPIRED = Counter("bot_reservations_expired_total", "Cart lines released by the expiry sweeper")
+DUPLICATE_CALLBACKS = Counter("bot_duplicate_callbacks_total", "Callback queries dropped as duplicates", ("reason",))
+OUTBOX_UNDELIVERABLE = Counter("bot_outbox_undeliverable_total", "Queued messages Telegram rejected for good")
+BACKLOG_SKIPPED = Counter("bot_backlog_skipped_total", "Updates not handled after a restart", ("reason",))
+EVENT_LOOP_LAG = Gauge("bot_event_loop_lag_seconds", "How late the event loop woke up a 0.5 s timer")
+
+async def monitor_event_loop(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(0.0, loop.time() - started - interval))
 
 
 # =========================
-# UI builders
+# Slow updates
 # =========================
-def main_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton(f"{BRAND} {VOLUME}", callback_data="cat:30")],
-        [InlineKeyboardButton("🧺 Корзина", callback_data="cart:view")],
-    ])
+# Every update runs with an UpdateTrace in a context variable; Store and
+# FloodLimiter add their time to it. Updates slower than SLOW_UPDATE_S land
+# in a small ring buffer that /slow shows, so "the bot was sluggish at 14:02"
+# can be answered with the route and where the time went.
+SLOW_UPDATE_S = float(os.environ.get("SLOW_UPDATE_S", "1.0"))
+SLOW_UPDATES_KEEP = int(os.environ.get("SLOW_UPDATES_KEEP", "50"))
 
-def back_to_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data="menu")]])
-
-def flavors_kb() -> InlineKeyboardMarkup:
-    st = get_stock_all()
-    buttons = []
-    for f in FLAVORS:
-        qty = st.get(f, 0)
-        if qty > 0:
-            buttons.append([InlineKeyboardButton(f"{f} ({qty} шт.)", callback_data=f"flavor:{f}")])
-    buttons.append([InlineKeyboardButton("⬅️ Меню", callback_data="menu")])
-    buttons.append([InlineKeyboardButton("🧺 Корзина", callback_data="cart:view")])
-    return InlineKeyboardMarkup(buttons)
 
-def flavor_actions_kb(flavor: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("➕ В корзину", callback_data=f"cart:add:{flavor}")],
-        [InlineKeyboardButton("🧺 Корзина", callback_data="cart:view")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="cat:30")],
-    ])
+class UpdateTrace:
+    __slots__ = ("db", "db_calls", "tg", "tg_calls", "tg_wait")
+
+    def __init__(self):
+        self.db = self.tg = self.tg_wait = 0.0
+        self.db_calls = self.tg_calls = 0
+
+
+class SlowUpdate(NamedTuple):
+    at: float  # wall clock, when the update finished
+    route: str
+    user_id: Optional[int]
+    total: float
+    db: float  # DB thread queue wait + run time
+    db_calls: int
+    tg: float  # Bot API request time
+    tg_calls: int
+    tg_wait: float  # time held back by the rate limiter
+
+
+_current_trace: "contextvars.ContextVar[Optional[UpdateTrace]]" = contextvars.ContextVar("update_trace", default=None)
+
+def update_route(update: object) -> str:
+    """Short description of what an update asks for, e.g. "callback:order" or "command:stock"."""
+    if not isinstance(update, Update):
+        return type(update).__name__
+    if update.callback_query:
+        parts = (update.callback_query.data or "").split(":", 2)
+        return "callback:" + (parts[1][:16] if len(parts) > 1 else "?")
+    if update.inline_query:
+        return "inline"
+    msg = update.effective_message
+    if msg and msg.text and msg.text.startswith("/"):
+        return "command:" + msg.text.split()[0][1:].split("@")[0][:16]
+    return "message"
+
+
+class UpdateTracer:
+    def __init__(self, threshold: float = SLOW_UPDATE_S, keep: int = SLOW_UPDATES_KEEP):
+        self.threshold = threshold
+        self.slow: Deque[SlowUpdate] = deque(maxlen=keep)
+        self.updates = 0  # processed so far
+
+    async def run(self, update: object, coroutine: Awaitable[Any]):
+        trace = UpdateTrace()
+        token = _current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            _current_trace.reset(token)
+            self.updates += 1
+            total = time.perf_counter() - started
+            if total >= self.threshold:
+                user = update.effective_user if isinstance(update, Update) else None
+                self.slow.append(SlowUpdate(
+                    time.time(), update_route(update), user.id if user else None, total,
+                    trace.db, trace.db_calls, trace.tg, trace.tg_calls, trace.tg_wait,
+                ))
+
+    @staticmethod
+    def add_db(seconds: float):
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.db += seconds
+            trace.db_calls += 1
+
+    @staticmethod
+    def add_tg(seconds: float, wait: float):
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.tg += seconds
+            trace.tg_calls += 1
+            trace.tg_wait += wait
 
-def cart_kb(cart: Dict[str, int]) -> InlineKeyboardMarkup:
-    rows = []
-    for flavor, qty in cart.items():
-        rows.append([
-            InlineKeyboardButton("➖", callback_data=f"cart:dec:{flavor}"),
-            InlineKeyboardButton(f"{flavor} × {qty}", callback_data=f"noop"),
-            InlineKeyboardButton("➕", callback_data=f"cart:inc:{flavor}"),
-        ])
-    if cart:
-        rows.append([InlineKeyboardButton("✅ Замовити", callback_data="order:confirm")])
-        rows.append([InlineKeyboardButton("🗑 Очистити", callback_data="cart:clear")])
-    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="cat:30")])
-    rows.append([InlineKeyboardButton("⬅️ Меню", callback_data="menu")])
-    return InlineKeyboardMarkup(rows)
+
+TRACER = UpdateTracer()
+
+
+class TracedApplication(Application):
+    """Application that runs every update under TRACER."""
+
+    async def process_update(self, update: object) -> None:
+        if isinstance(update, Update):
+            if HANDLED.redelivered(update.update_id):
+                BACKLOG_SKIPPED.inc("handled")
+                log.warning("skipping update %s: handled before the restart", update.update_id)
+                return
+            HANDLED.seen(update.update_id)
+        await TRACER.run(update, super().process_update(update))
 
 
 # =========================
-# Helpers
+# DB (SQLite)
 # =========================
-async def safe_answer(query, text=""):
-    try:
-        await query.answer(text=text)
-    except Exception:
-        pass
+DB_PATH = os.environ.get("DB_PATH", "data.db")  # you can set to /var/data/data.db if you attach Render Disk
+DB_READERS = int(os.environ.get("DB_READERS", "4"))  # max concurrent reader connections
+DB_STATEMENT_CACHE = 256  # prepared statements kept per connection
+DB_BUSY_TIMEOUT_MS = 5000
+RESERVATION_TTL_S = float(os.environ.get("RESERVATION_TTL_S", "1800"))  # cart holds stock this long after the last change
+SHOP_TZ = os.environ.get("SHOP_TZ", "Europe/Kyiv")  # where a sales day starts and ends
 
-def user_profile_text(u) -> str:
-    # tg deep link works even without username
-    link = f"tg://user?id={u.id}"
-    name = " ".join([x for x in [u.first_name, u.last_name] if x]) or "Без імені"
-    username = f"@{u.username}" if u.username else "немає username"
-    return f"👤 Клієнт: {name}\n🔗 Профіль: {link}\n🆔 ID: {u.id}\n👤 Username: {username}"
 
-def order_text(items: List[Tuple[str,int]]) -> str:
-    lines = ["🧾 **Нове замовлення**", f"Товар: **{BRAND} {VOLUME}**", ""]
-    for f, q in items:
-        lines.append(f"• {f} × {q}")
-    return "\n".join(lines)
+class Database:
+    """
+    Long-lived SQLite connections shared by all helpers:
+    - one writer connection, serialized by a lock
+    - a small pool of reusable read-only connections
+    """
 
-async def send_product_photo_if_exists(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if os.path.exists(PHOTO_PATH):
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self._writer: Optional[sqlite3.Connection] = None
+        self._write_lock = threading.Lock()
+        self._idle_readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(max(1, readers))
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._after_commit: List[Callable[[], None]] = []
+
+    def _connect(self, readonly: bool) -> sqlite3.Connection:
+        # isolation_level=None: no implicit BEGIN, transactions are explicit in write()
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        if not readonly:
+            # WAL: readers don't block the writer and vice versa
+            conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL: no fsync per commit in WAL mode, still crash-safe
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    def _get_writer(self) -> sqlite3.Connection:
+        if self._writer is None:
+            self._writer = self._connect(readonly=False)
+        return self._writer
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        self._reader_slots.acquire()
         try:
-            with open(PHOTO_PATH, "rb") as f:
-                await update.effective_chat.send_photo(photo=InputFile(f))
-        except Exception:
-            pass
+            try:
+                conn = self._idle_readers.get_nowait()
+            except queue.Empty:
+                conn = self._connect(readonly=True)
+            try:
+                yield conn
+            finally:
+                self._idle_readers.put(conn)
+        finally:
+            self._reader_slots.release()
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE takes the write lock up front, so a transaction never
+        # fails half-way with SQLITE_BUSY when upgrading from a read
+        with self._write_lock:
+            conn = self._get_writer()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                self._after_commit.clear()
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            callbacks, self._after_commit = self._after_commit, []
+            for fn in callbacks:
+                fn()
+
+    def on_commit(self, fn: Callable[[], None]):
+        # only valid inside write(): runs after COMMIT, still under the write lock,
+        # so in-memory mirrors are updated in the same order as the DB
+        self._after_commit.append(fn)
+
+    def data_version(self) -> int:
+        # Changes only when *another* connection (e.g. another process) commits;
+        # our own writes all go through the writer and don't bump it.
+        with self._write_lock:
+            return int(self._get_writer().execute("PRAGMA data_version").fetchone()[0])
+
+    def schema_version(self) -> int:
+        # PRAGMA user_version: which of MIGRATIONS the file has had applied
+        with self._write_lock:
+            return int(self._get_writer().execute("PRAGMA user_version").fetchone()[0])
+
+    def close(self):
+        with self._write_lock:
+            if self._writer is not None:
+                try:
+                    self._writer.execute("PRAGMA optimize")
+                    self._writer.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e:
+                    # closing anyway; the WAL is checkpointed on the next open
+                    log.warning("db close: %s", e)
+            with self._conns_lock:
+                conns, self._conns = self._conns, []
+            for conn in conns:
+                conn.close()
+            self._writer = None
+            self._idle_readers = queue.LifoQueue()
+
+
+DB = Database(DB_PATH)
 
 
 # =========================
-# Commands
+# Stock cache
 # =========================
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await send_product_photo_if_exists(update, context)
-    await update.message.reply_text(
-        f"Привіт! 👋\nВибери товар:",
-        reply_markup=main_menu_kb()
-    )
+STOCK_RECHECK_S = float(os.environ.get("STOCK_RECHECK_S", "2"))  # how often to look for external DB edits
 
-def is_admin(update: Update) -> bool:
-    return update.effective_user and update.effective_user.id == ADMIN_CHAT_ID_INT
 
-async def cmd_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update):
-        await update.message.reply_text("⛔️ Команда тільки для адміна.")
-        return
+class StockCache:
+    """
+    Process-wide copy of available stock (product id -> on hand minus
+    reserved in carts). The write helpers update it on commit; `version` grows on every stock or catalog
+    change so renderers can key on it.
+    """
 
-    st = get_stock_all()
-    lines = [f"📦 Склад: **{BRAND} {VOLUME}**", ""]
-    for f in FLAVORS:
-        lines.append(f"• {f}: {st.get(f, 0)}")
-    lines.append("")
-    lines.append("Команди:")
-    lines.append("/setstock <смак> <кількість>")
-    lines.append("/addstock <смак> <кількість>")
-    lines.append("Приклад: /setstock ВИШНЯ_МЕНТОЛ 20")
-    await update.message.reply_text("\n".join(lines))
+    def __init__(self):
+        self._qty: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._data_version: Optional[int] = None
+        self._checked_at = 0.0
+        self.version = 0
+        self.watch_db = True  # off when the storage engine, not the stock table, is authoritative
 
-async def cmd_setstock(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update):
-        await update.message.reply_text("⛔️ Команда тільки для адміна.")
-        return
+    def replace(self, qty: Dict[int, int], data_version: int):
+        with self._lock:
+            self._qty = dict(qty)
+            self._data_version = data_version
+            self._checked_at = time.monotonic()
+            self.version += 1
 
-    # Accept formats:
-    # /setstock ВИШНЯ_МЕНТОЛ 20
-    # /setstock ВИШНЯ МЕНТОЛ 20
-    parts = update.message.text.split(maxsplit=2)
-    if len(parts) < 3:
-        await update.message.reply_text("Формат: /setstock <смак> <кількість>\nПриклад: /setstock ВИШНЯ_МЕНТОЛ 20")
-        return
+    def update(self, changes: Dict[int, int]):
+        if not changes:
+            return
+        with self._lock:
+            # copy-on-write: snapshots handed out by all() never change under the reader
+            qty = dict(self._qty)
+            qty.update(changes)
+            self._qty = qty
+            self.version += 1
 
-    # parts[1..] contains flavor and qty, but flavor may have spaces if user did maxsplit=2 => good
-    tail = parts[2].strip()
-    # Here parts = ["/setstock", flavor_or_part, rest]
-    # We want last token of rest as qty if rest has spaces.
-    # Better parse: remove "/setstock " then split last as qty
-    raw = update.message.text[len("/setstock"):].strip()
-    if not raw:
-        await update.message.reply_text("Формат: /setstock <смак> <кількість>")
-        return
+    def touch(self):
+        # catalog changed: invalidate everything rendered for the current version
+        with self._lock:
+            self.version += 1
 
-    toks = raw.split()
-    if len(toks) < 2:
-        await update.message.reply_text("Формат: /setstock <смак> <кількість>")
-        return
+    def all(self) -> Dict[int, int]:
+        # read-only snapshot, don't mutate
+        return self._qty
 
-    qty_str = toks[-1]
-    flavor_raw = " ".join(toks[:-1])
-    flavor = normalize_flavor(flavor_raw)
+    def get(self, product_id: int) -> int:
+        return self._qty.get(product_id, 0)
 
-    if not qty_str.isdigit():
-        await update.message.reply_text("Кількість має бути числом.")
-        return
+    def recheck_due(self) -> bool:
+        return self.watch_db and time.monotonic() - self._checked_at >= STOCK_RECHECK_S
 
-    qty = int(qty_str)
+    def is_current(self, data_version: int) -> bool:
+        with self._lock:
+            self._checked_at = time.monotonic()
+            return data_version == self._data_version
 
-    # Try to match flavor from list (case-insensitive)
-    matched = None
-    for f in FLAVORS:
-        if f.upper() == flavor.upper():
-            matched = f
-            break
 
-    if not matched:
-        await update.message.reply_text("Не знайшов такий смак. Перевір написання.")
-        return
+STOCK = StockCache()
 
-    set_stock(matched, qty)
-    await update.message.reply_text(f"✅ Встановлено: {matched} = {qty}")
+def _load_stock(conn: sqlite3.Connection):
+    # call inside DB.write(): the cache is swapped in once the transaction commits
+    rows = conn.execute("SELECT product_id, MAX(qty - reserved, 0) AS available FROM stock").fetchall()
+    qty = {int(r["product_id"]): int(r["available"]) for r in rows}
+    data_version = int(conn.execute("PRAGMA data_version").fetchone()[0])
+    DB.on_commit(lambda: STOCK.replace(qty, data_version))
+    DB.on_commit(SEARCH.invalidate)
 
-async def cmd_addstock(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update):
-        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+def sync_stock_cache():
+    """Reload the stock cache if another process changed the DB file."""
+    if not STOCK.recheck_due():
         return
-
-    raw = update.message.text[len("/addstock"):].strip()
-    toks = raw.split()
-    if len(toks) < 2:
-        await update.message.reply_text("Формат: /addstock <смак> <кількість>\nПриклад: /addstock БАНАН 5")
+    if STOCK.is_current(DB.data_version()):
         return
+    log.info("stock table changed outside the bot, reloading cache")
+    with DB.write() as conn:
+        _load_stock(conn)
 
-    qty_str = toks[-1]
-    flavor_raw = " ".join(toks[:-1])
-    flavor = normalize_flavor(flavor_raw)
+# Small key/value table (photo file_ids etc.), mirrored in memory
+SETTINGS: Dict[str, str] = {}
 
-    try:
-        qty = int(qty_str)
-    except ValueError:
-        await update.message.reply_text("Кількість має бути числом (можна від'ємне).")
-        return
+def _load_settings(conn: sqlite3.Connection):
+    values = {r["key"]: r["value"] for r in conn.execute("SELECT key, value FROM settings").fetchall()}
 
-    matched = None
-    for f in FLAVORS:
-        if f.upper() == flavor.upper():
-            matched = f
-            break
+    def swap():
+        SETTINGS.clear()
+        SETTINGS.update(values)
+    DB.on_commit(swap)
 
-    if not matched:
-        await update.message.reply_text("Не знайшов такий смак. Перевір написання.")
-        return
+def get_setting(key: str, default: Optional[str] = None) -> Optional[str]:
+    return SETTINGS.get(key, default)
 
-    add_stock(matched, qty)
-    await update.message.reply_text(f"✅ Додано: {matched} ({qty:+d}). Тепер: {get_stock(matched)}")
+def set_setting(key: str, value: Optional[str]):
+    # value=None deletes the key
+    with DB.write() as conn:
+        if value is None:
+            conn.execute("DELETE FROM settings WHERE key = ?", (key,))
+            DB.on_commit(lambda: SETTINGS.pop(key, None))
+        else:
+            conn.execute("INSERT INTO settings(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+            DB.on_commit(lambda: SETTINGS.__setitem__(key, value))
 
+def close_db():
+    DB.close()
 
-# =========================
-# Callback router
-# =========================
-async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await safe_answer(query)
-    data = query.data or ""
+def _rename_flavor_tables(conn: sqlite3.Connection) -> bool:
+    # DBs from before the catalog keyed stock and cart by flavor name
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(stock)").fetchall()}
+    if "flavor" not in cols:
+        return False
+    conn.execute("ALTER TABLE stock RENAME TO stock_by_flavor")
+    conn.execute("ALTER TABLE cart RENAME TO cart_by_flavor")
+    return True
 
-    # MENU
-    if data == "menu":
-        await query.edit_message_text("Вибери товар:", reply_markup=main_menu_kb())
-        return
+def _copy_flavor_tables(conn: sqlite3.Connection, category_id: int):
+    # flavors that are no longer in FLAVORS are dropped together with their cart lines
+    conn.execute("""
+        INSERT OR REPLACE INTO stock(product_id, qty)
+        SELECT p.id, o.qty FROM stock_by_flavor o
+        JOIN products p ON p.category_id = ? AND p.name = o.flavor
+    """, (category_id,))
+    conn.execute("""
+        INSERT INTO cart(user_id, product_id, qty)
+        SELECT o.user_id, p.id, o.qty FROM cart_by_flavor o
+        JOIN products p ON p.category_id = ? AND p.name = o.flavor
+    """, (category_id,))
+    conn.execute("DROP TABLE stock_by_flavor")
+    conn.execute("DROP TABLE cart_by_flavor")
 
-    # CATEGORY (only 30)
-    if data == "cat:30":
-        kb = flavors_kb()
-        # if no items
-        st = get_stock_all()
-        if not any(st.get(f, 0) > 0 for f in FLAVORS):
-            await query.edit_message_text("Наразі немає в наявності 😕", reply_markup=back_to_menu_kb())
-            return
-        await query.edit_message_text(f"Смаки {BRAND} {VOLUME} (показує тільки те, що є на складі):", reply_markup=kb)
-        return
+def _add_column(conn: sqlite3.Connection, table: str, column: str, ddl: str) -> bool:
+    cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column in cols:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return True
 
-    # FLAVOR VIEW
-    if data.startswith("flavor:"):
-        flavor = data.split(":", 1)[1]
-        if get_stock(flavor) <= 0:
-            await query.edit_message_text("Цього смаку вже нема в наявності 😕", reply_markup=flavors_kb())
-            return
+def _reserve_existing_carts(conn: sqlite3.Connection):
+    # carts from before reservations: hold what they contain for one TTL
+    conn.execute("UPDATE cart SET expires_at = ?", (time.time() + RESERVATION_TTL_S,))
+    conn.execute("""
+        UPDATE stock SET reserved = (SELECT COALESCE(SUM(c.qty), 0) FROM cart c WHERE c.product_id = stock.product_id)
+    """)
 
-        text = flavor_description(flavor)
-        # send photo separately if exists, then edit text
-        try:
-            if os.path.exists(PHOTO_PATH):
-                # If current message has no photo, we send a new photo message
-                with open(PHOTO_PATH, "rb") as f:
-                    await query.message.reply_photo(photo=InputFile(f), caption=text, parse_mode="Markdown", reply_markup=flavor_actions_kb(flavor))
-                # keep old message as list screen
-                return
-        except Exception:
-            pass
+def _seed_catalog(conn: sqlite3.Connection) -> Optional[int]:
+    """First start: FLAVORS become category 1 with product ids in list order."""
+    if conn.execute("SELECT 1 FROM categories LIMIT 1").fetchone():
+        return None
+    cur = conn.execute("INSERT INTO categories(title) VALUES(?)", (f"{BRAND} {VOLUME}",))
+    category_id = int(cur.lastrowid)
+    conn.executemany(
+        "INSERT INTO products(id, category_id, name, lookup_key, position) VALUES(?, ?, ?, ?, ?)",
+        [(i, category_id, f, product_key(f), i) for i, f in enumerate(FLAVORS, 1)],
+    )
+    return category_id
 
-        # fallback: text only
-        await query.edit_message_text(text, parse_mode="Markdown", reply_markup=flavor_actions_kb(flavor))
-        return
+def _schema_v1(conn: sqlite3.Connection):
+    """
+    Schema as of the first versioned release. Unversioned DBs (user_version
+    0) may be from any earlier layout, so every step here is idempotent and
+    upgrades whatever it finds.
+    """
+    legacy = _rename_flavor_tables(conn)
 
-    # CART VIEW
-    if data == "cart:view":
-        cart = cart_get(update.effective_user.id)
-        if not cart:
-            await query.edit_message_text("🧺 Корзина пуста.", reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("⬅️ Назад", callback_data="cat:30")],
-                [InlineKeyboardButton("⬅️ Меню", callback_data="menu")],
-            ]))
-            return
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS categories (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL UNIQUE,
+        position INTEGER NOT NULL DEFAULT 0,
+        active INTEGER NOT NULL DEFAULT 1
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS categories_page ON categories(active, position, id)")
 
-        lines = ["🧺 **Твоя корзина:**", ""]
-        for f, q in cart.items():
-            lines.append(f"• {f} × {q}")
-        await query.edit_message_text("\n".join(lines), parse_mode="Markdown", reply_markup=cart_kb(cart))
-        return
+    # lookup_key = product_key(name), what admin commands match against
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS products (
+        id INTEGER PRIMARY KEY,
+        category_id INTEGER NOT NULL REFERENCES categories(id),
+        name TEXT NOT NULL,
+        lookup_key TEXT NOT NULL,
+        description TEXT,
+        position INTEGER NOT NULL DEFAULT 0,
+        active INTEGER NOT NULL DEFAULT 1,
+        UNIQUE (category_id, lookup_key)
+    )
+    """)
+    # one page of a category is a range scan of this index
+    conn.execute("CREATE INDEX IF NOT EXISTS products_page ON products(category_id, active, position, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS products_lookup ON products(lookup_key)")
 
-    # CART EDIT
-    if data.startswith("cart:add:"):
-        flavor = data.split(":", 2)[2]
-        if get_stock(flavor) <= 0:
-            await query.message.reply_text("Цього смаку вже нема в наявності 😕")
-            return
+    # qty = on hand, reserved = sum of cart lines holding it (kept in step by the cart helpers)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS stock (
+        product_id INTEGER PRIMARY KEY REFERENCES products(id),
+        qty INTEGER NOT NULL DEFAULT 0,
+        reserved INTEGER NOT NULL DEFAULT 0
+    )
+    """)
 
-        # Add 1 but not beyond stock
-        user_id = update.effective_user.id
-        current_in_cart = cart_get(user_id).get(flavor, 0)
-        if current_in_cart + 1 > get_stock(flavor):
-            await query.message.reply_text("Більше додати не можна — не вистачає на складі.")
-            return
+    # every line is a reservation until expires_at
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS cart (
+        user_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        qty INTEGER NOT NULL,
+        expires_at REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, product_id)
+    )
+    """)
+    unreserved = _add_column(conn, "cart", "expires_at", "REAL NOT NULL DEFAULT 0")
+    unreserved |= _add_column(conn, "stock", "reserved", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS cart_expires ON cart(expires_at)")
 
-        cart_add(user_id, flavor, 1)
-        await query.message.reply_text(f"✅ Додано в корзину: {flavor} (1 шт.)")
-        return
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )
+    """)
 
-    if data.startswith("cart:inc:"):
-        flavor = data.split(":", 2)[2]
-        user_id = update.effective_user.id
-        current = cart_get(user_id).get(flavor, 0)
-        if current + 1 > get_stock(flavor):
-            await query.message.reply_text("Більше додати не можна — не вистачає на складі.")
-            return
-        cart_add(user_id, flavor, 1)
-        cart = cart_get(user_id)
-        await query.edit_message_text(
-            "\n".join(["🧺 **Твоя корзина:**", ""] + [f"• {f} × {q}" for f, q in cart.items()]),
-            parse_mode="Markdown",
-            reply_markup=cart_kb(cart)
-        )
-        return
+    # messages waiting to be delivered (admin order notifications)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox(next_attempt_at)")
 
-    if data.startswith("cart:dec:"):
-        flavor = data.split(":", 2)[2]
-        user_id = update.effective_user.id
-        cart_add(user_id, flavor, -1)
-        cart = cart_get(user_id)
-        if not cart:
-            await query.edit_message_text("🧺 Корзина пуста.", reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("⬅️ Назад", callback_data="cat:30")],
-                [InlineKeyboardButton("⬅️ Меню", callback_data="menu")],
-            ]))
-            return
-        await query.edit_message_text(
-            "\n".join(["🧺 **Твоя корзина:**", ""] + [f"• {f} × {q}" for f, q in cart.items()]),
-            parse_mode="Markdown",
-            reply_markup=cart_kb(cart)
-        )
-        return
+    # items: JSON [[label, qty], ...] as reported to the buyer, so a retry gets the same answer
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        idempotency_key TEXT UNIQUE,
+        created_at REAL NOT NULL,
+        items TEXT NOT NULL
+    )
+    """)
 
-    if data == "cart:clear":
-        cart_clear(update.effective_user.id)
-        await query.edit_message_text("🗑 Корзина очищена.", reply_markup=InlineKeyboardMarkup([
-            [InlineKeyboardButton("⬅️ Назад", callback_data="cat:30")],
-            [InlineKeyboardButton("⬅️ Меню", callback_data="menu")],
-        ]))
-        return
+    category_id = _seed_catalog(conn)
+    if legacy and category_id is not None:
+        _copy_flavor_tables(conn, category_id)
+    if legacy or unreserved:
+        _reserve_existing_carts(conn)
 
-    # ORDER
-    if data == "order:confirm":
-        user_id = update.effective_user.id
-        ok, msg, items = checkout(user_id)
-        if not ok:
-            await query.message.reply_text(f"❌ {msg}")
-            return
+    # Ensure every product has a stock row
+    conn.execute("INSERT OR IGNORE INTO stock(product_id, qty) SELECT id, 0 FROM products")
 
-        # Send to admin: profile + order
-        u = update.effective_user
-        admin_text = user_profile_text(u) + "\n\n" + order_text(items)
+def _schema_v2(conn: sqlite3.Connection):
+    """Order lines and per-day sales counters (no backfill: history starts here)."""
+    # IF NOT EXISTS like v1: a DB whose user_version was reset must still migrate
+    # label is what the buyer saw, kept even if the product is renamed later
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS order_items (
+        order_id INTEGER NOT NULL REFERENCES orders(id),
+        product_id INTEGER NOT NULL,
+        label TEXT NOT NULL,
+        qty INTEGER NOT NULL,
+        PRIMARY KEY (order_id, product_id)
+    ) WITHOUT ROWID
+    """)
+    # bumped by every checkout, so a report reads days x products rows, never orders
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        units INTEGER NOT NULL DEFAULT 0,
+        orders INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sales_days (
+        day TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        units INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
 
-        try:
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID_INT, text=admin_text, parse_mode="Markdown")
-        except Exception:
-            # still ok for user, but warn
-            await query.message.reply_text("⚠️ Не зміг надіслати повідомлення адміну. Перевір ADMIN_CHAT_ID.")
-            return
+# Append only: a DB at user_version N has had MIGRATIONS[:N] applied.
+# Each one runs in its own transaction together with the version bump.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _schema_v1,
+    _schema_v2,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
-        # User confirmation
-        await query.edit_message_text("✅ Замовлення прийнято! Чекайте повідомлення від менеджера 🙌", reply_markup=back_to_menu_kb())
-        return
+def migrate() -> int:
+    """Bring the DB up to SCHEMA_VERSION; returns the number of migrations applied."""
+    version = DB.schema_version()
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"{DB_PATH} has schema version {version}, this bot only knows up to {SCHEMA_VERSION}")
+    applied = 0
+    while version < SCHEMA_VERSION:
+        with DB.write() as conn:
+            # re-read under the write lock: another process may have migrated meanwhile
+            version = int(conn.execute("PRAGMA user_version").fetchone()[0])
+            if version >= SCHEMA_VERSION:
+                break
+            started = time.perf_counter()
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+        log.info("DB migrated to schema version %d in %.0f ms", version + 1, (time.perf_counter() - started) * 1000)
+        version += 1
+        applied += 1
+    return applied
+
+def init_db():
+    # a current schema skips straight to loading the in-memory mirrors
+    migrate()
+    with DB.write() as conn:
+        _load_stock(conn)
+        _load_settings(conn)
+
+def normalize_flavor(text: str) -> str:
+    # Accept underscores as spaces, trim, uppercase Ukrainian/RU kept as is
+    t = (text or "").strip()
+    t = t.replace("_", " ")
+    t = " ".join(t.split())
+    return t
+
+def product_key(name: str) -> str:
+    return normalize_flavor(name).upper()
 
-    if data == "noop":
+def get_stock(product_id: int) -> int:
+    sync_stock_cache()
+    return STOCK.get(product_id)
+
+def _refresh_available(conn: sqlite3.Connection, product_ids):
+    # push the new availability of these products to STOCK on commit
+    ids = list(product_ids)
+    if not ids:
         return
+    rows = conn.execute(
+        f"SELECT product_id, MAX(qty - reserved, 0) AS available FROM stock WHERE product_id IN ({','.join('?' * len(ids))})",
+        ids,
+    ).fetchall()
+    available = {int(r["product_id"]): int(r["available"]) for r in rows}
+    DB.on_commit(lambda: STOCK.update(available))
 
-    # Unknown
-    await query.message.reply_text("Невідома дія. Натисни /start.")
+def set_stock(product_id: int, qty: int):
+    with DB.write() as conn:
+        conn.execute("INSERT INTO stock(product_id, qty) VALUES(?, ?) ON CONFLICT(product_id) DO UPDATE SET qty=excluded.qty", (product_id, qty))
+        _refresh_available(conn, [product_id])
 
+def add_stock(product_id: int, qty: int) -> int:
+    """Returns the new quantity on hand."""
+    with DB.write() as conn:
+        conn.execute("UPDATE stock SET qty = MAX(qty + ?, 0) WHERE product_id = ?", (qty, product_id))
+        row = conn.execute("SELECT qty FROM stock WHERE product_id = ?", (product_id,)).fetchone()
+        if not row:
+            return 0
+        _refresh_available(conn, [product_id])
+        return int(row["qty"])
 
-# =========================
-# Minimal HTTP server (for Render Web Service)
-# =========================
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(b"ok")
+def import_stock(rows: List[Tuple[int, int]], delta: bool):
+    """Apply validated (product id, qty) rows in one transaction: set, or add when `delta`."""
+    with DB.write() as conn:
+        if delta:
+            conn.executemany("UPDATE stock SET qty = MAX(qty + ?, 0) WHERE product_id = ?", [(q, p) for p, q in rows])
+        else:
+            conn.executemany(
+                "INSERT INTO stock(product_id, qty) VALUES(?, ?) ON CONFLICT(product_id) DO UPDATE SET qty=excluded.qty",
+                rows,
+            )
+        _load_stock(conn)
 
-def start_health_server():
-    try:
-        server = HTTPServer(("0.0.0.0", PORT), HealthHandler)
-        server.serve_forever()
-    except Exception:
-        pass
 
+class CartLine(NamedTuple):
+    product_id: int
+    name: str
+    qty: int
+    active: bool
 
-# =========================
-# Main
-# =========================
-def main():
-    init_db()
 
-    # Start health server in background (so Render Web Service doesn't kill it)
-    t = threading.Thread(target=start_health_server, daemon=True)
-    t.start()
+# lines in the order they were added; a tuple so it can key the render cache
+Cart = Tuple[CartLine, ...]
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def _cart_rows(conn: sqlite3.Connection, user_id: int) -> Cart:
+    rows = conn.execute("""
+        SELECT c.product_id, p.name, c.qty, p.active
+        FROM cart c JOIN products p ON p.id = c.product_id
+        WHERE c.user_id = ?
+        ORDER BY c.rowid
+    """, (user_id,)).fetchall()
+    return tuple(CartLine(int(r["product_id"]), r["name"], int(r["qty"]), bool(r["active"])) for r in rows)
 
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("stock", cmd_stock))
-    app.add_handler(CommandHandler("setstock", cmd_setstock))
-    app.add_handler(CommandHandler("addstock", cmd_addstock))
+def cart_get(user_id: int) -> Cart:
+    with DB.read() as conn:
+        return _cart_rows(conn, user_id)
 
-    app.add_handler(CallbackQueryHandler(on_callback))
+def cart_adjust(user_id: int, product_id: int, delta: int) -> Tuple[int, Cart]:
+    """
+    Atomically change one cart line by `delta`, reserving (or releasing) the
+    units in stock. Increments never take more than is available, decrements
+    always apply. Any change renews the reservation of the whole cart.
+    Returns (applied delta, full cart).
+    """
+    with DB.write() as conn:
+        row = conn.execute("""
+            SELECT
+                (SELECT MAX(s.qty - s.reserved, 0) FROM stock s JOIN products p ON p.id = s.product_id
+                 WHERE s.product_id = ? AND p.active = 1) AS available,
+                (SELECT qty FROM cart WHERE user_id = ? AND product_id = ?) AS current
+        """, (product_id, user_id, product_id)).fetchone()
+        available = int(row["available"] or 0)
+        current = int(row["current"] or 0)
+        if delta > 0:
+            new_qty = current + min(delta, available)
+        else:
+            new_qty = max(current + delta, 0)
+
+        change = new_qty - current
+        if change:
+            if new_qty == 0:
+                conn.execute("DELETE FROM cart WHERE user_id=? AND product_id=?", (user_id, product_id))
+            else:
+                conn.execute("""
+                    INSERT INTO cart(user_id, product_id, qty)
+                    VALUES(?, ?, ?)
+                    ON CONFLICT(user_id, product_id) DO UPDATE SET qty=excluded.qty
+                """, (user_id, product_id, new_qty))
+            conn.execute("UPDATE stock SET reserved = MAX(reserved + ?, 0) WHERE product_id = ?", (change, product_id))
+            _refresh_available(conn, [product_id])
+            conn.execute("UPDATE cart SET expires_at = ? WHERE user_id = ?", (time.time() + RESERVATION_TTL_S, user_id))
+        return change, _cart_rows(conn, user_id)
+
+def _release_lines(conn: sqlite3.Connection, lines: List[Tuple[int, int, int]]):
+    """Drop (user_id, product_id, qty) cart lines and give their units back to stock."""
+    freed: Dict[int, int] = {}
+    for _, product_id, qty in lines:
+        freed[product_id] = freed.get(product_id, 0) + qty
+    conn.executemany("UPDATE stock SET reserved = MAX(reserved - ?, 0) WHERE product_id = ?", [(q, p) for p, q in freed.items()])
+    conn.executemany("DELETE FROM cart WHERE user_id = ? AND product_id = ?", [(u, p) for u, p, _ in lines])
+    _refresh_available(conn, freed)
+
+def cart_clear(user_id: int):
+    with DB.write() as conn:
+        lines = conn.execute("SELECT user_id, product_id, qty FROM cart WHERE user_id = ?", (user_id,)).fetchall()
+        _release_lines(conn, [tuple(r) for r in lines])
+
+def release_expired(limit: int) -> int:
+    """Release up to `limit` expired cart lines, oldest first; returns how many."""
+    with DB.write() as conn:
+        # range scan on cart_expires, never the whole table
+        lines = conn.execute(
+            "SELECT user_id, product_id, qty FROM cart WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+        _release_lines(conn, [tuple(r) for r in lines])
+    RESERVATIONS_EXPIRED.inc(amount=len(lines))
+    return len(lines)
+
+try:
+    _shop_tz = ZoneInfo(SHOP_TZ)
+except (ZoneInfoNotFoundError, ValueError):
+    log.warning("unknown SHOP_TZ %r, sales days are counted in UTC", SHOP_TZ)
+    _shop_tz = ZoneInfo("UTC")
+
+def sales_day(ts: float) -> str:
+    """YYYY-MM-DD of a timestamp in the shop's time zone."""
+    return datetime.fromtimestamp(ts, _shop_tz).strftime("%Y-%m-%d")
+
+def _record_sale(conn: sqlite3.Connection, order_id: int, created_at: float, lines: List[Tuple[int, str, int]]):
+    # order lines plus the daily counters, in the checkout's savepoint
+    day = sales_day(created_at)
+    conn.executemany(
+        "INSERT INTO order_items(order_id, product_id, label, qty) VALUES(?, ?, ?, ?)",
+        [(order_id, product_id, label, qty) for product_id, label, qty in lines],
+    )
+    conn.executemany("""
+        INSERT INTO sales_daily(day, product_id, units, orders) VALUES(?, ?, ?, 1)
+        ON CONFLICT(day, product_id) DO UPDATE SET units = units + excluded.units, orders = orders + 1
+    """, [(day, product_id, qty) for product_id, _, qty in lines])
+    conn.execute("""
+        INSERT INTO sales_days(day, orders, units) VALUES(?, 1, ?)
+        ON CONFLICT(day) DO UPDATE SET orders = orders + 1, units = units + excluded.units
+    """, (day, sum(qty for _, _, qty in lines)))
+
+class CheckoutResult(NamedTuple):
+    ok: bool
+    message: str
+    items: List[Tuple[str, int]]  # (product label, qty)
+    order_id: Optional[int] = None
+    replayed: bool = False  # same idempotency key as an earlier order: nothing was done again
+
+# ordered items -> (chat_id, text, parse_mode) of a message to queue in the outbox with the order
+OrderNotice = Callable[[List[Tuple[str, int]]], Tuple[int, str, Optional[str]]]
+
+class CheckoutRequest(NamedTuple):
+    user_id: int
+    key: Optional[str] = None
+    notice: Optional[OrderNotice] = None
 
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+def order_key(key: str, lines: Iterable[Tuple[int, int]], expires_at: float) -> str:
+    """
+    The idempotency key of an order: the caller's `key` plus a token of the
+    cart as it is now. Every cart write changes the (product, qty) lines or
+    renews the reservation deadline, so a cart changed since an earlier
+    order under `key` gets a key of its own and is checked out. An empty
+    cart has no token: checkout replays the last order under `key` instead.
+    """
+    token = hashlib.sha1(repr((list(lines), expires_at)).encode()).hexdigest()[:16]
+    return f"{key}#{token}"
+
+def _checkout_one(conn: sqlite3.Connection, user_id: int, key: Optional[str], notice: Optional[OrderNotice],
+                  remaining: Dict[int, int]) -> CheckoutResult:
+    # validate the whole cart against stock in one query; the cart's own
+    # reservation is part of the stock on hand, hidden products count as sold out
+    rows = conn.execute("""
+        SELECT c.product_id, c.qty, c.expires_at, cat.title || ' · ' || p.name AS label,
+               CASE WHEN p.active THEN COALESCE(s.qty, 0) ELSE 0 END AS available
+        FROM cart c
+        JOIN products p ON p.id = c.product_id
+        JOIN categories cat ON cat.id = p.category_id
+        LEFT JOIN stock s ON s.product_id = c.product_id
+        WHERE c.user_id = ?
+        ORDER BY c.rowid
+    """, (user_id,)).fetchall()
+    if key is not None:
+        if rows:
+            key = order_key(key, [(int(r["product_id"]), int(r["qty"])) for r in rows], rows[0]["expires_at"])
+            row = conn.execute("SELECT id, items FROM orders WHERE idempotency_key = ?", (key,)).fetchone()
+        else:
+            row = conn.execute(
+                "SELECT id, items FROM orders WHERE idempotency_key > ? AND idempotency_key < ? ORDER BY id DESC LIMIT 1",
+                (key + "#", key + "$"),
+            ).fetchone()
+        if row:
+            items = [(label, qty) for label, qty in json.loads(row["items"])]
+            return CheckoutResult(True, "OK", items, int(row["id"]), replayed=True)
+
+    items = [(r["label"], int(r["qty"])) for r in rows]
+    if not items:
+        return CheckoutResult(False, "Корзина пуста.", [])
+    for r in rows:
+        if r["qty"] > r["available"]:
+            return CheckoutResult(False, f"Немає в наявності достатньо: {r['label']} (потрібно {r['qty']}, є {r['available']}).", items)
+
+    # deduct every line and its reservation with one conditional UPDATE joined against the cart
+    updated = conn.execute("""
+        UPDATE stock SET qty = stock.qty - c.qty, reserved = MAX(stock.reserved - c.qty, 0)
+        FROM cart c
+        WHERE c.user_id = ? AND c.product_id = stock.product_id AND stock.qty >= c.qty
+        RETURNING product_id, MAX(qty - reserved, 0) AS available
+    """, (user_id,)).fetchall()
+    if len(updated) != len(items):
+        raise sqlite3.IntegrityError("stock changed during checkout")
+
+    # clear cart
+    conn.execute("DELETE FROM cart WHERE user_id=?", (user_id,))
+    for r in updated:
+        remaining[int(r["product_id"])] = int(r["available"])
+
+    created_at = time.time()
+    cur = conn.execute(
+        "INSERT INTO orders(user_id, idempotency_key, created_at, items) VALUES(?, ?, ?, ?)",
+        (user_id, key, created_at, json.dumps(items, ensure_ascii=False)),
+    )
+    order_id = int(cur.lastrowid)
+    _record_sale(conn, order_id, created_at, [(int(r["product_id"]), r["label"], int(r["qty"])) for r in rows])
+    if notice is not None:
+        _outbox_insert(conn, *notice(items))
+    return CheckoutResult(True, "OK", items, order_id)
+
+def checkout_batch(requests: List[CheckoutRequest]) -> List[CheckoutResult]:
+    """
+    Check out several (user_id, idempotency key[, notice]) carts in one write
+    transaction (group commit). Orders are applied in the given order, so
+    earlier buyers get stock first; each runs in its own savepoint and a
+    failed order doesn't affect the rest. A key whose cart hasn't changed
+    since its order (see order_key) gets that order back instead of a
+    second checkout. A new order's notice is queued in the outbox in the
+    same savepoint, so the two commit together.
+    """
+    results: List[CheckoutResult] = []
+    outcomes: List[str] = []
+    remaining: Dict[int, int] = {}
+    try:
+        with DB.write() as conn:
+            for user_id, key, notice in (CheckoutRequest(*r) for r in requests):
+                conn.execute("SAVEPOINT checkout")
+                try:
+                    res = _checkout_one(conn, user_id, key, notice, remaining)
+                    outcomes.append("replayed" if res.replayed else "ok" if res.ok else "out_of_stock" if res.items else "empty")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO checkout")
+                    res = CheckoutResult(False, f"Помилка оформлення: {e}", [])
+                    outcomes.append("error")
+                conn.execute("RELEASE checkout")
+                results.append(res)
+            DB.on_commit(lambda: STOCK.update(remaining))
+    except Exception as e:
+        # nothing was committed
+        CHECKOUTS.inc("error", amount=len(requests))
+        failed = [r.items for r in results] + [[]] * (len(requests) - len(results))
+        return [CheckoutResult(False, f"Помилка оформлення: {e}", items) for items in failed]
+    for outcome in outcomes:
+        CHECKOUTS.inc(outcome)
+    return results
+
+def checkout(user_id: int, key: Optional[str] = None, notice: Optional[OrderNotice] = None) -> CheckoutResult:
+    """
+    Atomically:
+    - verify stock is enough
+    - decrement stock
+    - clear cart
+    - record the order under `key`
+    - queue `notice` in the outbox
+    """
+    return checkout_batch([CheckoutRequest(user_id, key, notice)])[0]
+
+class SalesReport(NamedTuple):
+    since: str  # first day included, YYYY-MM-DD
+    orders: int
+    units: int
+    products: List[Tuple[str, int]]  # (label, units), best sellers first
+
+def sales_report(days: int) -> SalesReport:
+    """Sales of the last `days` days including today, from the daily counters."""
+    since = (datetime.now(_shop_tz).date() - timedelta(days=days - 1)).isoformat()
+    with DB.read() as conn:
+        totals = conn.execute(
+            "SELECT COALESCE(SUM(orders), 0) AS orders, COALESCE(SUM(units), 0) AS units FROM sales_days WHERE day >= ?",
+            (since,),
+        ).fetchone()
+        rows = conn.execute("""
+            SELECT COALESCE(cat.title || ' · ' || p.name, '#' || s.product_id) AS label, SUM(s.units) AS units
+            FROM sales_daily s
+            LEFT JOIN products p ON p.id = s.product_id
+            LEFT JOIN categories cat ON cat.id = p.category_id
+            WHERE s.day >= ?
+            GROUP BY s.product_id
+            ORDER BY units DESC, label
+        """, (since,)).fetchall()
+    return SalesReport(since, int(totals["orders"]), int(totals["units"]), [(r["label"], int(r["units"])) for r in rows])
+
+def _outbox_insert(conn: sqlite3.Connection, chat_id: int, text: str, parse_mode: Optional[str]) -> int:
+    cur = conn.execute(
+        "INSERT INTO outbox(chat_id, text, parse_mode, next_attempt_at) VALUES(?, ?, ?, ?)",
+        (chat_id, text, parse_mode, time.time()),
+    )
+    return int(cur.lastrowid)
+
+def outbox_add(chat_id: int, text: str, parse_mode: Optional[str]) -> int:
+    with DB.write() as conn:
+        return _outbox_insert(conn, chat_id, text, parse_mode)
+
+def outbox_due(limit: int) -> List[sqlite3.Row]:
+    with DB.read() as conn:
+        return conn.execute(
+            "SELECT id, chat_id, text, parse_mode, attempts FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+
+def outbox_done(ids: List[int]):
+    with DB.write() as conn:
+        conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+
+def outbox_retry(ids: List[int], delay: float):
+    with DB.write() as conn:
+        conn.executemany(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+            [(time.time() + delay, i) for i in ids],
+        )
+
+
+# =========================
+# Catalog
+# =========================
+CATALOG_PAGE_SIZE = int(os.environ.get("CATALOG_PAGE_SIZE", "8"))  # buttons per category/product page
+
+
+class Product(NamedTuple):
+    id: int
+    category_id: int
+    category: str
+    name: str
+    description: Optional[str]
+    active: bool
+
+    @property
+    def label(self) -> str:
+        return f"{self.category} · {self.name}"
+
+
+_PRODUCT_SQL = """
+    SELECT p.id, p.category_id, c.title AS category, p.name, p.description, p.active
+    FROM products p JOIN categories c ON c.id = p.category_id
+"""
+
+def _product(row: sqlite3.Row) -> Product:
+    return Product(int(row["id"]), int(row["category_id"]), row["category"], row["name"], row["description"], bool(row["active"]))
+
+def get_product(product_id: int) -> Optional[Product]:
+    with DB.read() as conn:
+        row = conn.execute(_PRODUCT_SQL + " WHERE p.id = ?", (product_id,)).fetchone()
+    return _product(row) if row else None
+
+def find_products(names: List[str]) -> Dict[str, List[Product]]:
+    """
+    Products for admin-typed names; "12" or "#12" means product id 12,
+    anything else must match a whole name up to search_key() folding.
+    """
+    found: Dict[str, List[Product]] = {}
+    for name in names:
+        key = name.strip().lstrip("#")
+        if key.isdigit():
+            product = SEARCH.product(int(key))
+            found[name] = [product] if product else []
+        else:
+            found[name] = SEARCH.exact(name)
+    return found
+
+def categories_page(page: int) -> Tuple[List[Tuple[int, str]], bool]:
+    """(id, title) of active categories on `page`, and whether there's a next page."""
+    with DB.read() as conn:
+        rows = conn.execute(
+            "SELECT id, title FROM categories WHERE active = 1 ORDER BY position, id LIMIT ? OFFSET ?",
+            (CATALOG_PAGE_SIZE + 1, page * CATALOG_PAGE_SIZE),
+        ).fetchall()
+    return [(int(r["id"]), r["title"]) for r in rows[:CATALOG_PAGE_SIZE]], len(rows) > CATALOG_PAGE_SIZE
+
+def products_page(category_id: int, page: int) -> Tuple[Optional[str], List[Tuple[int, str, int]], bool]:
+    """
+    (category title, [(id, name, qty)], has next page) for in-stock products;
+    title is None if the category doesn't exist or is hidden.
+    """
+    with DB.read() as conn:
+        cat = conn.execute("SELECT title FROM categories WHERE id = ? AND active = 1", (category_id,)).fetchone()
+        if not cat:
+            return None, [], False
+        rows = conn.execute("""
+            SELECT p.id, p.name, s.qty - s.reserved AS qty
+            FROM products p JOIN stock s ON s.product_id = p.id
+            WHERE p.category_id = ? AND p.active = 1 AND s.qty > s.reserved
+            ORDER BY p.position, p.id
+            LIMIT ? OFFSET ?
+        """, (category_id, CATALOG_PAGE_SIZE + 1, page * CATALOG_PAGE_SIZE)).fetchall()
+    items = [(int(r["id"]), r["name"], int(r["qty"])) for r in rows[:CATALOG_PAGE_SIZE]]
+    return cat["title"], items, len(rows) > CATALOG_PAGE_SIZE
+
+def catalog_summary() -> List[sqlite3.Row]:
+    """Per category: id, title, active, product count and units in stock (admin view)."""
+    with DB.read() as conn:
+        return conn.execute("""
+            SELECT c.id, c.title, c.active, COUNT(p.id) AS products, COALESCE(SUM(s.qty), 0) AS units
+            FROM categories c
+            LEFT JOIN products p ON p.category_id = c.id AND p.active = 1
+            LEFT JOIN stock s ON s.product_id = p.id
+            GROUP BY c.id ORDER BY c.position, c.id
+        """).fetchall()
+
+def catalog_products(category_id: Optional[int] = None) -> List[sqlite3.Row]:
+    """All products (hidden ones too) with stock, one category or the whole catalog."""
+    sql = """
+        SELECT p.id, c.title AS category, p.name, p.active, COALESCE(s.qty, 0) AS qty, COALESCE(s.reserved, 0) AS reserved
+        FROM products p
+        JOIN categories c ON c.id = p.category_id
+        LEFT JOIN stock s ON s.product_id = p.id
+    """
+    with DB.read() as conn:
+        if category_id is None:
+            return conn.execute(sql + " ORDER BY c.position, c.id, p.position, p.id").fetchall()
+        return conn.execute(sql + " WHERE p.category_id = ? ORDER BY p.position, p.id", (category_id,)).fetchall()
+
+def add_category(title: str) -> int:
+    with DB.write() as conn:
+        cur = conn.execute(
+            "INSERT INTO categories(title, position) VALUES(?, (SELECT COALESCE(MAX(position), 0) + 1 FROM categories))",
+            (title,),
+        )
+        DB.on_commit(STOCK.touch)
+        DB.on_commit(SEARCH.invalidate)
+        return int(cur.lastrowid)
+
+def add_product(category_id: int, name: str, description: Optional[str] = None) -> Optional[int]:
+    """New product with zero stock, appended to its category; None if there's no such category."""
+    with DB.write() as conn:
+        if not conn.execute("SELECT 1 FROM categories WHERE id = ?", (category_id,)).fetchone():
+            return None
+        cur = conn.execute("""
+            INSERT INTO products(category_id, name, lookup_key, description, position)
+            VALUES(?, ?, ?, ?, (SELECT COALESCE(MAX(position), 0) + 1 FROM products WHERE category_id = ?))
+        """, (category_id, name, product_key(name), description, category_id))
+        product_id = int(cur.lastrowid)
+        conn.execute("INSERT INTO stock(product_id, qty) VALUES(?, 0)", (product_id,))
+        DB.on_commit(lambda: STOCK.update({product_id: 0}))
+        DB.on_commit(SEARCH.invalidate)
+        return product_id
+
+def set_product_active(product_id: int, active: bool) -> bool:
+    with DB.write() as conn:
+        cur = conn.execute("UPDATE products SET active = ? WHERE id = ?", (int(active), product_id))
+        DB.on_commit(STOCK.touch)
+        DB.on_commit(SEARCH.invalidate)
+        return cur.rowcount > 0
+
+
+# =========================
+# Search
+# =========================
+# Inline queries and admin commands find products by name through one
+# in-memory index. Names and queries go through the same folding: case,
+# "_"/punctuation, Cyrillic -> Latin transliteration and a few spelling
+# merges (y/i/j, kh/h, c/k...), so "vish", "ВИШ", "вiш" and "vysh" land on
+# the same tokens. The index is rebuilt lazily after a catalog change; stock
+# is checked against STOCK at query time, so stock changes cost nothing.
+SEARCH_MAX_EDITS = 2  # typos tolerated in a word of 6+ letters (1 for 4-5, 0 below)
+
+_TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "ґ": "g", "д": "d", "е": "e", "є": "ie", "ё": "e", "ж": "zh",
+    "з": "z", "и": "y", "і": "i", "ї": "i", "й": "i", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh",
+    "щ": "shch", "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "iu", "я": "ia", "'": "", "’": "", "ʼ": "",
+})
+# applied in order to the transliterated text
+_SPELLING = [
+    (re.compile(r"shch|sch"), "sh"), (re.compile(r"kh"), "h"), (re.compile(r"ph"), "f"),
+    (re.compile(r"ck|q|c(?!h)"), "k"), (re.compile(r"x"), "ks"), (re.compile(r"w"), "v"),
+    (re.compile(r"[yj]"), "i"), (re.compile(r"([a-z])\1+"), r"\1"),
+]
+_NON_WORD = re.compile(r"[\W_]+")
+
+def search_key(text: str) -> str:
+    """Folded form of a name or query: lowercase Latin words separated by single spaces."""
+    t = (text or "").lower().translate(_TRANSLIT)
+    t = _NON_WORD.sub(" ", t)
+    for pattern, repl in _SPELLING:
+        t = pattern.sub(repl, t)
+    return " ".join(t.split())
+
+def _prefix_edits(word: str, token: str, limit: int) -> int:
+    """Edit distance from `word` to the closest prefix of `token`, or limit + 1 if over `limit`."""
+    prev = list(range(len(token) + 1))
+    for i, ch in enumerate(word, 1):
+        cur = [i]
+        for j, tc in enumerate(token, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ch != tc)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return min(prev)
+
+
+class _SearchData(NamedTuple):
+    products: Dict[int, Product]  # catalog order
+    order: Dict[int, int]  # product id -> position in catalog order
+    visible: Set[int]  # active product in an active category
+    by_key: Dict[str, List[int]]  # search_key(name) -> product ids
+    tokens: List[Tuple[str, int]]  # sorted (word, product id)
+    vocab: Dict[str, List[str]]  # letter -> distinct words with it first or second, for fuzzy matching
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Optional[_SearchData] = None
+        self.generation = 0  # bumped on every invalidate, for callers caching results
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self.generation += 1
+
+    def _get(self) -> _SearchData:
+        data = self._data
+        if data is not None:
+            return data
+        with self._lock:
+            if self._data is None:
+                self._data = self._build()
+            return self._data
+
+    @staticmethod
+    def _build() -> _SearchData:
+        with DB.read() as conn:
+            rows = conn.execute("""
+                SELECT p.id, p.category_id, c.title AS category, p.name, p.description, p.active, c.active AS category_active
+                FROM products p JOIN categories c ON c.id = p.category_id
+                ORDER BY c.position, c.id, p.position, p.id
+            """).fetchall()
+        products: Dict[int, Product] = {}
+        visible: Set[int] = set()
+        by_key: Dict[str, List[int]] = {}
+        tokens: List[Tuple[str, int]] = []
+        for r in rows:
+            p = _product(r)
+            products[p.id] = p
+            if p.active and r["category_active"]:
+                visible.add(p.id)
+            key = search_key(p.name)
+            by_key.setdefault(key, []).append(p.id)
+            tokens.extend((word, p.id) for word in set(key.split()))
+        tokens.sort()
+        order = {pid: i for i, pid in enumerate(products)}
+        vocab: Dict[str, List[str]] = {}
+        for word in sorted({word for word, _ in tokens}):
+            for ch in set(word[:2]):
+                vocab.setdefault(ch, []).append(word)
+        return _SearchData(products, order, visible, by_key, tokens, vocab)
+
+    def warm(self):
+        """Build the index now (on a DB thread) rather than on the next lookup."""
+        self._get()
+
+    def ready(self) -> bool:
+        """Whether the next lookup is answered without building the index."""
+        return self._data is not None
+
+    def product(self, product_id: int) -> Optional[Product]:
+        return self._get().products.get(product_id)
+
+    def visible_products(self) -> List[Product]:
+        """Active products of active categories, in catalog order."""
+        data = self._get()
+        return [p for pid, p in data.products.items() if pid in data.visible]
+
+    def exact(self, name: str) -> List[Product]:
+        """Products (hidden ones too) whose whole name folds to the same key as `name`."""
+        data = self._get()
+        return [data.products[pid] for pid in data.by_key.get(search_key(name), [])]
+
+    def search(self, query: str, limit: int, visible_only: bool = True,
+               keep: Optional[Callable[[int], bool]] = None) -> List[Tuple[Product, int]]:
+        """
+        (product, typos) for products having, for every query word, a word that
+        starts with it; a query word with no such match is matched with typos.
+        Best matches first, then catalog order. An empty query lists the catalog.
+        `keep` filters product ids further (e.g. by stock).
+        """
+        data = self._get()
+
+        def wanted(pid: int) -> bool:
+            return (not visible_only or pid in data.visible) and (keep is None or keep(pid))
+
+        words = search_key(query).split()
+        if not words:
+            return [(p, 0) for p in itertools.islice((p for pid, p in data.products.items() if wanted(pid)), limit)]
+        edits: Optional[Dict[int, int]] = None
+        for word in words:
+            matched = self._word_matches(data, word)
+            if edits is None:
+                edits = {pid: n for pid, n in matched.items() if wanted(pid)}
+            else:
+                edits = {pid: n + matched[pid] for pid, n in edits.items() if pid in matched}
+            if not edits:
+                return []
+        ranked = sorted(edits, key=lambda pid: (edits[pid], data.order[pid]))
+        return [(data.products[pid], edits[pid]) for pid in ranked[:limit]]
+
+    @staticmethod
+    def _word_matches(data: _SearchData, word: str) -> Dict[int, int]:
+        # prefix range of the sorted token list
+        lo = bisect.bisect_left(data.tokens, (word,))
+        matches: Dict[int, int] = {}
+        for token, pid in data.tokens[lo:]:
+            if not token.startswith(word):
+                break
+            matches[pid] = 0
+        if matches:
+            return matches
+        limit = 0 if len(word) < 4 else 1 if len(word) < 6 else SEARCH_MAX_EDITS
+        if not limit:
+            return matches
+        # A typo rarely touches both of the first two letters, so only tokens
+        # sharing one of them with the word (in either position, which covers
+        # a dropped or doubled first letter) are compared. A prefix match only
+        # looks at the first len(word) + limit letters of a token, and tokens
+        # sharing those letters are checked once.
+        width = len(word) + limit
+        close: Dict[str, int] = {}
+        for token in itertools.chain.from_iterable(data.vocab.get(ch, ()) for ch in set(word[:2])):
+            head = token[:width]
+            if head not in close and len(head) + limit >= len(word):
+                close[head] = _prefix_edits(word, head, limit)
+        for head, n in close.items():
+            if n > limit:
+                continue
+            lo = bisect.bisect_left(data.tokens, (head,))
+            for t, pid in data.tokens[lo:]:
+                if not t.startswith(head):
+                    break
+                matches[pid] = min(n, matches.get(pid, n))
+        return matches
+
+
+SEARCH = SearchIndex()
+
+def search_products(query: str, limit: int) -> List[Tuple[Product, int]]:
+    """(product, available) for visible, in-stock products matching `query`."""
+    sync_stock_cache()
+    found = SEARCH.search(query, limit, keep=lambda pid: STOCK.get(pid) > 0)
+    return [(p, STOCK.get(p.id)) for p, _ in found]
+
+
+# =========================
+# Storage engines
+# =========================
+# Stock, carts and checkout go through the StorageEngine picked by
+# STORAGE_ENGINE; the catalog, settings, outbox and reports stay in SQLite
+# either way.
+# - "sqlite": the helpers above, every change its own transaction.
+# - "memory": the state lives in dicts and changes never wait for the disk.
+#   Each one is appended to a journal file by a writer thread (fsync every
+#   JOURNAL_FSYNC_S) and folded into the SQLite tables every SNAPSHOT_S; on
+#   startup the snapshot is loaded and the newer journal entries replayed.
+#   _commit only queues the entry, so the user may already see a change
+#   that the writer hasn't written yet: a killed process loses that backlog
+#   (normally milliseconds), a power loss up to JOURNAL_FSYNC_S more.
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "sqlite")
+JOURNAL_FSYNC_S = float(os.environ.get("JOURNAL_FSYNC_S", "1"))
+SNAPSHOT_S = float(os.environ.get("SNAPSHOT_S", "60"))
+ORDER_KEY_TTL_S = 7 * 86400  # memory engine: idempotency keys kept this long
+JOURNAL_SEQ_SETTING = "journal_seq"  # last journal entry folded into SQLite
+
+
+class StorageEngine:
+    """
+    Stock, carts and checkout, with the semantics of the SQLite helpers
+    (see cart_adjust and checkout_batch). Methods block; engines with
+    `blocking = False` never touch the disk in them and are called straight
+    from the event loop, except products_page, which reads the catalog.
+    """
+
+    name = "base"
+    blocking = True
+
+    def load(self):
+        """Called once after init_db()."""
+
+    def flush(self):
+        """Make the SQLite tables current (admin listings and reports read them)."""
+
+    def close(self):
+        """Flush and stop; safe to call twice."""
+
+    def set_stock(self, product_id: int, qty: int):
+        raise NotImplementedError
+
+    def add_stock(self, product_id: int, qty: int) -> int:
+        raise NotImplementedError
+
+    def import_stock(self, rows: List[Tuple[int, int]], delta: bool):
+        raise NotImplementedError
+
+    def products_page(self, category_id: int, page: int) -> Tuple[Optional[str], List[Tuple[int, str, int]], bool]:
+        raise NotImplementedError
+
+    def cart_get(self, user_id: int) -> Cart:
+        raise NotImplementedError
+
+    def cart_adjust(self, user_id: int, product_id: int, delta: int) -> Tuple[int, Cart]:
+        raise NotImplementedError
+
+    def cart_clear(self, user_id: int):
+        raise NotImplementedError
+
+    def release_expired(self, limit: int) -> int:
+        raise NotImplementedError
+
+    def checkout_batch(self, requests: List[CheckoutRequest]) -> List[CheckoutResult]:
+        raise NotImplementedError
+
+
+class SQLiteEngine(StorageEngine):
+    name = "sqlite"
+    set_stock = staticmethod(set_stock)
+    add_stock = staticmethod(add_stock)
+    import_stock = staticmethod(import_stock)
+    products_page = staticmethod(products_page)
+    cart_get = staticmethod(cart_get)
+    cart_adjust = staticmethod(cart_adjust)
+    cart_clear = staticmethod(cart_clear)
+    release_expired = staticmethod(release_expired)
+    checkout_batch = staticmethod(checkout_batch)
+
+
+class Journal:
+    """
+    Append-only JSON-lines files "<prefix>.<first seq>", written by a
+    background thread. rotate() starts a new file so the older ones can be
+    deleted once a snapshot covers them.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._queue: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    def path(self, first_seq: int) -> str:
+        return f"{self.prefix}.{first_seq:012d}"
+
+    def files(self) -> List[Tuple[int, str]]:
+        """(first seq, path) of the journal files on disk, oldest first."""
+        folder, base = os.path.split(self.prefix)
+        found = []
+        for name in os.listdir(folder or "."):
+            head, _, seq = name.rpartition(".")
+            if head == base and seq.isdigit():
+                found.append((int(seq), os.path.join(folder, name)))
+        return sorted(found)
+
+    def entries(self) -> Iterator[dict]:
+        for _, path in self.files():
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # torn last write of a crashed run; nothing after it in this file
+                        log.warning("journal %s ends with a partial entry, skipping it", path)
+                        break
+
+    def delete_before(self, first_seq: int):
+        for seq, path in self.files():
+            if seq < first_seq:
+                os.remove(path)
+
+    def start(self, first_seq: int):
+        self._thread = threading.Thread(target=self._run, args=(first_seq,), name="journal", daemon=True)
+        self._thread.start()
+
+    def append(self, line: str):
+        self._queue.put(line)
+
+    def rotate(self, first_seq: int) -> threading.Event:
+        """Continue in a new file from `first_seq`; the event is set once the old one is closed."""
+        done = threading.Event()
+        self._queue.put((first_seq, done))
+        return done
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, first_seq: int):
+        f = open(self.path(first_seq), "a", encoding="utf-8")
+        synced = time.monotonic()
+        unsynced = False
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=JOURNAL_FSYNC_S)
+                except queue.Empty:
+                    item = ""
+                # write everything that's queued with one flush
+                batch = [item]
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                for item in batch:
+                    if isinstance(item, str):
+                        if item:
+                            f.write(item + "\n")
+                            unsynced = True
+                        continue
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                    unsynced = False
+                    if item is None:
+                        return
+                    next_seq, done = item
+                    f = open(self.path(next_seq), "a", encoding="utf-8")
+                    done.set()
+                f.flush()
+                if unsynced and time.monotonic() - synced >= JOURNAL_FSYNC_S:
+                    os.fsync(f.fileno())
+                    synced = time.monotonic()
+                    unsynced = False
+        except Exception:
+            log.exception("journal writer died; changes since are only in memory until the next snapshot")
+        finally:
+            if not f.closed:
+                f.close()
+
+
+class MemoryEngine(StorageEngine):
+    name = "memory"
+    blocking = False
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._snapshot_lock = threading.Lock()
+        self._qty: Dict[int, int] = {}
+        self._reserved: Dict[int, int] = {}
+        self._carts: Dict[int, Dict[int, int]] = {}  # user -> {product: qty}, in the order lines were added
+        self._expires: Dict[int, float] = {}  # user -> reservation deadline of the whole cart
+        self._expiry_heap: List[Tuple[float, int]] = []  # (deadline, user), stale entries skipped
+        # order_key() -> (id, items, created_at), and the caller's key -> its last order
+        self._orders: Dict[str, Tuple[int, List[Tuple[str, int]], float]] = {}
+        self._next_order_id = 1
+        self._seq = 0
+        # changed since the last snapshot
+        self._dirty_stock: Set[int] = set()
+        self._dirty_carts: Set[int] = set()
+        self._new_orders: List[dict] = []
+        # category -> sorted (catalog position, product) of visible products in stock, for paging
+        self._in_stock: Dict[int, List[Tuple[int, int]]] = {}
+        self._listed: Dict[int, Tuple[int, int]] = {}  # visible product -> (category, catalog position)
+        self._listed_generation = -1  # SEARCH.generation the two above were built from
+        self._journal: Optional[Journal] = None
+        self._stop = threading.Event()
+        self._snapshotter: Optional[threading.Thread] = None
+
+    # ---- lifecycle
+
+    def load(self):
+        self._journal = Journal(DB.path + ".journal")
+        with DB.read() as conn:
+            for r in conn.execute("SELECT product_id, qty, reserved FROM stock"):
+                self._qty[r["product_id"]] = r["qty"]
+                self._reserved[r["product_id"]] = r["reserved"]
+            for r in conn.execute("SELECT user_id, product_id, qty, expires_at FROM cart ORDER BY rowid"):
+                self._carts.setdefault(r["user_id"], {})[r["product_id"]] = r["qty"]
+                self._expires[r["user_id"]] = r["expires_at"]
+            for r in conn.execute(
+                "SELECT id, idempotency_key, items, created_at FROM orders WHERE idempotency_key IS NOT NULL AND created_at > ? ORDER BY id",
+                (time.time() - ORDER_KEY_TTL_S,),
+            ):
+                items = [(label, qty) for label, qty in json.loads(r["items"])]
+                self._remember_order(r["idempotency_key"], (r["id"], items, r["created_at"]))
+            self._next_order_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM orders").fetchone()[0]
+            row = conn.execute("SELECT value FROM settings WHERE key = ?", (JOURNAL_SEQ_SETTING,)).fetchone()
+        self._seq = int(row["value"]) if row else 0
+
+        replayed = 0
+        for entry in self._journal.entries():
+            if entry["s"] > self._seq:
+                self._apply(entry)
+                self._seq = entry["s"]
+                replayed += 1
+        if replayed:
+            log.info("replayed %d journal entries", replayed)
+            self._write_snapshot(self._capture())
+        self._journal.delete_before(self._seq + 1)
+        self._journal.start(self._seq + 1)
+
+        self._expiry_heap = [(deadline, user) for user, deadline in self._expires.items()]
+        heapq.heapify(self._expiry_heap)
+        # this engine is the source of truth now, the stock table only trails it
+        STOCK.watch_db = False
+        STOCK.update({pid: self._available(pid) for pid in self._qty})
+        SEARCH.warm()  # product names and flags for carts and checkout
+        self._snapshotter = threading.Thread(target=self._snapshot_loop, name="snapshot", daemon=True)
+        self._snapshotter.start()
+
+    def close(self):
+        if self._snapshotter is None:
+            return
+        self._stop.set()
+        self._snapshotter.join()
+        self._snapshotter = None
+        self.flush()
+        self._journal.stop()
+        # everything is in SQLite now
+        self._journal.delete_before(self._seq + 2)
+
+    def _snapshot_loop(self):
+        while not self._stop.wait(SNAPSHOT_S):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("snapshot failed, keeping the journal")
+
+    # ---- snapshots
+
+    def _capture(self) -> Tuple[int, Dict[int, Tuple[int, int]], Dict[int, Tuple[float, List[Tuple[int, int]]]], List[dict]]:
+        # call with the lock held: what changed since the last snapshot, as of now
+        stock = {pid: (self._qty.get(pid, 0), self._reserved.get(pid, 0)) for pid in self._dirty_stock}
+        carts = {user: (self._expires.get(user, 0.0), list(self._carts.get(user, {}).items())) for user in self._dirty_carts}
+        orders = self._new_orders
+        self._dirty_stock, self._dirty_carts, self._new_orders = set(), set(), []
+        return self._seq, stock, carts, orders
+
+    def _write_snapshot(self, captured):
+        seq, stock, carts, orders = captured
+        with DB.write() as conn:
+            conn.executemany("""
+                INSERT INTO stock(product_id, qty, reserved) VALUES(?, ?, ?)
+                ON CONFLICT(product_id) DO UPDATE SET qty = excluded.qty, reserved = excluded.reserved
+            """, [(pid, qty, reserved) for pid, (qty, reserved) in stock.items()])
+            conn.executemany("DELETE FROM cart WHERE user_id = ?", [(user,) for user in carts])
+            conn.executemany(
+                "INSERT INTO cart(user_id, product_id, qty, expires_at) VALUES(?, ?, ?, ?)",
+                [(user, pid, qty, expires) for user, (expires, lines) in carts.items() for pid, qty in lines],
+            )
+            for o in orders:
+                items = [(label, qty) for _, label, qty in o["i"]]
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO orders(id, user_id, idempotency_key, created_at, items) VALUES(?, ?, ?, ?, ?)",
+                    (o["id"], o["u"], o["k"], o["at"], json.dumps(items, ensure_ascii=False)),
+                )
+                if cur.rowcount:
+                    _record_sale(conn, o["id"], o["at"], [tuple(line) for line in o["i"]])
+                    if o.get("n"):
+                        _outbox_insert(conn, *o["n"])
+            conn.execute(
+                "INSERT INTO settings(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (JOURNAL_SEQ_SETTING, str(seq)),
+            )
+
+    def flush(self):
+        with self._snapshot_lock:
+            with self._lock:
+                if not (self._dirty_stock or self._dirty_carts or self._new_orders):
+                    return
+                captured = self._capture()
+                rotated = self._journal.rotate(captured[0] + 1)
+                cutoff = time.time() - ORDER_KEY_TTL_S
+                self._orders = {k: v for k, v in self._orders.items() if v[2] > cutoff}
+            try:
+                self._write_snapshot(captured)
+            except Exception:
+                # not in SQLite: include these again next time (their journal files stay)
+                with self._lock:
+                    self._dirty_stock |= set(captured[1])
+                    self._dirty_carts |= set(captured[2])
+                    self._new_orders[:0] = captured[3]
+                raise
+            rotated.wait()
+            self._journal.delete_before(captured[0] + 1)
+
+    # ---- journal
+
+    def _commit(self, stock: Iterable[int] = (), carts: Iterable[int] = (), orders: Iterable[dict] = ()):
+        # call with the lock held, after changing the state: journal the after-image
+        self._seq += 1
+        entry: Dict[str, Any] = {"s": self._seq}
+        stock, carts, orders = list(stock), list(carts), list(orders)
+        if stock:
+            entry["stock"] = {pid: [self._qty.get(pid, 0), self._reserved.get(pid, 0)] for pid in stock}
+            self._dirty_stock.update(stock)
+            STOCK.update({pid: self._available(pid) for pid in stock})
+            self._relist(stock)
+        if carts:
+            entry["carts"] = {user: [self._expires.get(user, 0.0), list(self._carts.get(user, {}).items())] for user in carts}
+            self._dirty_carts.update(carts)
+        if orders:
+            entry["orders"] = orders
+            self._new_orders.extend(orders)
+        self._journal.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+
+    def _apply(self, entry: dict):
+        # replay: the entry holds absolute values, so applying it is idempotent
+        for pid, (qty, reserved) in entry.get("stock", {}).items():
+            self._qty[int(pid)], self._reserved[int(pid)] = qty, reserved
+            self._dirty_stock.add(int(pid))
+        for user, (expires, lines) in entry.get("carts", {}).items():
+            user = int(user)
+            if lines:
+                self._carts[user] = {pid: qty for pid, qty in lines}
+                self._expires[user] = expires
+            else:
+                self._carts.pop(user, None)
+                self._expires.pop(user, None)
+            self._dirty_carts.add(user)
+        for o in entry.get("orders", []):
+            if o["k"] is not None:
+                self._remember_order(o["k"], (o["id"], [(label, qty) for _, label, qty in o["i"]], o["at"]))
+            self._next_order_id = max(self._next_order_id, o["id"] + 1)
+            self._new_orders.append(o)
+
+    # ---- stock
+
+    def _available(self, product_id: int) -> int:
+        return max(self._qty.get(product_id, 0) - self._reserved.get(product_id, 0), 0)
+
+    def set_stock(self, product_id: int, qty: int):
+        with self._lock:
+            self._qty[product_id] = qty
+            self._commit(stock=[product_id])
+
+    def add_stock(self, product_id: int, qty: int) -> int:
+        with self._lock:
+            if product_id not in self._qty and SEARCH.product(product_id) is None:
+                return 0
+            self._qty[product_id] = max(self._qty.get(product_id, 0) + qty, 0)
+            self._commit(stock=[product_id])
+            return self._qty[product_id]
+
+    def import_stock(self, rows: List[Tuple[int, int]], delta: bool):
+        with self._lock:
+            for pid, qty in rows:
+                self._qty[pid] = max(self._qty.get(pid, 0) + qty, 0) if delta else qty
+            self._commit(stock=[pid for pid, _ in rows])
+
+    def _relist(self, product_ids: Iterable[int]):
+        # call with the lock held: keep _in_stock in step with availability
+        if self._listed_generation != SEARCH.generation:
+            return  # catalog changed, rebuilt on the next page view
+        for pid in product_ids:
+            listed = self._listed.get(pid)
+            if listed is None:
+                continue
+            category_id, position = listed
+            items = self._in_stock.setdefault(category_id, [])
+            i = bisect.bisect_left(items, (position, pid))
+            present = i < len(items) and items[i] == (position, pid)
+            if self._available(pid) > 0 and not present:
+                items.insert(i, (position, pid))
+            elif self._available(pid) <= 0 and present:
+                del items[i]
+
+    def products_page(self, category_id: int, page: int) -> Tuple[Optional[str], List[Tuple[int, str, int]], bool]:
+        # the stock table trails this engine, so page through the in-memory in-stock lists
+        with DB.read() as conn:
+            cat = conn.execute("SELECT title FROM categories WHERE id = ? AND active = 1", (category_id,)).fetchone()
+        if not cat:
+            return None, [], False
+        with self._lock:
+            if self._listed_generation != SEARCH.generation:
+                generation = SEARCH.generation
+                self._in_stock, self._listed = {}, {}
+                for position, p in enumerate(SEARCH.visible_products()):
+                    self._listed[p.id] = (p.category_id, position)
+                    if self._available(p.id) > 0:
+                        self._in_stock.setdefault(p.category_id, []).append((position, p.id))
+                self._listed_generation = generation
+            start = page * CATALOG_PAGE_SIZE
+            listed = self._in_stock.get(category_id, [])[start:start + CATALOG_PAGE_SIZE + 1]
+            items = []
+            for _, pid in listed:
+                product = SEARCH.product(pid)
+                if product is not None:
+                    items.append((pid, product.name, self._available(pid)))
+        return cat["title"], items[:CATALOG_PAGE_SIZE], len(items) > CATALOG_PAGE_SIZE
+
+    # ---- carts
+
+    def _cart(self, user_id: int) -> Cart:
+        lines = []
+        for pid, qty in self._carts.get(user_id, {}).items():
+            product = SEARCH.product(pid)
+            if product is not None:
+                lines.append(CartLine(pid, product.name, qty, product.active))
+        return tuple(lines)
+
+    def cart_get(self, user_id: int) -> Cart:
+        with self._lock:
+            return self._cart(user_id)
+
+    def cart_adjust(self, user_id: int, product_id: int, delta: int) -> Tuple[int, Cart]:
+        with self._lock:
+            cart = self._carts.get(user_id, {})
+            current = cart.get(product_id, 0)
+            product = SEARCH.product(product_id)
+            available = self._available(product_id) if product and product.active else 0
+            new_qty = current + min(delta, available) if delta > 0 else max(current + delta, 0)
+            change = new_qty - current
+            if change:
+                cart = self._carts.setdefault(user_id, cart)
+                if new_qty:
+                    cart[product_id] = new_qty
+                else:
+                    del cart[product_id]
+                self._reserved[product_id] = max(self._reserved.get(product_id, 0) + change, 0)
+                if cart:
+                    self._expires[user_id] = deadline = time.time() + RESERVATION_TTL_S
+                    heapq.heappush(self._expiry_heap, (deadline, user_id))
+                else:
+                    del self._carts[user_id]
+                    self._expires.pop(user_id, None)
+                self._commit(stock=[product_id], carts=[user_id])
+            return change, self._cart(user_id)
+
+    def _drop_cart(self, user_id: int) -> List[int]:
+        # call with the lock held: give the cart's units back, returns the products touched
+        cart = self._carts.pop(user_id, {})
+        self._expires.pop(user_id, None)
+        for pid, qty in cart.items():
+            self._reserved[pid] = max(self._reserved.get(pid, 0) - qty, 0)
+        return list(cart)
+
+    def cart_clear(self, user_id: int):
+        with self._lock:
+            if user_id in self._carts:
+                self._commit(stock=self._drop_cart(user_id), carts=[user_id])
+
+    def release_expired(self, limit: int) -> int:
+        released = 0
+        with self._lock:
+            now = time.time()
+            stock: Set[int] = set()
+            users: List[int] = []
+            while self._expiry_heap and self._expiry_heap[0][0] <= now and released < limit:
+                deadline, user = heapq.heappop(self._expiry_heap)
+                if self._expires.get(user) != deadline:
+                    continue  # renewed or gone since
+                released += len(self._carts.get(user, {}))
+                stock.update(self._drop_cart(user))
+                users.append(user)
+            if users:
+                self._commit(stock=stock, carts=users)
+        RESERVATIONS_EXPIRED.inc(amount=released)
+        return released
+
+    # ---- checkout
+
+    def _remember_order(self, key: str, order: Tuple[int, List[Tuple[str, int]], float]):
+        self._orders[key] = order
+        self._orders[key.partition("#")[0]] = order
+
+    def _checkout_one(self, user_id: int, key: Optional[str], notice: Optional[OrderNotice]) -> CheckoutResult:
+        if key is not None:
+            cart = self._carts.get(user_id)
+            if cart:
+                key = order_key(key, cart.items(), self._expires[user_id])
+            if key in self._orders:
+                order_id, items, _ = self._orders[key]
+                return CheckoutResult(True, "OK", items, order_id, replayed=True)
+
+        lines = []
+        for pid, qty in self._carts.get(user_id, {}).items():
+            product = SEARCH.product(pid)
+            if product is not None:
+                lines.append((pid, product, qty))
+        items = [(product.label, qty) for _, product, qty in lines]
+        if not items:
+            return CheckoutResult(False, "Корзина пуста.", [])
+        for pid, product, qty in lines:
+            available = self._qty.get(pid, 0) if product.active else 0
+            if qty > available:
+                return CheckoutResult(False, f"Немає в наявності достатньо: {product.label} (потрібно {qty}, є {available}).", items)
+
+        for pid, _, qty in lines:
+            self._qty[pid] -= qty
+            self._reserved[pid] = max(self._reserved.get(pid, 0) - qty, 0)
+        self._carts.pop(user_id, None)
+        self._expires.pop(user_id, None)
+        order_id, self._next_order_id = self._next_order_id, self._next_order_id + 1
+        order = {"id": order_id, "u": user_id, "k": key, "at": time.time(),
+                 "i": [[pid, product.label, qty] for pid, product, qty in lines]}
+        if notice is not None:
+            # journaled with the order; the snapshot that writes the order queues it
+            order["n"] = list(notice(items))
+        if key is not None:
+            self._remember_order(key, (order_id, items, order["at"]))
+        self._commit(stock=[pid for pid, _, _ in lines], carts=[user_id], orders=[order])
+        return CheckoutResult(True, "OK", items, order_id)
+
+    def checkout_batch(self, requests: List[CheckoutRequest]) -> List[CheckoutResult]:
+        results = []
+        with self._lock:
+            for user_id, key, notice in (CheckoutRequest(*r) for r in requests):
+                res = self._checkout_one(user_id, key, notice)
+                CHECKOUTS.inc("replayed" if res.replayed else "ok" if res.ok else "out_of_stock" if res.items else "empty")
+                results.append(res)
+        return results
+
+
+STORAGE_ENGINES: Dict[str, Callable[[], StorageEngine]] = {"sqlite": SQLiteEngine, "memory": MemoryEngine}
+
+def make_engine(name: str = STORAGE_ENGINE) -> StorageEngine:
+    if name not in STORAGE_ENGINES:
+        raise RuntimeError(f"STORAGE_ENGINE must be one of: {', '.join(STORAGE_ENGINES)}")
+    return STORAGE_ENGINES[name]()
+
+
+# =========================
+# Async data access
+# =========================
+DB_WORKERS = int(os.environ.get("DB_WORKERS", str(DB_READERS)))
+DB_QUEUE_SIZE = int(os.environ.get("DB_QUEUE_SIZE", "256"))  # max DB calls queued or running
+DB_SLOW_CALL_MS = float(os.environ.get("DB_SLOW_CALL_MS", "200"))
+
+
+CHECKOUT_BATCH_MAX = int(os.environ.get("CHECKOUT_BATCH_MAX", "64"))
+
+
+class CheckoutEngine:
+    """
+    Group commit for checkouts. While one batch is being written, new
+    requests queue up and go out together in the next transaction, in
+    arrival order; each caller gets its own result back.
+    """
+
+    def __init__(self, run_batch: Callable[[List[CheckoutRequest]], Awaitable[List[CheckoutResult]]],
+                 max_batch: int = CHECKOUT_BATCH_MAX):
+        self._run_batch = run_batch
+        self._max_batch = max(1, max_batch)
+        self._pending: List[Tuple[CheckoutRequest, asyncio.Future]] = []
+        self._drainer: Optional[asyncio.Task] = None
+
+    async def checkout(self, user_id: int, key: Optional[str] = None, notice: Optional[OrderNotice] = None) -> CheckoutResult:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((CheckoutRequest(user_id, key, notice), fut))
+        if self._drainer is None:
+            self._drainer = asyncio.create_task(self._drain())
+        started = time.perf_counter()
+        try:
+            return await fut
+        finally:
+            # the batch runs in the drainer's task; its DB time is this caller's wait
+            TRACER.add_db(time.perf_counter() - started)
+
+    async def _drain(self):
+        # the task inherited the trace of whichever update started it; batches
+        # belong to every caller, not to that one
+        _current_trace.set(None)
+        try:
+            while self._pending:
+                batch = self._pending[:self._max_batch]
+                del self._pending[:self._max_batch]
+                try:
+                    results = await self._run_batch([request for request, _ in batch])
+                except Exception as e:
+                    results = [CheckoutResult(False, f"Помилка оформлення: {e}", [])] * len(batch)
+                for (_, fut), res in zip(batch, results):
+                    if not fut.done():
+                        fut.set_result(res)
+        finally:
+            self._drainer = None
+
+
+class Store:
+    """
+    Async facade over the DB helpers above. Calls run on a small pool of DB
+    threads so a slow write never blocks the event loop; at most
+    `queue_size` calls may be pending, further callers wait for a slot.
+    """
+
+    def __init__(self, engine: Optional[StorageEngine] = None, workers: int = DB_WORKERS, queue_size: int = DB_QUEUE_SIZE):
+        self.engine = engine or SQLiteEngine()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="db")
+        self._queue_size = max(1, queue_size)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._checkout = CheckoutEngine(lambda requests: self._engine(self.engine.checkout_batch, requests))
+
+    def _record(self, name: str, wait: float, elapsed: float):
+        DB_CALL_SECONDS.observe(elapsed, name)
+        DB_WAIT_SECONDS.observe(wait, name)
+        TRACER.add_db(wait + elapsed)
+        if (wait + elapsed) * 1000 >= DB_SLOW_CALL_MS:
+            log.warning("slow db call %s: wait %.1f ms, run %.1f ms", name, wait * 1000, elapsed * 1000)
+
+    async def call(self, fn: Callable[..., Any], *args) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._queue_size)
+        queued = time.perf_counter()
+        timing: List[float] = []
+
+        def run():
+            started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                timing.append(started - queued)
+                timing.append(time.perf_counter() - started)
+
+        async with self._slots:
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, run)
+            finally:
+                if timing:
+                    self._record(fn.__name__, timing[0], timing[1])
+
+    async def _engine(self, fn: Callable[..., Any], *args) -> Any:
+        # storage engine call: in-memory engines answer right here on the loop
+        if self.engine.blocking:
+            return await self.call(fn, *args)
+        # they read product names and flags from SEARCH: after a catalog change
+        # (admin command, stock import, another process) rebuild it on a DB thread
+        while not SEARCH.ready():
+            await self.call(SEARCH.warm)
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._record(fn.__name__, 0.0, time.perf_counter() - started)
+
+    async def _catalog_changed(self):
+        # in-memory engines read product names from SEARCH; rebuild it here, not on the loop
+        if not self.engine.blocking:
+            await self.call(SEARCH.warm)
+
+    def close(self):
+        self.engine.close()
+        self._executor.shutdown(wait=True)
+
+    # stock reads are served from STOCK on the event loop; only the periodic
+    # external-change check goes to a DB thread
+    async def _read_stock(self, name: str, read: Callable[[], Any]) -> Any:
+        started = time.perf_counter()
+        if STOCK.recheck_due():
+            await self.call(sync_stock_cache)
+        value = read()
+        elapsed = time.perf_counter() - started
+        DB_CALL_SECONDS.observe(elapsed, name)
+        TRACER.add_db(elapsed)
+        return value
+
+    async def get_stock(self, product_id: int) -> int:
+        return await self._read_stock("get_stock", lambda: STOCK.get(product_id))
+
+    async def stock_version(self) -> int:
+        return await self._read_stock("stock_version", lambda: STOCK.version)
+
+    async def set_stock(self, product_id: int, qty: int):
+        return await self._engine(self.engine.set_stock, product_id, qty)
+
+    async def add_stock(self, product_id: int, qty: int) -> int:
+        return await self._engine(self.engine.add_stock, product_id, qty)
+
+    async def import_stock(self, rows: List[Tuple[int, int]], delta: bool):
+        return await self._engine(self.engine.import_stock, rows, delta)
+
+    async def get_product(self, product_id: int) -> Optional[Product]:
+        return await self.call(get_product, product_id)
+
+    async def find_products(self, names: List[str]) -> Dict[str, List[Product]]:
+        return await self.call(find_products, names)
+
+    async def search_products(self, query: str, limit: int) -> List[Tuple[Product, int]]:
+        return await self.call(search_products, query, limit)
+
+    async def suggest_products(self, name: str, limit: int) -> List[Tuple[Product, int]]:
+        # admin lookups: hidden and sold-out products count too
+        return await self.call(SEARCH.search, name, limit, False)
+
+    async def categories_page(self, page: int) -> Tuple[List[Tuple[int, str]], bool]:
+        return await self.call(categories_page, page)
+
+    async def products_page(self, category_id: int, page: int) -> Tuple[Optional[str], List[Tuple[int, str, int]], bool]:
+        return await self.call(self.engine.products_page, category_id, page)
+
+    # admin listings and reports read the SQLite tables: bring them up to date first
+    async def catalog_summary(self) -> List[sqlite3.Row]:
+        await self.call(self.engine.flush)
+        return await self.call(catalog_summary)
+
+    async def catalog_products(self, category_id: Optional[int] = None) -> List[sqlite3.Row]:
+        await self.call(self.engine.flush)
+        return await self.call(catalog_products, category_id)
+
+    async def add_category(self, title: str) -> int:
+        category_id = await self.call(add_category, title)
+        await self._catalog_changed()
+        return category_id
+
+    async def add_product(self, category_id: int, name: str, description: Optional[str] = None) -> Optional[int]:
+        product_id = await self.call(add_product, category_id, name, description)
+        await self._catalog_changed()
+        return product_id
+
+    async def set_product_active(self, product_id: int, active: bool) -> bool:
+        changed = await self.call(set_product_active, product_id, active)
+        await self._catalog_changed()
+        return changed
+
+    async def cart_get(self, user_id: int) -> Cart:
+        return await self._engine(self.engine.cart_get, user_id)
+
+    async def cart_adjust(self, user_id: int, product_id: int, delta: int) -> Tuple[int, Cart]:
+        return await self._engine(self.engine.cart_adjust, user_id, product_id, delta)
+
+    async def cart_clear(self, user_id: int):
+        return await self._engine(self.engine.cart_clear, user_id)
+
+    async def release_expired(self, limit: int) -> int:
+        return await self._engine(self.engine.release_expired, limit)
+
+    async def checkout(self, user_id: int, key: Optional[str] = None, notice: Optional[OrderNotice] = None) -> CheckoutResult:
+        res = await self._checkout.checkout(user_id, key, notice)
+        if notice is not None and res.ok and not res.replayed and not self.engine.blocking:
+            # the notice reaches the outbox table with the order's snapshot: take one now
+            try:
+                await self.call(self.engine.flush)
+            except Exception:
+                log.exception("snapshot after checkout failed; the order's notice waits for the next one")
+        return res
+
+    async def sales_report(self, days: int) -> SalesReport:
+        await self.call(self.engine.flush)
+        return await self.call(sales_report, days)
+
+    async def set_setting(self, key: str, value: Optional[str]):
+        return await self.call(set_setting, key, value)
+
+
+store = Store(make_engine())
+
+
+# =========================
+# Callback data
+# =========================
+# Format: "<version>:<action>[:<arg>]", products are referenced by their DB
+# id because Telegram caps callback_data at 64 bytes and Cyrillic names take
+# 2 bytes per letter. Pages are "<category id>.<page>".
+# Bump CB_VERSION when the format changes; buttons from older messages then
+# get a "button expired" answer instead of doing something unexpected.
+# The seeded catalog keeps the old FLAVORS positions as product ids, so
+# buttons sent before the catalog moved to the DB keep working.
+CB_VERSION = "1"
+CB_MAX_BYTES = 64
+
+def cb(action: str, arg: Any = None) -> str:
+    data = f"{CB_VERSION}:{action}" if arg is None else f"{CB_VERSION}:{action}:{arg}"
+    if len(data.encode("utf-8")) > CB_MAX_BYTES:
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+def parse_id(arg: str) -> Optional[int]:
+    return int(arg) if arg.isdigit() else None
+
+def parse_page(arg: str) -> Optional[Tuple[int, int]]:
+    """"<id>.<page>" -> (id, page)"""
+    parent, _, page = arg.partition(".")
+    return (int(parent), int(page)) if parent.isdigit() and page.isdigit() else None
+
+
+# =========================
+# UI builders
+# =========================
+# Markups are immutable in PTB 20, so built ones are reused as-is across
+# updates: static keyboards once, dynamic ones through small LRU caches.
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "512"))
+INLINE_SEARCH = False  # set at startup if inline mode is enabled in @BotFather
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Any:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def get_or_build(self, key, build: Callable[[], Any]):
+        value = self.get(key)
+        return value if value is not None else self.put(key, build())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_page_cache = LRUCache(maxsize=64)  # catalog pages, keyed by stock version
+_cart_cache = LRUCache()
+
+@lru_cache(maxsize=None)
+def back_to_menu_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Меню", callback_data=cb("menu"))]])
+
+def pager_row(page_cb: Callable[[int], str], page: int, has_next: bool) -> List[InlineKeyboardButton]:
+    if page == 0 and not has_next:
+        return []
+    row = []
+    if page > 0:
+        row.append(InlineKeyboardButton("◀️", callback_data=page_cb(page - 1)))
+    row.append(InlineKeyboardButton(f"стор. {page + 1}", callback_data=cb("noop")))
+    if has_next:
+        row.append(InlineKeyboardButton("▶️", callback_data=page_cb(page + 1)))
+    return row
+
+def categories_kb(categories: List[Tuple[int, str]], page: int, has_next: bool) -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(title, callback_data=cb("cat", f"{cid}.0"))] for cid, title in categories]
+    nav = pager_row(lambda p: cb("mpage", p), page, has_next)
+    if nav:
+        buttons.append(nav)
+    if INLINE_SEARCH:
+        buttons.append([InlineKeyboardButton("🔎 Пошук смаку", switch_inline_query_current_chat="")])
+    buttons.append([InlineKeyboardButton("🧺 Корзина", callback_data=cb("cart"))])
+    return InlineKeyboardMarkup(buttons)
+
+def products_kb(category_id: int, items: List[Tuple[int, str, int]], page: int, has_next: bool) -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(f"{name} ({qty} шт.)", callback_data=cb("fl", pid))] for pid, name, qty in items]
+    nav = pager_row(lambda p: cb("cat", f"{category_id}.{p}"), page, has_next)
+    if nav:
+        buttons.append(nav)
+    buttons.append([InlineKeyboardButton("⬅️ Меню", callback_data=cb("menu"))])
+    buttons.append([InlineKeyboardButton("🧺 Корзина", callback_data=cb("cart"))])
+    return InlineKeyboardMarkup(buttons)
+
+# Each page reads only its own LIMIT/OFFSET slice, so render time and the
+# cache footprint don't depend on catalog size.
+async def main_menu_view(page: int = 0) -> InlineKeyboardMarkup:
+    key = ("menu", await store.stock_version(), page)
+    kb = _page_cache.get(key)
+    if kb is None:
+        categories, has_next = await store.categories_page(page)
+        kb = _page_cache.put(key, categories_kb(categories, page, has_next))
+    return kb
+
+async def category_view(category_id: int, page: int) -> Tuple[Optional[str], bool, InlineKeyboardMarkup]:
+    """(category title or None if it's gone, anything on this page?, keyboard)"""
+    key = ("cat", await store.stock_version(), category_id, page)
+    view = _page_cache.get(key)
+    if view is None:
+        title, items, has_next = await store.products_page(category_id, page)
+        view = _page_cache.put(key, (title, bool(items), products_kb(category_id, items, page, has_next)))
+    return view
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def product_actions_kb(product_id: int, category_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("➕ В корзину", callback_data=cb("add", product_id))],
+        [InlineKeyboardButton("🧺 Корзина", callback_data=cb("cart"))],
+        [InlineKeyboardButton("⬅️ Назад", callback_data=cb("cat", f"{category_id}.0"))],
+    ])
+
+def cart_kb(cart: Cart) -> InlineKeyboardMarkup:
+    rows = []
+    for line in cart:
+        label = InlineKeyboardButton(f"{line.name} × {line.qty}", callback_data=cb("noop"))
+        if not line.active:
+            # no longer sold: can only be removed with "Очистити"
+            rows.append([label])
+            continue
+        rows.append([
+            InlineKeyboardButton("➖", callback_data=cb("dec", line.product_id)),
+            label,
+            InlineKeyboardButton("➕", callback_data=cb("inc", line.product_id)),
+        ])
+    if cart:
+        rows.append([InlineKeyboardButton("✅ Замовити", callback_data=cb("order"))])
+        rows.append([InlineKeyboardButton("🗑 Очистити", callback_data=cb("clear"))])
+    rows.append([InlineKeyboardButton("⬅️ Меню", callback_data=cb("menu"))])
+    return InlineKeyboardMarkup(rows)
+
+def cart_text(cart: Cart) -> str:
+    lines = ["🧺 **Твоя корзина:**", ""]
+    for line in cart:
+        lines.append(f"• {escape_markdown(line.name)} × {line.qty}")
+    lines.append("")
+    lines.append(f"⏳ Товари зарезервовано на {max(1, round(RESERVATION_TTL_S / 60))} хв після останньої зміни.")
+    return "\n".join(lines)
+
+def cart_view(cart: Cart) -> Tuple[str, InlineKeyboardMarkup]:
+    """(text, keyboard) for a non-empty cart, cached by cart contents."""
+    return _cart_cache.get_or_build(cart, lambda: (cart_text(cart), cart_kb(cart)))
+
+# =========================
+# Helpers
+# =========================
+async def safe_answer(query, text=""):
+    try:
+        await query.answer(text=text)
+    except BadRequest as e:
+        # "query is too old": the spinner is long gone, nothing left to do
+        log.debug("callback answer failed: %s", e)
+    except Exception:
+        log.warning("callback answer failed", exc_info=True)
+
+def user_profile_text(u) -> str:
+    """Markdown: names and username are the customer's own text, so they're escaped."""
+    # tg deep link works even without username
+    link = f"tg://user?id={u.id}"
+    name = escape_markdown(" ".join([x for x in [u.first_name, u.last_name] if x]) or "Без імені")
+    username = escape_markdown(f"@{u.username}") if u.username else "немає username"
+    return f"👤 Клієнт: {name}\n🔗 Профіль: {link}\n🆔 ID: {u.id}\n👤 Username: {username}"
+
+def order_text(items: List[Tuple[str,int]]) -> str:
+    lines = ["🧾 **Нове замовлення**", ""]
+    for f, q in items:
+        lines.append(f"• {escape_markdown(f)} × {q}")
+    return "\n".join(lines)
+
+
+# =========================
+# Message edits
+# =========================
+# Rapid ➕/➖ taps change the cart right away, but the message is edited
+# once, after the taps stop. Anything else that edits the message goes
+# through edit_message(), which drops the pending edit so it can't land
+# on top of a newer screen.
+EDIT_DEBOUNCE_S = float(os.environ.get("EDIT_DEBOUNCE_S", "0.4"))  # quiet time before the edit goes out
+EDIT_MAX_DELAY_S = 1.5  # while tapping non-stop, still show progress this often
+
+MessageKey = Union[Tuple[int, int], str]
+
+
+class EditDebouncer:
+    """
+    Per-message trailing edits: the latest content wins, a newer schedule()
+    cancels the edit it supersedes, and content equal to what the message
+    already shows is not sent at all.
+    """
+
+    def __init__(self, delay: float = EDIT_DEBOUNCE_S, max_delay: float = EDIT_MAX_DELAY_S):
+        self.delay = delay
+        self.max_delay = max_delay
+        self._pending: Dict[MessageKey, Tuple[Callable[..., Awaitable[Any]], str, Dict[str, Any]]] = {}
+        self._timers: Dict[MessageKey, asyncio.Task] = {}
+        self._first: Dict[MessageKey, float] = {}
+        self._shown = LRUCache()  # key -> (text, kwargs) last sent
+
+    def schedule(self, key: MessageKey, edit: Callable[..., Awaitable[Any]], text: str, **kwargs):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        first = self._first.setdefault(key, now)
+        self._pending[key] = (edit, text, kwargs)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+            MESSAGE_EDITS.inc("superseded")
+        wait = min(self.delay, max(0.0, first + self.max_delay - now))
+        self._timers[key] = loop.create_task(self._fire(key, wait))
+
+    def cancel(self, key: MessageKey):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+            MESSAGE_EDITS.inc("superseded")
+        self._pending.pop(key, None)
+        self._first.pop(key, None)
+
+    def shown(self, key: MessageKey, text: str, kwargs: Dict[str, Any]):
+        """Record content that was put on the message some other way."""
+        self._shown.put(key, (text, kwargs))
+
+    async def _fire(self, key: MessageKey, wait: float):
+        await asyncio.sleep(wait)
+        # from here on the edit is committed, a newer schedule() starts its own timer
+        self._timers.pop(key, None)
+        self._first.pop(key, None)
+        edit, text, kwargs = self._pending.pop(key)
+        await self._send(key, edit, text, kwargs)
+
+    async def _send(self, key: MessageKey, edit: Callable[..., Awaitable[Any]], text: str, kwargs: Dict[str, Any]):
+        if self._shown.get(key) == (text, kwargs):
+            MESSAGE_EDITS.inc("unchanged")
+            return
+        try:
+            await edit(text, **kwargs)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                log.warning("debounced edit failed: %s", e)
+            MESSAGE_EDITS.inc("failed")
+            return
+        except Exception:
+            log.exception("debounced edit failed")
+            MESSAGE_EDITS.inc("failed")
+            return
+        MESSAGE_EDITS.inc("sent")
+        self.shown(key, text, kwargs)
+
+    async def flush(self):
+        """Send everything pending now (shutdown, benchmarks)."""
+        for key in list(self._timers):
+            # an earlier _send() yielded: this one may have fired meanwhile
+            timer = self._timers.pop(key, None)
+            if timer is None:
+                continue
+            timer.cancel()
+            self._first.pop(key, None)
+            edit, text, kwargs = self._pending.pop(key)
+            await self._send(key, edit, text, kwargs)
+
+
+edits = EditDebouncer()
+
+def message_key(query) -> MessageKey:
+    if query.message is not None:
+        return (query.message.chat.id, query.message.message_id)
+    return query.inline_message_id
+
+def text_editor(query) -> Callable[..., Awaitable[Any]]:
+    """
+    Edits the text of the message under `query`. A photo message (the
+    product card) has no text to edit, so it's replaced by a new text
+    message instead.
+    """
+    message = query.message
+    if message is None or not message.photo:
+        return query.edit_message_text
+
+    async def replace(text: str, **kwargs):
+        await message.reply_text(text, **kwargs)
+        try:
+            await message.delete()
+        except TelegramError as e:
+            # too old to delete or already gone: it just stays above the new one
+            log.info("couldn't delete the photo message: %s", e)
+    return replace
+
+async def edit_message(query, text: str, **kwargs):
+    """text_editor(query) that also drops a debounced edit of the same message."""
+    key = message_key(query)
+    edits.cancel(key)
+    await text_editor(query)(text, **kwargs)
+    edits.shown(key, text, kwargs)
+
+
+# =========================
+# Outgoing rate limiting
+# =========================
+# Telegram flood limits: ~30 messages/s overall, ~1/s in one private chat,
+# 20/min in a group. All Bot API calls pass through FloodLimiter, so
+# replies and edits queue up instead of getting 429s.
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.environ.get("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = float(os.environ.get("TG_CHAT_BURST", "3"))
+TG_GROUP_RATE = 20 / 60
+TG_MAX_RETRIES = 3
+# not tied to a chat's message flow
+TG_UNLIMITED_ENDPOINTS = {"answerCallbackQuery", "answerInlineQuery", "getMe", "getUpdates", "setWebhook", "deleteWebhook"}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token; returns how long to wait before it may be used."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        # tokens may go negative: each waiter gets its own slot in the future
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class FloodLimiter(BaseRateLimiter):
+    """Global + per-chat token buckets; waits out RetryAfter and tries again."""
+
+    def __init__(self, max_retries: int = TG_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10_000:
+                now = time.monotonic()
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            is_group = isinstance(chat_id, str) or int(chat_id) < 0
+            bucket = TokenBucket(TG_GROUP_RATE, 1) if is_group else TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        limited = endpoint not in TG_UNLIMITED_ENDPOINTS
+        for attempt in range(self.max_retries + 1):
+            delay = self._paused_until - time.monotonic()
+            if limited:
+                delay = max(delay, self._global.reserve())
+                if chat_id is not None:
+                    delay = max(delay, self._chat_bucket(chat_id).reserve())
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                delay = 0.0
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                TG_API_ERRORS.inc(endpoint, "RetryAfter")
+                if attempt == self.max_retries:
+                    raise
+                log.warning("flood limit on %s (chat %s), retrying in %ss", endpoint, chat_id, e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + float(e.retry_after))
+            except Exception as e:
+                TG_API_ERRORS.inc(endpoint, type(e).__name__)
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                TG_API_SECONDS.observe(elapsed, endpoint)
+                TRACER.add_tg(elapsed, delay)
+
+
+# =========================
+# Admin outbox
+# =========================
+# Admin notifications are written to the outbox table first and delivered
+# by a background task, so a Telegram error never loses an order message.
+# When several are waiting for the same chat they go out as one digest.
+OUTBOX_POLL_S = 10.0
+OUTBOX_BATCH = 100
+OUTBOX_DIGEST_AFTER = int(TG_CHAT_BURST)  # more pending than one chat burst -> digest
+OUTBOX_MAX_BACKOFF_S = 600
+TG_MESSAGE_LIMIT = 4096
+
+
+def outbox_digests(rows: List[sqlite3.Row]) -> List[Tuple[List[int], str, Optional[str]]]:
+    """Pack pending rows of one chat into as few messages as fit Telegram's size limit."""
+    if len(rows) <= OUTBOX_DIGEST_AFTER:
+        return [([r["id"]], r["text"], r["parse_mode"]) for r in rows]
+
+    sep = "\n\n———\n\n"
+    out: List[Tuple[List[int], str, Optional[str]]] = []
+    batch: List[sqlite3.Row] = []
+    size = 0
+
+    def pack():
+        text = batch[0]["text"] if len(batch) == 1 else \
+            f"📬 Повідомлень: {len(batch)}{sep}" + sep.join(r["text"] for r in batch)
+        out.append(([r["id"] for r in batch], text, batch[0]["parse_mode"]))
+
+    for r in rows:
+        too_big = size + len(sep) + len(r["text"]) > TG_MESSAGE_LIMIT - 64
+        if batch and (too_big or r["parse_mode"] != batch[0]["parse_mode"]):
+            pack()
+            batch, size = [], 0
+        batch.append(r)
+        size += len(sep) + len(r["text"])
+    pack()
+    return out
+
+
+class Outbox:
+    def __init__(self):
+        self._bot = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot):
+        self._bot = bot
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def send(self, chat_id: int, text: str, parse_mode: Optional[str] = None):
+        await store.call(outbox_add, chat_id, text, parse_mode)
+        self.wake()
+
+    def wake(self):
+        """Deliver what's due now instead of at the next poll."""
+        if self._wake is not None:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                more = await self.flush()
+            except Exception:
+                log.exception("outbox flush failed")
+                more = False
+            if more:
+                continue
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_S)
+
+    async def flush(self) -> bool:
+        """Deliver what's due; True if there may be more waiting."""
+        rows = await store.call(outbox_due, OUTBOX_BATCH)
+        by_chat: Dict[int, List[sqlite3.Row]] = {}
+        for r in rows:
+            by_chat.setdefault(r["chat_id"], []).append(r)
+        for chat_id, chat_rows in by_chat.items():
+            attempts = max(r["attempts"] for r in chat_rows)
+            for ids, text, parse_mode in outbox_digests(chat_rows):
+                try:
+                    await self._send(chat_id, text, parse_mode)
+                except (BadRequest, Forbidden) as e:
+                    # retrying won't help (chat gone, bot blocked, ...): drop it, keep the rest moving;
+                    # the order itself is in the orders table
+                    OUTBOX_UNDELIVERABLE.inc(amount=len(ids))
+                    log.error("outbox: %s rejected for good (%s), dropping:\n%s", chat_id, e, text)
+                except TelegramError as e:
+                    delay = min(2 ** attempts * 5, OUTBOX_MAX_BACKOFF_S)
+                    log.warning("outbox: sending to %s failed (%s), retry in %ss", chat_id, e, delay)
+                    await store.call(outbox_retry, ids, delay)
+                    break  # keep this chat's messages in order
+                await store.call(outbox_done, ids)
+        return len(rows) == OUTBOX_BATCH
+
+    async def _send(self, chat_id: int, text: str, parse_mode: Optional[str]):
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+        except BadRequest as e:
+            if parse_mode is None or "parse entities" not in str(e):
+                raise
+            # markup Telegram can't parse: better unformatted than never
+            log.warning("outbox: %s markup rejected (%s), sending as plain text", chat_id, e)
+            await self._bot.send_message(chat_id=chat_id, text=text)
+
+
+outbox = Outbox()
+
+
+# =========================
+# Reservation sweeper
+# =========================
+# Cart lines reserve stock until RESERVATION_TTL_S after the user's last
+# change. A JobQueue job gives expired ones back, in batches of its own
+# transaction so the writer is never held for long.
+RESERVATION_SWEEP_S = float(os.environ.get("RESERVATION_SWEEP_S", "60"))
+RESERVATION_SWEEP_BATCH = 500
+RESERVATION_SWEEP_MAX_BATCHES = 20  # per run; the rest waits for the next one
+
+
+async def sweep_reservations(context: ContextTypes.DEFAULT_TYPE):
+    released = 0
+    for _ in range(RESERVATION_SWEEP_MAX_BATCHES):
+        n = await store.release_expired(RESERVATION_SWEEP_BATCH)
+        released += n
+        if n < RESERVATION_SWEEP_BATCH:
+            break
+    if released:
+        log.info("released %d expired cart lines", released)
+
+def schedule_sweeper(app):
+    if app.job_queue is None:
+        log.error("JobQueue unavailable (pip install 'python-telegram-bot[job-queue]'): expired carts won't be released")
+        return
+    # first run right away picks up whatever expired while the bot was down
+    app.job_queue.run_repeating(sweep_reservations, interval=RESERVATION_SWEEP_S, first=1, name="reservations")
+
+
+# =========================
+# Product photo (file_id cache)
+# =========================
+# Telegram keeps every uploaded file and hands back a file_id; sending that
+# id again costs nothing. Priority: PHOTO_URL > /setphoto > PHOTO_PATH upload.
+PHOTO_SETTING = "photo_file_id"  # set by /setphoto
+
+_asset_keys: Dict[str, Optional[str]] = {}
+_photo_upload_lock = asyncio.Lock()
+
+def asset_key(path: str) -> Optional[str]:
+    """settings key for an asset's file_id: path + content hash (None if the file is missing)."""
+    if path not in _asset_keys:
+        try:
+            with open(path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:16]
+            _asset_keys[path] = f"file_id:{path}:{digest}"
+        except OSError:
+            _asset_keys[path] = None
+    return _asset_keys[path]
+
+def cached_photo() -> Tuple[Optional[str], Optional[str]]:
+    """(photo to send as URL/file_id, or None; settings key to capture an upload into)"""
+    if PHOTO_URL:
+        return PHOTO_URL, None
+    file_id = get_setting(PHOTO_SETTING)
+    if file_id:
+        return file_id, PHOTO_SETTING
+    key = asset_key(PHOTO_PATH)
+    if key is None:
+        return None, None
+    return get_setting(key), key
+
+async def send_product_photo(send: Callable[..., Awaitable[Any]], **kwargs) -> bool:
+    """
+    Send the product photo via `send` (send_photo / reply_photo) with kwargs.
+    Uploads PHOTO_PATH only when no file_id is known yet. False if nothing was sent.
+    """
+    photo, key = cached_photo()
+    if photo is None and key is not None:
+        async with _photo_upload_lock:
+            photo, key = cached_photo()  # someone else may have just uploaded it
+            if photo is None:
+                with open(PHOTO_PATH, "rb") as f:
+                    msg = await send(photo=InputFile(f), **kwargs)
+                if msg is not None and getattr(msg, "photo", None):
+                    await store.set_setting(key, msg.photo[-1].file_id)
+                return True
+    if photo is None:
+        return False
+    try:
+        await send(photo=photo, **kwargs)
+    except BadRequest:
+        # stale file_id (e.g. bot token changed): forget it, re-upload next time
+        if key is not None:
+            log.warning("cached photo %s rejected by Telegram, dropping it", key)
+            await store.set_setting(key, None)
+        raise
+    return True
+
+async def send_product_photo_if_exists(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await send_product_photo(update.effective_chat.send_photo)
+    except Exception:
+        log.exception("failed to send product photo")
+
+
+# =========================
+# Commands
+# =========================
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # t.me/<bot>?start=p<id> from an inline search result opens that product
+    if context.args and re.fullmatch(r"p\d+", context.args[0]):
+        if await send_product_card(update.message, int(context.args[0][1:])):
+            return
+        await update.message.reply_text("Цього смаку вже нема в наявності 😕")
+
+    await send_product_photo_if_exists(update, context)
+    await update.message.reply_text(
+        f"Привіт! 👋\nВибери товар:",
+        reply_markup=await main_menu_view()
+    )
+
+async def send_product_card(message, product_id: int) -> bool:
+    """Reply with the product card (photo if there is one); False if it's gone or sold out."""
+    product = await store.get_product(product_id)
+    if product is None or not product.active or await store.get_stock(product_id) <= 0:
+        return False
+    text = product_description(product.category, product.name, product.description)
+    kb = product_actions_kb(product.id, product.category_id)
+    try:
+        if await send_product_photo(message.reply_photo, caption=text, parse_mode="Markdown", reply_markup=kb):
+            return True
+    except Exception:
+        log.exception("failed to send product photo")
+    await message.reply_text(text, parse_mode="Markdown", reply_markup=kb)
+    return True
+
+def timed_command(name: str, fn: Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]):
+    async def run(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            await fn(update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, "command", name)
+    return run
+
+def is_admin(update: Update) -> bool:
+    return update.effective_user and update.effective_user.id == ADMIN_CHAT_ID_INT
+
+async def cmd_setphoto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    # Usage: reply to a photo with /setphoto; "/setphoto -" resets to PHOTO_PATH
+    if context.args and context.args[0] == "-":
+        await store.set_setting(PHOTO_SETTING, None)
+        await update.message.reply_text("✅ Фото скинуто, використовую файл за замовчуванням.")
+        return
+
+    src = update.message.reply_to_message
+    if not src or not src.photo:
+        await update.message.reply_text("Надішли фото і дай на нього відповідь командою /setphoto")
+        return
+
+    await store.set_setting(PHOTO_SETTING, src.photo[-1].file_id)
+    note = "\n⚠️ Задано PHOTO_URL — воно має пріоритет." if PHOTO_URL else ""
+    await update.message.reply_text("✅ Фото збережено." + note)
+
+def split_message(lines: List[str], limit: int = 4096) -> List[str]:
+    """Join lines into as few messages as fit Telegram's length limit."""
+    chunks: List[str] = []
+    cur: List[str] = []
+    size = 0
+    for line in lines:
+        if cur and size + len(line) + 1 > limit:
+            chunks.append("\n".join(cur))
+            cur, size = [], 0
+        cur.append(line)
+        size += len(line) + 1
+    if cur:
+        chunks.append("\n".join(cur))
+    return chunks
+
+async def resolve_product(update: Update, name: str) -> Optional[Product]:
+    """The one product an admin meant by `name` (or "#id"); replies and returns None otherwise."""
+    found = (await store.find_products([name]))[name]
+    if not found:
+        # not a whole name: accept a unique prefix ("виш мен"), only suggest typo matches
+        close = await store.suggest_products(name, 5)
+        if len(close) == 1 and close[0][1] == 0:
+            return close[0][0]
+        if not close:
+            await update.message.reply_text("Не знайшов такий смак. Перевір написання.")
+            return None
+        options = "\n".join(f"#{p.id} {p.label}" for p, _ in close)
+        await update.message.reply_text(f"Точного збігу немає, можливо:\n{options}\nВкажи id, наприклад #{close[0][0].id}")
+        return None
+    if len(found) > 1:
+        options = "\n".join(f"#{p.id} {p.label}" for p in found)
+        await update.message.reply_text(f"Таких товарів кілька, вкажи id:\n{options}")
+        return None
+    return found[0]
+
+async def cmd_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    # /stock -> categories, /stock <category id> -> its products
+    if context.args and context.args[0].isdigit():
+        rows = await store.catalog_products(int(context.args[0]))
+        if not rows:
+            await update.message.reply_text("Категорія порожня або не існує.")
+            return
+        lines = [f"📦 Склад: **{rows[0]['category']}**", ""]
+        for r in rows:
+            hidden = " (приховано)" if not r["active"] else ""
+            reserved = f" (у корзинах {r['reserved']})" if r["reserved"] else ""
+            lines.append(f"• #{r['id']} {r['name']}: {r['qty']}{reserved}{hidden}")
+        for chunk in split_message(lines):
+            await update.message.reply_text(chunk)
+        return
+
+    lines = ["📦 Склад по категоріях:", ""]
+    for r in await store.catalog_summary():
+        hidden = " (приховано)" if not r["active"] else ""
+        lines.append(f"• {r['id']}. {r['title']}: {r['products']} товарів, {r['units']} шт.{hidden}")
+    lines.append("")
+    lines.append("Команди:")
+    lines.append("/stock <id категорії> — товари й залишки")
+    lines.append("/setstock <смак або #id> <кількість>")
+    lines.append("/addstock <смак або #id> <кількість>")
+    lines.append("/importstock [set|add] — CSV-файл або рядки «смак кількість»")
+    lines.append("/exportstock — склад у CSV")
+    lines.append("/addcategory <назва>")
+    lines.append("/addproduct <id категорії> <назва> [| опис]")
+    lines.append("/report [днів] — продажі за сьогодні або за N днів")
+    lines.append("/slow — повільні оновлення, /profile [секунд] — профіль бота")
+    lines.append("/hideproduct, /showproduct <#id>")
+    lines.append("Приклад: /setstock ВИШНЯ_МЕНТОЛ 20")
+    for chunk in split_message(lines):
+        await update.message.reply_text(chunk)
+
+async def cmd_setstock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    # Accept formats:
+    # /setstock ВИШНЯ_МЕНТОЛ 20
+    # /setstock ВИШНЯ МЕНТОЛ 20
+    # /setstock #6 20
+    raw = update.message.text[len("/setstock"):].strip()
+    toks = raw.split()
+    if len(toks) < 2:
+        await update.message.reply_text("Формат: /setstock <смак> <кількість>\nПриклад: /setstock ВИШНЯ_МЕНТОЛ 20")
+        return
+
+    qty_str = toks[-1]
+    flavor = normalize_flavor(" ".join(toks[:-1]))
+
+    if not qty_str.isdigit():
+        await update.message.reply_text("Кількість має бути числом.")
+        return
+
+    qty = int(qty_str)
+
+    product = await resolve_product(update, flavor)
+    if not product:
+        return
+
+    await store.set_stock(product.id, qty)
+    await update.message.reply_text(f"✅ Встановлено: {product.label} = {qty}")
+
+async def cmd_addstock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    raw = update.message.text[len("/addstock"):].strip()
+    toks = raw.split()
+    if len(toks) < 2:
+        await update.message.reply_text("Формат: /addstock <смак> <кількість>\nПриклад: /addstock БАНАН 5")
+        return
+
+    qty_str = toks[-1]
+    flavor = normalize_flavor(" ".join(toks[:-1]))
+
+    try:
+        qty = int(qty_str)
+    except ValueError:
+        await update.message.reply_text("Кількість має бути числом (можна від'ємне).")
+        return
+
+    product = await resolve_product(update, flavor)
+    if not product:
+        return
+
+    new_qty = await store.add_stock(product.id, qty)
+    await update.message.reply_text(f"✅ Додано: {product.label} ({qty:+d}). Тепер: {new_qty}")
+
+async def cmd_addcategory(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    title = " ".join(context.args).strip()
+    if not title:
+        await update.message.reply_text("Формат: /addcategory <назва>\nПриклад: /addcategory Chaser 10 мл")
+        return
+    try:
+        category_id = await store.add_category(title)
+    except sqlite3.IntegrityError:
+        await update.message.reply_text("Така категорія вже є.")
+        return
+    await update.message.reply_text(f"✅ Категорія {category_id}: {title}\nДодай товари: /addproduct {category_id} <назва>")
+
+async def cmd_addproduct(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    # /addproduct 2 ПОЛУНИЦЯ КІВІ | опис (необов'язково)
+    parts = update.message.text.split(maxsplit=1)
+    head, _, description = (parts[1] if len(parts) > 1 else "").partition("|")
+    toks = head.split()
+    if len(toks) < 2 or not toks[0].isdigit():
+        await update.message.reply_text("Формат: /addproduct <id категорії> <назва> [| опис]\nid категорій: /stock")
+        return
+
+    name = normalize_flavor(" ".join(toks[1:]))
+    try:
+        product_id = await store.add_product(int(toks[0]), name, description.strip() or None)
+    except sqlite3.IntegrityError:
+        await update.message.reply_text("Такий товар у цій категорії вже є.")
+        return
+    if product_id is None:
+        await update.message.reply_text("Немає такої категорії. id категорій: /stock")
+        return
+    await update.message.reply_text(f"✅ Товар #{product_id}: {name}\nЗалишок 0 — постав: /setstock #{product_id} <кількість>")
+
+async def _set_product_visibility(update: Update, context: ContextTypes.DEFAULT_TYPE, active: bool):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    name = " ".join(context.args)
+    if not name:
+        await update.message.reply_text("Формат: /hideproduct <смак або #id>")
+        return
+    product = await resolve_product(update, name)
+    if not product:
+        return
+    await store.set_product_active(product.id, active)
+    state = "показується" if active else "приховано (залишки й корзини не чіпаю)"
+    await update.message.reply_text(f"✅ {product.label}: {state}")
+
+async def cmd_hideproduct(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _set_product_visibility(update, context, False)
+
+async def cmd_showproduct(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _set_product_visibility(update, context, True)
+
+# Bulk stock: "flavor qty" per line, or a CSV/TSV file with flavor,qty columns
+IMPORT_MAX_BYTES = 1 << 20
+IMPORT_MAX_ERRORS = 30
+_import_line_re = re.compile(r"^(.*?)[\s,;]+([+-]?\d+)\s*[,;]?\s*$")
+
+def decode_import(data: bytes) -> str:
+    # Excel saves UTF-8 with a BOM, or cp1251 on Ukrainian Windows
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return data.decode("cp1251", errors="replace")
+
+def parse_import_csv(text: str) -> List[Tuple[int, str, str]]:
+    """
+    (line number, product, qty) from CSV/TSV text: the first column names the
+    product (or is its id, as in /exportstock), the last one is the quantity.
+    A header row is skipped.
+    """
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    out = []
+    for n, row in enumerate(csv.reader(io.StringIO(text), dialect), 1):
+        cells = [c.strip() for c in row]
+        if not any(cells):
+            continue
+        if n == 1 and len(cells) >= 2 and not re.fullmatch(r"[+-]?\d+", cells[-1]):
+            continue  # header
+        out.append((n, cells[0], cells[-1] if len(cells) > 1 else ""))
+    return out
+
+def parse_import_lines(lines: List[str], first_line: int = 1) -> List[Tuple[int, str, str]]:
+    out = []
+    for n, line in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        m = _import_line_re.match(line.strip())
+        out.append((n, m.group(1), m.group(2)) if m else (n, line.strip(), ""))
+    return out
+
+def validate_import(
+    rows: List[Tuple[int, str, str]], delta: bool, found: Dict[str, List[Product]]
+) -> Tuple[List[Tuple[int, int]], List[str]]:
+    valid: List[Tuple[int, int]] = []
+    errors: List[str] = []
+    for n, flavor_raw, qty_raw in rows:
+        products = found.get(flavor_raw, [])
+        if not products:
+            errors.append(f"рядок {n}: не знайшов смак «{flavor_raw}»")
+            continue
+        if len(products) > 1:
+            errors.append(f"рядок {n}: «{flavor_raw}» є в кількох категоріях, вкажи id")
+            continue
+        if not re.fullmatch(r"[+-]?\d+", qty_raw):
+            errors.append(f"рядок {n}: кількість «{qty_raw}» — не число")
+            continue
+        qty = int(qty_raw)
+        if qty < 0 and not delta:
+            errors.append(f"рядок {n}: від'ємна кількість (для змін використовуй /importstock add)")
+            continue
+        valid.append((products[0].id, qty))
+    return valid, errors
+
+async def cmd_importstock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    # Accept:
+    # - a document with caption "/importstock [set|add]"
+    # - "/importstock [set|add]" as a reply to a document
+    # - "/importstock [set|add]" followed by "flavor qty" lines
+    msg = update.message
+    lines = (msg.text or msg.caption or "").splitlines()
+    head = lines[0].split()[1:] if lines else []
+    delta = False
+    if head and head[0].lower() in ("set", "add"):
+        delta = head.pop(0).lower() == "add"
+
+    doc = msg.document or (msg.reply_to_message.document if msg.reply_to_message else None)
+    if doc:
+        if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+            await msg.reply_text("Файл завеликий (макс. 1 МБ).")
+            return
+        tg_file = await context.bot.get_file(doc.file_id)
+        rows = parse_import_csv(decode_import(bytes(await tg_file.download_as_bytearray())))
+    else:
+        # anything left on the command line is the first row
+        rows = parse_import_lines([" ".join(head)] + lines[1:])
+
+    if not rows:
+        await msg.reply_text(
+            "Формат: /importstock [set|add], далі рядки «смак кількість»,\n"
+            "або надішли CSV (смак,кількість) з підписом /importstock.\n"
+            "set — встановити кількість (за замовчуванням), add — додати/відняти."
+        )
+        return
+
+    found = await store.find_products(list({r[1] for r in rows}))
+    valid, errors = validate_import(rows, delta, found)
+    if errors:
+        shown = errors[:IMPORT_MAX_ERRORS]
+        more = f"\n… і ще {len(errors) - len(shown)}" if len(errors) > len(shown) else ""
+        await msg.reply_text("❌ Нічого не змінено, помилки:\n" + "\n".join(shown) + more)
+        return
+
+    await store.import_stock(valid, delta)
+    mode = "додано" if delta else "встановлено"
+    await msg.reply_text(f"✅ Імпорт: {len(valid)} рядків, {mode}. Перевір /stock")
+
+async def cmd_exportstock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    rows = await store.catalog_products()
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["id", "category", "product", "qty"])
+    for r in rows:
+        w.writerow([r["id"], r["category"], r["name"], r["qty"]])
+    data = buf.getvalue().encode("utf-8-sig")  # BOM so Excel picks UTF-8
+    name = time.strftime("stock-%Y%m%d-%H%M.csv")
+    await update.message.reply_document(document=InputFile(data, filename=name), caption=f"📦 Склад: {len(rows)} позицій")
+
+SLOW_SHOWN = 20
+PROFILE_DEFAULT_S = 30
+PROFILE_MAX_S = 300
+PROFILE_TOP = 40
+
+async def cmd_slow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    if not TRACER.slow:
+        await update.message.reply_text(f"Повільних оновлень (≥ {TRACER.threshold:g} с) не було. Усього оброблено: {TRACER.updates}")
+        return
+    shown = list(TRACER.slow)[-SLOW_SHOWN:][::-1]
+    lines = [f"🐢 Оновлення ≥ {TRACER.threshold:g} с (останні {len(shown)} з {len(TRACER.slow)}), нові зверху:", ""]
+    for s in shown:
+        stamp = datetime.fromtimestamp(s.at, _shop_tz).strftime("%d.%m %H:%M:%S")
+        wait = f", чекав ліміт {s.tg_wait * 1000:.0f}" if s.tg_wait >= 0.001 else ""
+        lines.append(
+            f"{stamp} {s.route} — {s.total * 1000:.0f} мс: "
+            f"БД {s.db * 1000:.0f} ({s.db_calls}), Telegram {s.tg * 1000:.0f} ({s.tg_calls}{wait}), user {s.user_id}"
+        )
+    for chunk in split_message(lines):
+        await update.message.reply_text(chunk)
+
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    seconds = PROFILE_DEFAULT_S
+    if context.args:
+        if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= PROFILE_MAX_S:
+            await update.message.reply_text(f"Формат: /profile [секунд від 1 до {PROFILE_MAX_S}]")
+            return
+        seconds = int(context.args[0])
+    if context.bot_data.get("profiling"):
+        await update.message.reply_text("Профілювання вже запущене, дочекайся результату.")
+        return
+
+    # cProfile hooks the event loop thread: handlers, rendering, PTB itself.
+    # DB threads show up only as time spent waiting on them.
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # another profiler (e.g. a debugger) owns the hook
+        await update.message.reply_text(f"Не вдалося запустити профілювання: {e}")
+        return
+    context.bot_data["profiling"] = True
+    await update.message.reply_text(f"⏱ Профілюю {seconds} с…")
+    # finish in the background: waiting here would hold up the admin's own updates
+    context.application.create_task(finish_profile(update.message, profiler, seconds, TRACER.updates, context.bot_data))
+
+async def finish_profile(message, profiler: cProfile.Profile, seconds: int, updates_before: int, bot_data: dict):
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        bot_data.pop("profiling", None)
+    updates = TRACER.updates - updates_before
+    buf = io.StringIO()
+    buf.write(f"{seconds} s, {updates} updates\n\n")
+    stats = pstats.Stats(profiler, stream=buf).strip_dirs()
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+    stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+    name = time.strftime("profile-%Y%m%d-%H%M.txt")
+    await message.reply_document(
+        document=InputFile(buf.getvalue().encode(), filename=name),
+        caption=f"⏱ {seconds} с, оновлень: {updates}",
+    )
+
+REPORT_MAX_DAYS = 366
+
+async def cmd_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔️ Команда тільки для адміна.")
+        return
+
+    # /report -> today, /report 7 -> last 7 days including today
+    days = 1
+    if context.args:
+        if not context.args[0].isdigit() or not 1 <= int(context.args[0]) <= REPORT_MAX_DAYS:
+            await update.message.reply_text(f"Формат: /report [днів від 1 до {REPORT_MAX_DAYS}]")
+            return
+        days = int(context.args[0])
+
+    report = await store.sales_report(days)
+    period = "сьогодні" if days == 1 else f"{days} дн. (з {report.since})"
+    lines = [f"📊 Продажі за {period}", "", f"Замовлень: {report.orders}", f"Штук: {report.units}"]
+    if report.products:
+        lines.append("")
+        lines += [f"• {label} — {units}" for label, units in report.products]
+    for chunk in split_message(lines):
+        await update.message.reply_text(chunk)
+
+
+# =========================
+# Duplicate suppression
+# =========================
+# Telegram redelivers updates after a timeout or a restart, and impatient
+# users double-tap. Both are answered straight from memory: a callback query
+# id is only ever handled once, and the same button on the same version of a
+# message is handled once per DUPLICATE_WINDOW_S (except ➕/➖, which are
+# meant to be tapped repeatedly). Checkout is additionally idempotent in the
+# DB (orders.idempotency_key), which also covers restarts.
+DUPLICATE_WINDOW_S = float(os.environ.get("DUPLICATE_WINDOW_S", "3"))
+CALLBACK_ID_TTL_S = 600
+
+
+class TTLCache:
+    """Set of recently seen keys; each is forgotten `ttl` seconds after it was added."""
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Any, float]" = OrderedDict()
+
+    def add(self, key: Any) -> bool:
+        """Remember `key`; False if it was already seen within the TTL."""
+        now = time.monotonic()
+        # insertion order == expiry order, so only the head can be stale
+        while self._data:
+            oldest, expires = next(iter(self._data.items()))
+            if expires > now and len(self._data) < self.maxsize:
+                break
+            del self._data[oldest]
+        if key in self._data:
+            return False
+        self._data[key] = now + self.ttl
+        return True
+
+    def clear(self):
+        self._data.clear()
+
+
+_seen_callback_ids = TTLCache(CALLBACK_ID_TTL_S)
+_recent_taps = TTLCache(DUPLICATE_WINDOW_S)
+
+def message_version(message) -> Optional[int]:
+    """Timestamp of the message as the user saw it (changes with every edit)."""
+    stamp = getattr(message, "edit_date", None) or getattr(message, "date", None)
+    return int(stamp.timestamp()) if stamp else None
+
+def duplicate_reason(query, action: str) -> Optional[str]:
+    """Why this callback query is a duplicate, or None if it should be handled."""
+    if query.id and not _seen_callback_ids.add(query.id):
+        return "redelivered"
+    if action in REPEATABLE_ACTIONS or query.message is None:
+        return None
+    key = (query.from_user.id, query.data, query.message.chat.id, query.message.message_id, message_version(query.message))
+    return None if _recent_taps.add(key) else "double_tap"
+
+
+# =========================
+# Callback router
+# =========================
+# action -> (handler, arg parser); handlers get the parsed arg, a parser
+# returning None (or raising ValueError) marks the button as stale
+CallbackHandler = Callable[[Update, ContextTypes.DEFAULT_TYPE, Any], Awaitable[None]]
+CALLBACK_ROUTES: Dict[str, Tuple[CallbackHandler, Optional[Callable[[str], Any]]]] = {}
+REPEATABLE_ACTIONS: Set[str] = set()  # not subject to double-tap suppression
+
+def callback_route(action: str, parse_arg: Optional[Callable[[str], Any]] = None, repeatable: bool = False):
+    def register(fn: CallbackHandler) -> CallbackHandler:
+        CALLBACK_ROUTES[action] = (fn, parse_arg)
+        if repeatable:
+            REPEATABLE_ACTIONS.add(action)
+        return fn
+    return register
+
+def parse_callback(data: str) -> Optional[Tuple[str, CallbackHandler, Any]]:
+    """(action, handler, arg) for callback_data, or None if it's stale/unknown."""
+    parts = data.split(":", 2)
+    if len(parts) < 2 or parts[0] != CB_VERSION:
+        return None
+    route = CALLBACK_ROUTES.get(parts[1])
+    if route is None:
+        return None
+    handler, parse_arg = route
+    if parse_arg is None:
+        return (parts[1], handler, None) if len(parts) == 2 else None
+    if len(parts) != 3:
+        return None
+    try:
+        arg = parse_arg(parts[2])
+    except ValueError:
+        return None
+    return (parts[1], handler, arg) if arg is not None else None
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    started = time.perf_counter()
+    route = parse_callback(query.data or "")
+    if route is None:
+        # button from an old message (before a format/catalog change) or garbage
+        try:
+            await safe_answer(query, "Ця кнопка застаріла — ось актуальне меню.")
+            await query.message.reply_text("Вибери товар:", reply_markup=await main_menu_view())
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, "callback", "stale")
+        return
+    action, handler, arg = route
+    reason = duplicate_reason(query, action)
+    if reason:
+        DUPLICATE_CALLBACKS.inc(reason)
+        try:
+            await safe_answer(query, "Вже виконано ✅")
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, "callback", "duplicate")
+        return
+    try:
+        await safe_answer(query)
+        await handler(update, context, arg)
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, "callback", action)
+
+@callback_route("menu")
+async def cb_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, _):
+    await edit_message(update.callback_query, "Вибери товар:", reply_markup=await main_menu_view())
+
+@callback_route("mpage", parse_id)
+async def cb_menu_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int):
+    await edit_message(update.callback_query, "Вибери товар:", reply_markup=await main_menu_view(page))
+
+@callback_route("cat", parse_page)
+async def cb_category(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: Tuple[int, int]):
+    query = update.callback_query
+    category_id, page = arg
+    title, has_items, kb = await category_view(category_id, page)
+    if title is None:
+        await edit_message(query, "Цієї категорії вже немає 😕", reply_markup=await main_menu_view())
+        return
+    # if no items
+    if not has_items:
+        await edit_message(query, "Наразі немає в наявності 😕", reply_markup=back_to_menu_kb())
+        return
+    suffix = f" — стор. {page + 1}" if page else ""
+    await edit_message(query, f"Смаки {title} (показує тільки те, що є на складі){suffix}:", reply_markup=kb)
+
+@callback_route("fl", parse_id)
+async def cb_flavor(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int):
+    query = update.callback_query
+    product = await store.get_product(product_id)
+    if product is None or not product.active or await store.get_stock(product_id) <= 0:
+        kb = (await category_view(product.category_id, 0))[2] if product else back_to_menu_kb()
+        await edit_message(query, "Цього смаку вже нема в наявності 😕", reply_markup=kb)
+        return
+
+    text = product_description(product.category, product.name, product.description)
+    kb = product_actions_kb(product.id, product.category_id)
+    # send photo separately if exists, then edit text
+    try:
+        # If current message has no photo, we send a new photo message
+        if await send_product_photo(query.message.reply_photo, caption=text, parse_mode="Markdown", reply_markup=kb):
+            # keep old message as list screen
+            return
+    except Exception:
+        log.exception("failed to send product photo")
+
+    # fallback: text only
+    await edit_message(query, text, parse_mode="Markdown", reply_markup=kb)
+
+@callback_route("cart")
+async def cb_cart_view(update: Update, context: ContextTypes.DEFAULT_TYPE, _):
+    query = update.callback_query
+    cart = await store.cart_get(update.effective_user.id)
+    if not cart:
+        await edit_message(query, "🧺 Корзина пуста.", reply_markup=back_to_menu_kb())
+        return
+
+    text, kb = cart_view(cart)
+    await edit_message(query, text, parse_mode="Markdown", reply_markup=kb)
+
+@callback_route("add", parse_id)
+async def cb_cart_add(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int):
+    query = update.callback_query
+    # Add 1 but not beyond stock
+    added, cart = await store.cart_adjust(update.effective_user.id, product_id, 1)
+    if not added:
+        if any(line.product_id == product_id for line in cart):
+            await query.message.reply_text("Більше додати не можна — не вистачає на складі.")
+        else:
+            await query.message.reply_text("Цього смаку вже нема в наявності 😕")
+        return
+
+    name = next(line.name for line in cart if line.product_id == product_id)
+    await query.message.reply_text(f"✅ Додано в корзину: {name} (1 шт.)")
+
+@callback_route("inc", parse_id, repeatable=True)
+async def cb_cart_inc(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int):
+    query = update.callback_query
+    added, cart = await store.cart_adjust(update.effective_user.id, product_id, 1)
+    if not added:
+        await query.message.reply_text("Більше додати не можна — не вистачає на складі.")
+        return
+    text, kb = cart_view(cart)
+    edits.schedule(message_key(query), text_editor(query), text, parse_mode="Markdown", reply_markup=kb)
+
+@callback_route("dec", parse_id, repeatable=True)
+async def cb_cart_dec(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id: int):
+    query = update.callback_query
+    _, cart = await store.cart_adjust(update.effective_user.id, product_id, -1)
+    if not cart:
+        edits.schedule(message_key(query), text_editor(query), "🧺 Корзина пуста.", reply_markup=back_to_menu_kb())
+        return
+    text, kb = cart_view(cart)
+    edits.schedule(message_key(query), text_editor(query), text, parse_mode="Markdown", reply_markup=kb)
+
+@callback_route("clear")
+async def cb_cart_clear(update: Update, context: ContextTypes.DEFAULT_TYPE, _):
+    await store.cart_clear(update.effective_user.id)
+    await edit_message(update.callback_query, "🗑 Корзина очищена.", reply_markup=back_to_menu_kb())
+
+@callback_route("order")
+async def cb_order_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, _):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    # one order per version of the cart message and state of the cart (see
+    # order_key): a retried or redelivered tap gets the original order back
+    # instead of checking out again
+    version = message_version(query.message)
+    key = f"{user_id}:{query.message.chat.id}:{query.message.message_id}:{version}" if version else f"q:{query.id}"
+
+    def admin_notice(items):
+        # profile + order, queued in the outbox with the order itself and retried until delivered
+        u = update.effective_user
+        return ADMIN_CHAT_ID_INT, user_profile_text(u) + "\n\n" + order_text(items), "Markdown"
+
+    result = await store.checkout(user_id, key, admin_notice)
+    if not result.ok:
+        await query.message.reply_text(f"❌ {result.message}")
+        return
+
+    if not result.replayed:
+        outbox.wake()
+
+    # User confirmation
+    await edit_message(query, "✅ Замовлення прийнято! Чекайте повідомлення від менеджера 🙌", reply_markup=back_to_menu_kb())
+
+@callback_route("noop", repeatable=True)
+async def cb_noop(update: Update, context: ContextTypes.DEFAULT_TYPE, _):
+    return
+
+
+# =========================
+# Inline search
+# =========================
+# "@bot виш" in any chat. Results are the same for everyone, so Telegram may
+# serve a repeated query from its own cache for INLINE_CACHE_S; messages sent
+# from inline mode can't carry our callback buttons, so they link back to
+# the bot instead (/start p<id>).
+INLINE_RESULTS = 20
+INLINE_CACHE_S = int(os.environ.get("INLINE_CACHE_S", "30"))
+INLINE_HINT = "Натисни «🛒 Замовити», щоб відкрити смак у боті."
+
+
+async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    started = time.perf_counter()
+    try:
+        found = await store.search_products(query.query, INLINE_RESULTS)
+        results = [
+            InlineQueryResultArticle(
+                id=str(p.id),
+                title=p.name,
+                description=f"{p.category} · {qty} шт.",
+                input_message_content=InputTextMessageContent(
+                    product_description(p.category, p.name, p.description, INLINE_HINT), parse_mode="Markdown",
+                ),
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("🛒 Замовити", url=f"https://t.me/{context.bot.username}?start=p{p.id}"),
+                ]]),
+            )
+            for p, qty in found
+        ]
+        try:
+            await query.answer(
+                results,
+                cache_time=INLINE_CACHE_S,
+                is_personal=False,
+                button=InlineQueryResultsButton("🛍 Усе меню в боті", start_parameter="menu"),
+            )
+        except TelegramError as e:
+            # the user typed on and the query expired, nothing to show it to
+            log.debug("inline answer failed: %s", e)
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, "inline", "search")
+
+
+# =========================
+# HTTP server (health check + webhook)
+# =========================
+# Runs on the bot's own event loop. In polling mode it only answers health
+# checks (Render Web Service needs an open PORT); in webhook mode Telegram
+# also POSTs updates to WEBHOOK_PATH.
+BOT_MODE = os.environ.get("BOT_MODE", "polling").strip().lower()  # polling | webhook
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").strip()  # public base URL, e.g. https://<service>.onrender.com
+WEBHOOK_PATH = "/telegram"
+# Telegram echoes it back in X-Telegram-Bot-Api-Secret-Token; the default is stable across restarts
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "").strip() or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+HTTP_MAX_BODY = 1 << 20
+HTTP_IDLE_TIMEOUT = 75  # seconds a keep-alive connection may sit idle
+TEXT_PLAIN = "text/plain; charset=utf-8"
+
+if BOT_MODE not in ("polling", "webhook"):
+    raise RuntimeError("BOT_MODE must be 'polling' or 'webhook'.")
+
+# (status, body, content type)
+HttpResponse = Tuple[int, bytes, str]
+HttpRoute = Callable[[str, Dict[str, str], bytes], Awaitable[HttpResponse]]
+
+
+async def _read_http_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, _ = line.decode("latin-1").split(" ", 2)
+    headers: Dict[str, str] = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = h.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    length = int(headers.get("content-length") or 0)
+    if length < 0 or length > HTTP_MAX_BODY:
+        raise ValueError("bad content-length")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+def _http_response(status: int, body: bytes, content_type: str, keep_alive: bool) -> bytes:
+    head = (
+        f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+class HttpServer:
+    def __init__(self, app, webhook: bool):
+        self.app = app
+        self.routes: Dict[str, HttpRoute] = {"/healthz": self.health, "/metrics": self.metrics}
+        if webhook:
+            self.routes[WEBHOOK_PATH] = self.webhook
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = "0.0.0.0", port: int = PORT):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        log.info("http server listening on %s:%s (%s)", host, port, ", ".join(self.routes))
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def health(self, method: str, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        return 200, b"ok", TEXT_PLAIN
+
+    async def metrics(self, method: str, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        return 200, render_metrics().encode(), "text/plain; version=0.0.4; charset=utf-8"
+
+    async def webhook(self, method: str, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        if method != "POST":
+            return 405, b"", TEXT_PLAIN
+        token = headers.get("x-telegram-bot-api-secret-token", "").encode("utf-8", "replace")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET.encode()):
+            return 403, b"", TEXT_PLAIN
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, b"bad update", TEXT_PLAIN
+        # ack right away, the Application processes it from its queue
+        await self.app.update_queue.put(update)
+        return 200, b"", TEXT_PLAIN
+
+    async def _route(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> HttpResponse:
+        route = self.routes.get(path)
+        if route is None:
+            # the old health server said "ok" to any GET; Render may be probing "/"
+            if method in ("GET", "HEAD"):
+                return await self.health(method, headers, body)
+            return 404, b"not found", TEXT_PLAIN
+        try:
+            return await route(method, headers, body)
+        except Exception:
+            log.exception("http %s %s failed", method, path)
+            return 500, b"error", TEXT_PLAIN
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    req = await asyncio.wait_for(_read_http_request(reader), HTTP_IDLE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except ValueError:
+                    writer.write(_http_response(400, b"bad request", TEXT_PLAIN, keep_alive=False))
+                    await writer.drain()
+                    break
+                if req is None:
+                    break
+                method, path, headers, body = req
+                status, payload, content_type = await self._route(method, path, headers, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if method == "HEAD":
+                    payload = b""
+                writer.write(_http_response(status, payload, content_type, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            with suppress(Exception):
+                await writer.wait_closed()
+
+
+# =========================
+# Update processing
+# =========================
+# Different users' updates are handled concurrently (a slow photo upload or
+# checkout no longer holds up everyone else); one user's updates still run
+# one at a time, in the order Telegram sent them.
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))  # 1 = strictly sequential
+
+
+def update_user_key(update: object) -> Optional[int]:
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+
+class UserOrderedProcessor(BaseUpdateProcessor):
+    """
+    Up to `max_concurrent_updates` updates at once, never two of the same
+    user. While a user's update runs, their next ones wait in a per-user
+    queue (without taking a concurrency slot) and are run by the same task
+    in arrival order; the queue is dropped as soon as it's empty.
+    """
+
+    def __init__(self, max_concurrent_updates: int = CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._queues: Dict[int, Deque[Awaitable[Any]]] = {}
+
+    @property
+    def busy_users(self) -> int:
+        return len(self._queues)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        key = update_user_key(update)
+        if key is None:
+            await coroutine
+            return
+        pending = self._queues.get(key)
+        if pending is not None:
+            pending.append(coroutine)
+            return
+        pending = self._queues[key] = deque()
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception:
+                    # Application reports handler errors itself; keep the user's queue going
+                    log.exception("update processing failed")
+                if not pending:
+                    break
+                coroutine = pending.popleft()
+        finally:
+            del self._queues[key]
+            # only left over if we were cancelled (shutdown)
+            for coroutine in pending:
+                coroutine.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# =========================
+# Warm restart
+# =========================
+# A redeploy shouldn't feel like one:
+# - the id of the last update handed to the handlers is saved every
+#   OFFSET_SAVE_S and on shutdown, with the time even when it hasn't changed;
+#   the next start confirms everything up to it with Telegram and, until the
+#   first newer update, skips it if it's delivered again, so nothing from
+#   before a crash runs twice;
+# - updates that queued up while the bot was down are fetched before
+#   polling/the webhook starts, BACKLOG_BATCH at a time, and each batch is
+#   handled before the next is confirmed. If the bot was down (judging by
+#   the last save) longer than STALE_CALLBACK_S the taps in it went unanswered: only the last tap on each
+#   message is handled (the user sees where they ended up, ➕ x5 doesn't add
+#   five) and inline queries are dropped, nobody is waiting for them anymore;
+# - the search index and the first page of the menu and of every category
+#   are built before the first update. Stock and photo file_ids already come
+#   from the DB at init_db().
+# Only the update types some handler uses are requested from Telegram.
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.INLINE_QUERY]
+UPDATE_OFFSET_SETTING = "update_offset"  # "<update id> <unix time it was seen> <unix time saved>"
+OFFSET_SAVE_S = 5
+BACKLOG_BATCH = 100  # getUpdates maximum
+# after a week without updates Telegram starts update ids at a random value
+OFFSET_MAX_AGE_S = 6 * 86400
+STALE_CALLBACK_S = float(os.environ.get("STALE_CALLBACK_S", "15"))
+
+
+class HandledUpdates:
+    """The last update id handed to the handlers, persisted across restarts."""
+
+    def __init__(self):
+        self.restored = 0  # last id of the previous run
+        self.saved_at = 0.0  # when the previous run last saved: it was up until then
+        self.catching_up = False  # Telegram may still redeliver what the previous run handled
+        self.last = 0
+        self.last_at = 0.0  # when `last` arrived
+
+    def seen(self, update_id: int):
+        if update_id > self.last:
+            self.last, self.last_at = update_id, time.time()
+
+    def restore(self, value: Optional[str]):
+        try:
+            fields = (value or "").split()
+            update_id, last_at = int(fields[0]), float(fields[1])
+            self.saved_at = float(fields[2]) if len(fields) > 2 else last_at
+        except (IndexError, ValueError):
+            return
+        if time.time() - last_at <= OFFSET_MAX_AGE_S:
+            self.restored, self.catching_up = update_id, True
+            if update_id > self.last:
+                self.last, self.last_at = update_id, last_at
+
+    def redelivered(self, update_id: int) -> bool:
+        """
+        Whether Telegram sent an update the previous run already handled.
+        Only until the backlog is confirmed or a newer update arrives (they
+        come in order): after that an old id is a replay by hand or a reset
+        on Telegram's side, and is handled.
+        """
+        if not self.catching_up:
+            return False
+        if update_id <= self.restored:
+            return True
+        self.catching_up = False
+        return False
+
+    async def save(self):
+        await store.set_setting(UPDATE_OFFSET_SETTING, f"{self.last} {self.last_at:.0f} {time.time():.0f}")
+
+
+HANDLED = HandledUpdates()
+
+async def save_offset(context: ContextTypes.DEFAULT_TYPE):
+    await HANDLED.save()
+
+def fresh_backlog(updates: List[Update], stale: bool) -> List[Update]:
+    """The part of a backlog batch worth handling (all of it unless `stale`)."""
+    if not stale:
+        return updates
+    last_tap: Dict[Tuple[int, int, int], int] = {}
+    for u in updates:
+        q = u.callback_query
+        if q is not None and q.message is not None:
+            last_tap[(q.from_user.id, q.message.chat.id, q.message.message_id)] = u.update_id
+    fresh = []
+    for u in updates:
+        q = u.callback_query
+        if u.inline_query is not None:
+            BACKLOG_SKIPPED.inc("inline_query")
+        elif q is not None and q.message is not None and last_tap[(q.from_user.id, q.message.chat.id, q.message.message_id)] != u.update_id:
+            BACKLOG_SKIPPED.inc("stale_tap")
+        else:
+            fresh.append(u)
+    return fresh
+
+async def drain_backlog(app) -> int:
+    """Handle the updates that arrived while the bot was down; returns how many were handled."""
+    stale = time.time() - HANDLED.saved_at > STALE_CALLBACK_S
+    offset = HANDLED.restored + 1 if HANDLED.restored else None
+    if BOT_MODE == "webhook":
+        # getUpdates only works without a webhook; run_webhook sets it again right after
+        await app.bot.delete_webhook()
+    handled = 0
+    while True:
+        updates = await app.bot.get_updates(offset=offset, limit=BACKLOG_BATCH, timeout=0, allowed_updates=ALLOWED_UPDATES)
+        if not updates:
+            break
+        offset = updates[-1].update_id + 1
+        batch = fresh_backlog(updates, stale)
+        # through the processor, so one user's updates still run in order
+        await asyncio.gather(*(app.update_processor.process_update(u, app.process_update(u)) for u in batch))
+        handled += len(batch)
+        if len(updates) < BACKLOG_BATCH:
+            # confirm the last batch; anything newer is left for polling/the webhook
+            await app.bot.get_updates(offset=offset, limit=1, timeout=0, allowed_updates=ALLOWED_UPDATES)
+            break
+    # everything up to the offset is confirmed, Telegram won't send it again
+    HANDLED.catching_up = False
+    return handled
+
+async def warm_views():
+    """Render the first page of the menu and of every category into _page_cache."""
+    page, has_next = 0, True
+    while has_next and len(_page_cache) < _page_cache.maxsize:
+        categories, has_next = await store.categories_page(page)
+        await main_menu_view(page)
+        for category_id, _ in categories:
+            await category_view(category_id, 0)
+        page += 1
+
+
+# =========================
+# Main
+# =========================
+async def on_startup(app):
+    global INLINE_SEARCH
+    INLINE_SEARCH = bool(app.bot.supports_inline_queries)
+    outbox.start(app.bot)
+    schedule_sweeper(app)
+    app.bot_data["loop_monitor"] = asyncio.create_task(monitor_event_loop())
+    server = HttpServer(app, webhook=BOT_MODE == "webhook")
+    try:
+        await server.start()
+        app.bot_data["http_server"] = server
+    except OSError:
+        if BOT_MODE == "webhook":
+            raise
+        # polling works without it, but say so instead of failing silently
+        log.exception("health server could not bind port %s", PORT)
+    await warm_start(app)
+
+async def warm_start(app):
+    started = time.perf_counter()
+    HANDLED.restore(get_setting(UPDATE_OFFSET_SETTING))
+    await store.call(SEARCH.warm)
+    handled = 0
+    if BOT_MODE == "polling" or WEBHOOK_URL:
+        try:
+            handled = await drain_backlog(app)
+        except TelegramError:
+            # polling/the webhook will deliver them one by one instead
+            log.exception("could not fetch the backlog")
+    else:
+        # updates only come in by hand, nothing is redelivered
+        HANDLED.catching_up = False
+    await warm_views()
+    if app.job_queue is not None:
+        app.job_queue.run_repeating(save_offset, interval=OFFSET_SAVE_S, first=OFFSET_SAVE_S, name="update_offset")
+    log.info("warm start in %.0f ms, %d backlog updates handled", (time.perf_counter() - started) * 1000, handled)
+
+async def on_shutdown(app):
+    monitor = app.bot_data.pop("loop_monitor", None)
+    if monitor is not None:
+        monitor.cancel()
+    await edits.flush()
+    await outbox.stop()
+    server = app.bot_data.pop("http_server", None)
+    if server is not None:
+        await server.close()
+    await HANDLED.save()
+    store.close()
+    close_db()
+
+async def run_webhook(app):
+    """Like Application.run_polling, but updates arrive through HttpServer.webhook."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    try:
+        await app.post_init(app)
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        else:
+            # local testing: POST recorded updates to WEBHOOK_PATH yourself
+            log.warning("WEBHOOK_URL is not set, webhook not registered with Telegram")
+        await app.start()
+        await stop.wait()
+    finally:
+        if app.running:
+            await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
+def add_handlers(app):
+    app.add_handler(CommandHandler("start", timed_command("start", cmd_start)))
+    app.add_handler(CommandHandler("stock", timed_command("stock", cmd_stock)))
+    app.add_handler(CommandHandler("setstock", timed_command("setstock", cmd_setstock)))
+    app.add_handler(CommandHandler("addstock", timed_command("addstock", cmd_addstock)))
+    app.add_handler(CommandHandler("setphoto", timed_command("setphoto", cmd_setphoto)))
+    app.add_handler(CommandHandler("importstock", timed_command("importstock", cmd_importstock)))
+    app.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r"^/importstock(@\w+)?\b"),
+        timed_command("importstock", cmd_importstock),
+    ))
+    app.add_handler(CommandHandler("exportstock", timed_command("exportstock", cmd_exportstock)))
+    app.add_handler(CommandHandler("report", timed_command("report", cmd_report)))
+    app.add_handler(CommandHandler("slow", timed_command("slow", cmd_slow)))
+    app.add_handler(CommandHandler("profile", timed_command("profile", cmd_profile)))
+    app.add_handler(CommandHandler("addcategory", timed_command("addcategory", cmd_addcategory)))
+    app.add_handler(CommandHandler("addproduct", timed_command("addproduct", cmd_addproduct)))
+    app.add_handler(CommandHandler("hideproduct", timed_command("hideproduct", cmd_hideproduct)))
+    app.add_handler(CommandHandler("showproduct", timed_command("showproduct", cmd_showproduct)))
+
+    app.add_handler(CallbackQueryHandler(on_callback))
+    app.add_handler(InlineQueryHandler(on_inline_query))
+
+def main():
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s", level=logging.INFO)
+    init_db()
+    store.engine.load()
+
+    # on_startup also starts the health server (so Render Web Service doesn't kill it)
+    builder = (
+        ApplicationBuilder()
+        .application_class(TracedApplication)
+        .token(BOT_TOKEN)
+        .rate_limiter(FloodLimiter())
+        .concurrent_updates(UserOrderedProcessor(CONCURRENT_UPDATES) if CONCURRENT_UPDATES > 1 else False)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    app = builder.build()
+    add_handlers(app)
+
+    try:
+        if BOT_MODE == "webhook":
+            asyncio.run(run_webhook(app))
+        else:
+            app.run_polling(allowed_updates=ALLOWED_UPDATES)
+    finally:
+        # no-op if post_shutdown already ran
+        store.close()
+        close_db()
 
 
 if __name__ == "__main__":